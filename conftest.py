@@ -6,6 +6,8 @@
 import util.globals
 import testlink.tltrack
 import control.netem
+import control.shell
+import control.metrics
 
 #########################################################################################
 #
@@ -180,3 +182,22 @@ def pytest_collect_file(path, parent):
     util.globals.setOpt("TESTCASE_FILE", str(path))
     util.globals.setLogFileName(1)
     util.globals.log("Entered test module: " + str(path))
+
+
+#########################################################################################
+#
+# METHOD: pytest_sessionfinish(session, exitstatus)
+#
+# DESCRIPTION: This method is called by py.test after the whole run has finished. It writes out the
+#              shell command timings (if SHELL_METRICS is set) and closes the persistent ssh
+#              connections opened by the shell objects during the run.
+#
+#########################################################################################
+def pytest_sessionfinish(session, exitstatus):
+    """pytest_sessionfinish(session, exitstatus) - This method is called by py.test after the whole run
+                has finished. It writes out the shell command timings (if SHELL_METRICS is set) and closes the
+                persistent ssh connections opened by the shell objects during the run.
+                """
+
+    control.metrics.metrics.report()
+    control.shell.close_ssh_masters()
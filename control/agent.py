@@ -0,0 +1,478 @@
+#!/usr/bin/python3
+
+#
+# Copyright 2016, Dan Malone, All Rights Reserved
+#
+from util.globals import *
+from .metrics import metrics
+
+import os
+import sys
+import json
+import queue
+import struct
+import base64
+import atexit
+import time
+import tempfile
+import threading
+from subprocess import Popen, PIPE, DEVNULL
+
+# Where the agent lives on the remote (relative to the login directory)
+AGENT_PATH = ".pati_agent.py"
+
+# #################################################################################################
+#
+# AGENT_SOURCE
+#
+# This is the program pushed to and run on the remote system. It reads framed requests from stdin and
+# writes framed responses to stdout. A frame is a 4 byte big endian length followed by that many bytes
+# of UTF-8 JSON. Every request carries an "id" which is echoed in all of its responses.
+#
+# Requests:
+#    {"id", "op" : "run",    "cmd", "stream"}  run cmd, respond "started", ("out"/"err" if stream), "exit"
+#    {"id", "op" : "signal", "pgid", "sig"}    signal a process group, respond "result"
+#    {"id", "op" : "read",   "path"}           read a file (or /proc entry), respond "result" with "data"
+#    {"id", "op" : "ping"}                     respond "result"
+#
+# Output and file data are base64 encoded so binary content survives the JSON.
+#
+# NOTE: Keep this python 3.4 compatible, it runs on whatever the testbed systems have installed
+#
+# #################################################################################################
+AGENT_SOURCE = r'''
+import os, sys, json, struct, base64, signal, threading, subprocess
+
+out_lock = threading.Lock()
+
+def send(msg):
+    data = json.dumps(msg).encode("utf-8")
+    with out_lock:
+        sys.stdout.buffer.write(struct.pack(">I", len(data)) + data)
+        sys.stdout.buffer.flush()
+
+def recv():
+    head = sys.stdin.buffer.read(4)
+    if len(head) < 4:
+        return None
+    size = struct.unpack(">I", head)[0]
+    return json.loads(sys.stdin.buffer.read(size).decode("utf-8"))
+
+def b64(data):
+    return base64.b64encode(data).decode("ascii")
+
+def pump(rid, pipe, kind, stream, keep):
+    while True:
+        data = os.read(pipe.fileno(), 65536)
+        if not data:
+            break
+        if stream:
+            send({"id": rid, "type": kind, "data": b64(data)})
+        else:
+            keep.append(data)
+
+def run(req):
+    rid = req["id"]
+    try:
+        proc = subprocess.Popen(req["cmd"], shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, start_new_session=True)
+    except Exception as e:
+        send({"id": rid, "type": "error", "error": str(e)})
+        return
+    send({"id": rid, "type": "started", "pid": proc.pid, "pgid": proc.pid})
+    out, err = [], []
+    stream = req.get("stream", 0)
+    pumps = [threading.Thread(target=pump, args=(rid, proc.stdout, "out", stream, out)),
+             threading.Thread(target=pump, args=(rid, proc.stderr, "err", stream, err))]
+    for t in pumps:
+        t.start()
+    for t in pumps:
+        t.join()
+    rc = proc.wait()
+    send({"id": rid, "type": "exit", "rc": rc, "out": b64(b"".join(out)), "err": b64(b"".join(err))})
+
+def main():
+    while True:
+        req = recv()
+        if req is None:
+            break
+        op = req.get("op")
+        try:
+            if op == "run":
+                t = threading.Thread(target=run, args=(req,))
+                t.daemon = True
+                t.start()
+            elif op == "signal":
+                try:
+                    os.killpg(int(req["pgid"]), getattr(signal, "SIG" + req["sig"]))
+                    send({"id": req["id"], "type": "result"})
+                except ProcessLookupError:
+                    send({"id": req["id"], "type": "result", "gone": 1})
+            elif op == "read":
+                with open(req["path"], "rb") as f:
+                    send({"id": req["id"], "type": "result", "data": b64(f.read())})
+            elif op == "ping":
+                send({"id": req["id"], "type": "result", "pid": os.getpid()})
+            else:
+                send({"id": req["id"], "type": "error", "error": "unknown op " + str(op)})
+        except Exception as e:
+            send({"id": req.get("id"), "type": "error", "error": str(e)})
+
+main()
+'''
+
+###################################################################################################
+#
+# MODULE (Class): agent
+#
+# DESCRIPTION   : This class starts and talks to a small resident python agent on a remote system. The
+#                 agent is pushed with put_file() and started once over a single ssh session, after
+#                 that every command is one request/response round trip on that session instead of a
+#                 new ssh channel plus a remote shell startup.
+#
+#                 A shell object uses it as its transport after shell.use_agent() (or for every remote
+#                 shell when SHELL_AGENT=1), it may also be used directly. Like the ssh masters, agents
+#                 are pooled per (user, ip): get_agent() returns the one every shell object pointing at
+#                 the same system shares, close_agents() stops them.
+#
+# Usage:
+#
+# remote = get_agent(shell("172.16.0.33", "root"))          (None if it could not be started)
+# rc, out, err = remote.run("tc qdisc")
+# for kind, data in remote.run_stream("tcpdump -c 10 -i any"):
+#    ...
+# stat = remote.read_file("/proc/loadavg")
+# remote.stop()
+#
+##################################################################################################
+class agent:
+    """This class starts and talks to a resident python agent on a remote system"""
+
+    ##############################################################################################
+    #
+    # METHOD: __init__(host_shell, python)
+    #
+    # DESCRIPTION: This is the initialization constructor:
+    #                 host_shell - shell object for the remote system
+    #                 python     - python interpreter to run the agent with on the remote
+    #              The agent is started right away
+    #
+    ##############################################################################################
+    def __init__(self, host_shell, python="python3"):
+        """__init__(host_shell, python)
+              This is the initialization constructor:
+                 host_shell - shell object for the remote system
+                 python     - python interpreter to run the agent with on the remote
+              The agent is started right away
+              """
+
+        self.host_shell = host_shell
+        self.python = python
+        self.process = None
+        self.reader = None
+        self.next_id = 0
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+
+        self.start()
+
+        # Don't leave the agent behind if we bomb out
+        atexit.register(self.stop)
+
+    ##############################################################################################
+    #
+    # METHOD: start()
+    #
+    # DESCRIPTION: Push the agent to the remote and start it. Returns 1 if the agent answered within
+    #              AGENT_WAIT seconds, 0 if it could not be copied or started (for instance no python
+    #              on the remote), the shell then keeps using ssh
+    #
+    ##############################################################################################
+    def start(self):
+        """start():
+              Push the agent to the remote and start it. Returns 1 if the agent answered within
+              AGENT_WAIT seconds, 0 if it could not be copied or started (for instance no python
+              on the remote), the shell then keeps using ssh
+              """
+
+        # Ship the agent source (not with put_file(), which ends the test if the copy fails)
+        fd, source = tempfile.mkstemp(prefix="pati_agent_", suffix=".py")
+        with os.fdopen(fd, "w") as f:
+            f.write(AGENT_SOURCE)
+        try:
+            copy = Popen(self.host_shell.copy_argv(source, AGENT_PATH, put=1), stdin=DEVNULL, stdout=PIPE, stderr=PIPE)
+            out, err = copy.communicate()
+        finally:
+            os.remove(source)
+        if copy.returncode != 0:
+            log("Agent could not be copied to " + self.host_shell.ip + ": " + err.decode('utf-8', 'replace').strip())
+            return 0
+
+        # And run it on one long lived ssh session
+        self.process = Popen(self.host_shell.ssh_argv(self.python + " -u " + AGENT_PATH), stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+        self.reader = threading.Thread(target=self.read_responses)
+        self.reader.daemon = True
+        self.reader.start()
+
+        try:
+            msg = self.request("ping").get(timeout=float(getOpt('AGENT_WAIT')))
+        except queue.Empty:
+            msg = {'type' : "error", 'error' : "no answer in " + str(getOpt('AGENT_WAIT')) + "s"}
+        if msg['type'] == "error":
+            log("Agent on " + self.host_shell.ip + " did not start: " + msg['error'])
+            # a wedged agent would not exit when its stdin is closed
+            self.process.kill()
+            self.stop()
+            return 0
+
+        if getOpt('VERBOSE'):
+            log("Agent started on " + self.host_shell.ip + " (remote pid " + str(msg['pid']) + ")")
+        return 1
+
+    ##############################################################################################
+    #
+    # METHOD: alive()
+    #
+    # DESCRIPTION: Returns 1 if the agent session is still up
+    #
+    ##############################################################################################
+    def alive(self):
+        """alive():
+              Returns 1 if the agent session is still up
+              """
+
+        return 1 if self.process is not None and self.process.poll() is None else 0
+
+    ##############################################################################################
+    #
+    # METHOD: stop()
+    #
+    # DESCRIPTION: Stop the agent. Closing its stdin makes it exit, commands it started keep running
+    #              in their own process groups.
+    #
+    ##############################################################################################
+    def stop(self):
+        """stop():
+              Stop the agent. Closing its stdin makes it exit, commands it started keep running
+              in their own process groups.
+              """
+
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(5)
+        except Exception:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    ##############################################################################################
+    #
+    # METHOD: request(op, **args)
+    #
+    # DESCRIPTION: Send a request and return the queue its responses will be delivered to
+    #
+    ##############################################################################################
+    def request(self, op, **args):
+        """request(op, **args):
+              Send a request and return the queue its responses will be delivered to
+              """
+
+        with self.lock:
+            self.next_id += 1
+            rid = self.next_id
+            responses = queue.Queue()
+            self.pending[rid] = responses
+
+        args['id'] = rid
+        args['op'] = op
+        data = json.dumps(args).encode("utf-8")
+        try:
+            with self.write_lock:
+                self.process.stdin.write(struct.pack(">I", len(data)) + data)
+                self.process.stdin.flush()
+        except (OSError, AttributeError, ValueError):
+            responses.put({'id' : rid, 'type' : "error", 'error' : "agent on " + self.host_shell.ip + " is not running"})
+        return responses
+
+    ##############################################################################################
+    #
+    # METHOD: read_responses()
+    #
+    # DESCRIPTION: Reader thread, hands each response frame to the queue of the request it belongs to.
+    #              If the session drops every outstanding request gets an error.
+    #
+    ##############################################################################################
+    def read_responses(self):
+        """read_responses():
+              Reader thread, hands each response frame to the queue of the request it belongs to.
+              If the session drops every outstanding request gets an error.
+              """
+
+        pipe = self.process.stdout
+        while True:
+            head = pipe.read(4)
+            if len(head) < 4:
+                break
+            msg = json.loads(pipe.read(struct.unpack(">I", head)[0]).decode("utf-8"))
+            with self.lock:
+                responses = self.pending.get(msg['id'])
+                if msg['type'] in ["exit", "result", "error"]:
+                    self.pending.pop(msg['id'], None)
+            if responses is not None:
+                responses.put(msg)
+
+        # Session is gone, fail whatever is still waiting
+        with self.lock:
+            for rid in list(self.pending.keys()):
+                self.pending.pop(rid).put({'id' : rid, 'type' : "error", 'error' : "agent on " + self.host_shell.ip + " exited"})
+
+    ##############################################################################################
+    #
+    # METHOD: run(cmd)
+    #
+    # DESCRIPTION: Run a command through the agent and wait for it. Returns (rc, out, err) where out
+    #              and err are bytes. rc is None if the agent could not run it.
+    #
+    ##############################################################################################
+    def run(self, cmd):
+        """run(cmd):
+              Run a command through the agent and wait for it. Returns (rc, out, err) where out
+              and err are bytes. rc is None if the agent could not run it.
+              """
+
+        responses = self.request("run", cmd=cmd, stream=0)
+        while True:
+            msg = responses.get()
+            if msg['type'] == "exit":
+                return msg['rc'], base64.b64decode(msg['out']), base64.b64decode(msg['err'])
+            if msg['type'] == "error":
+                return None, b"", msg['error'].encode("utf-8")
+
+    ##############################################################################################
+    #
+    # METHOD: run_stream(cmd)
+    #
+    # DESCRIPTION: Run a command through the agent and yield its output as it arrives. This is a
+    #              generator of (kind, data) where kind is "started" (data is (pid, pgid)), "out" or
+    #              "err" (data is bytes) and finally "exit" (data is the exit code).
+    #
+    ##############################################################################################
+    def run_stream(self, cmd):
+        """run_stream(cmd):
+              Run a command through the agent and yield its output as it arrives. This is a
+              generator of (kind, data) where kind is "started" (data is (pid, pgid)), "out" or
+              "err" (data is bytes) and finally "exit" (data is the exit code).
+              """
+
+        responses = self.request("run", cmd=cmd, stream=1)
+        while True:
+            msg = responses.get()
+            if msg['type'] == "started":
+                yield "started", (str(msg['pid']), str(msg['pgid']))
+            elif msg['type'] in ["out", "err"]:
+                yield msg['type'], base64.b64decode(msg['data'])
+            elif msg['type'] == "exit":
+                yield "exit", msg['rc']
+                return
+            else:
+                yield "err", msg['error'].encode("utf-8")
+                yield "exit", None
+                return
+
+    ##############################################################################################
+    #
+    # METHOD: signal(pgid, sig)
+    #
+    # DESCRIPTION: Signal (TERM, KILL, ...) a process group on the remote. Returns 1 if the group
+    #              still existed.
+    #
+    ##############################################################################################
+    def signal(self, pgid, sig="TERM"):
+        """signal(pgid, sig):
+              Signal (TERM, KILL, ...) a process group on the remote. Returns 1 if the group
+              still existed.
+              """
+
+        msg = self.request("signal", pgid=int(pgid), sig=sig).get()
+        return 0 if msg['type'] == "error" or 'gone' in msg else 1
+
+    ##############################################################################################
+    #
+    # METHOD: read_file(path)
+    #
+    # DESCRIPTION: Read a remote file (or /proc entry) directly, without running cat. Returns bytes,
+    #              None if it could not be read.
+    #
+    ##############################################################################################
+    def read_file(self, path):
+        """read_file(path):
+              Read a remote file (or /proc entry) directly, without running cat. Returns bytes,
+              None if it could not be read.
+              """
+
+        msg = self.request("read", path=path).get()
+        if msg['type'] == "error":
+            return None
+        return base64.b64decode(msg['data'])
+
+# Pool of agents keyed by (user, ip), the systems an agent could not be started on and the lock
+# protecting them
+agents = {}
+agents_failed = set()
+agents_lock = threading.Lock()
+
+##############################################################################################
+#
+# METHOD: get_agent(host_shell, retry)
+#
+# DESCRIPTION: Returns the pooled agent for the user@ip of host_shell, starting it if needed. Returns
+#              None if it could not be started, a system that failed is not tried again unless retry
+#              is 1.
+#
+##############################################################################################
+def get_agent(host_shell, retry=0):
+    """get_agent(host_shell, retry):
+          Returns the pooled agent for the user@ip of host_shell, starting it if needed. Returns
+          None if it could not be started, a system that failed is not tried again unless retry
+          is 1.
+          """
+
+    key = (host_shell.user, host_shell.ip)
+    with agents_lock:
+        remote = agents.get(key)
+        if remote is not None and remote.alive():
+            return remote
+        if key in agents_failed and not retry:
+            return None
+
+        # the start up is the connect time of the command waiting for it
+        started = time.time()
+        remote = agent(host_shell)
+        metrics.handshake(time.time() - started)
+        if not remote.alive():
+            agents.pop(key, None)
+            agents_failed.add(key)
+            return None
+        agents[key] = remote
+        agents_failed.discard(key)
+        return remote
+
+##############################################################################################
+#
+# METHOD: close_agents(ip)
+#
+# DESCRIPTION: Stop the pooled agents. If ip is given only the agents on that ip are stopped.
+#
+##############################################################################################
+def close_agents(ip=None):
+    """close_agents(ip):
+          Stop the pooled agents. If ip is given only the agents on that ip are stopped.
+          """
+
+    with agents_lock:
+        for key in list(agents.keys()):
+            if ip is None or key[1] == ip:
+                agents.pop(key).stop()
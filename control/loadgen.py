@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+
+#
+# Copyright 2016, Dan Malone, All Rights Reserved
+#
+import json
+import base64
+
+# #################################################################################################
+#
+# LOADGEN_SOURCE
+#
+# This is the HTTP load generator run on the test client by transfer.start({'ENGINE' : 'loadgen'}) (see
+# transfer.loadgenThread). It reads the plan (json) from stdin:
+#    {"urls" : [<url>, ...], "connections" : <n>, "count" : <passes over urls per connection>,
+#     "continuous" : 0/1, "proxy" : "<host>:<port>" or "", "http" : "1.1" or "1.0", "timeout" : <seconds>}
+# and keeps <connections> HTTP connections busy at the same time, each requesting the urls in turn over one
+# kept-alive connection (re-opened when the server closes it). https urls are fetched over TLS (certificates
+# are verified, like curl does), but not through a proxy. Bodies are counted and thrown away. It writes
+# one json line per request as soon as it completes:
+#    {"w" : <connection>, "url", "code", "bytes", "new" : 1 if a connection was opened for it,
+#     "t" : <start time>, "connect", "ttfb", "total" : <seconds from the start of the request>, "error"}
+# and exits when every connection is done, or on a TERM (requests in flight are reported as errors).
+#
+# NOTE: Keep this python 3.5 compatible, it runs on whatever the test client has installed
+#
+# #################################################################################################
+LOADGEN_SOURCE = r'''
+import sys, json, time, asyncio, signal, ssl
+from urllib.parse import urlsplit
+
+plan = json.loads(sys.stdin.read())
+state = {'stop' : 0}
+
+def emit(record):
+    sys.stdout.write(json.dumps(record) + "\n")
+    sys.stdout.flush()
+
+async def skip(reader, n):
+    left = n
+    while left:
+        data = await reader.read(min(left, 262144))
+        if not data:
+            raise ConnectionError("connection closed in the body")
+        left -= len(data)
+    return n
+
+async def body(reader, headers):
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        size = 0
+        while 1:
+            n = int((await reader.readline()).split(b";")[0].strip() or b"0", 16)
+            if n == 0:
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return size, 1
+            size += await skip(reader, n)
+            await reader.readline()
+    if "content-length" in headers:
+        return await skip(reader, int(headers["content-length"])), 1
+    size = 0
+    while 1:
+        data = await reader.read(262144)
+        if not data:
+            return size, 0
+        size += len(data)
+
+async def request(conn, url, record, start):
+    parts = urlsplit(url if "://" in url else "http://" + url)
+    secure = parts.scheme == "https"
+    target = plan["proxy"] or parts.scheme + "://" + parts.netloc
+    if conn[0] is None or conn[0][0] != target:
+        if conn[0] is not None:
+            conn[0][2].close()
+        address = plan["proxy"] or parts.netloc
+        host, sep, port = address.rpartition(":") if ":" in address else (address, "", "443" if secure else "80")
+        tls = {"ssl" : ssl.create_default_context(), "server_hostname" : host} if secure and not plan["proxy"] else {}
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, int(port), **tls), plan["timeout"])
+        conn[0] = (target, reader, writer)
+        record["new"] = 1
+        record["connect"] = time.time() - start
+    target, reader, writer = conn[0]
+    path = parts.geturl() if plan["proxy"] else (parts.path or "/") + ("?" + parts.query if parts.query else "")
+    writer.write(("GET " + path + " HTTP/" + plan["http"] + "\r\nHost: " + parts.netloc +
+                  "\r\nUser-Agent: pati-loadgen\r\nAccept: */*\r\n\r\n").encode("latin-1"))
+    await writer.drain()
+    status = await asyncio.wait_for(reader.readline(), plan["timeout"])
+    if not status:
+        raise ConnectionError("connection closed before the response")
+    record["ttfb"] = time.time() - start
+    record["code"] = int(status.split()[1])
+    headers = {}
+    while 1:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, sep, value = line.decode("latin-1").partition(":")
+        headers[key.strip().lower()] = value.strip()
+    record["bytes"], framed = await body(reader, headers)
+    if not framed or plan["http"] == "1.0" or headers.get("connection", "").lower() == "close":
+        writer.close()
+        conn[0] = None
+
+async def worker(wid):
+    conn = [None]
+    passes = 0
+    while not state['stop'] and (plan["continuous"] or passes < plan["count"]):
+        for url in plan["urls"]:
+            if state['stop']:
+                break
+            start = time.time()
+            for attempt in range(2):
+                record = {"w" : wid, "url" : url, "code" : 0, "bytes" : 0, "new" : 0, "t" : start,
+                          "connect" : 0.0, "ttfb" : 0.0, "total" : 0.0, "error" : ""}
+                try:
+                    await request(conn, url, record, start)
+                    break
+                except asyncio.CancelledError:
+                    record["error"] = "stopped"
+                    break
+                except Exception as e:
+                    record["error"] = type(e).__name__ + ": " + str(e)
+                    if conn[0] is not None:
+                        conn[0][2].close()
+                        conn[0] = None
+                    # a kept-alive connection the server dropped meanwhile is opened again once
+                    if record["new"] or record["code"]:
+                        break
+            record["total"] = time.time() - start
+            emit(record)
+            if record["error"] == "stopped":
+                return
+        passes += 1
+    if conn[0] is not None:
+        conn[0][2].close()
+
+loop = asyncio.get_event_loop()
+tasks = [loop.create_task(worker(wid)) for wid in range(plan["connections"])]
+def halt():
+    state['stop'] = 1
+    for task in tasks:
+        task.cancel()
+loop.add_signal_handler(signal.SIGTERM, halt)
+loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+'''
+
+##############################################################################################
+#
+# METHOD: loadgen_command(plan)
+#
+# DESCRIPTION: Returns the shell command which runs LOADGEN_SOURCE with the plan dictionary
+#
+##############################################################################################
+def loadgen_command(plan):
+    """loadgen_command(plan):
+          Returns the shell command which runs LOADGEN_SOURCE with the plan dictionary
+          """
+
+    source = base64.b64encode(LOADGEN_SOURCE.encode('utf-8')).decode('ascii')
+    return "python3 -c 'import base64; exec(base64.b64decode(\"" + source + "\"))' <<'PATI_PLAN'\n" + json.dumps(plan) + "\nPATI_PLAN"
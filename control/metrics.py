@@ -0,0 +1,378 @@
+#!/usr/bin/python3
+
+#
+# Copyright 2016, Dan Malone, All Rights Reserved
+#
+from util.globals import *
+
+import os
+import sys
+import csv
+import json
+import time
+import threading
+
+###################################################################################################
+#
+# MODULE (Class): shell_metrics
+#
+# DESCRIPTION   : This class is an in-process registry of per command timings recorded by the shell
+#                 objects. Each record holds the host, the class of command (like "tc qdisc" or "ps"),
+#                 the helper which issued it (like "netem.clear_netem"), how long was spent bringing up a
+#                 connection (the ssh master or agent handshake the command had to wait for, 0 when it
+#                 reused one; a plain ssh connection is part of the exec time), executing and decoding,
+#                 the bytes of stdout/stderr and the exit status. launch() and the file copies are timed
+#                 too (exec time is the time to start the program or to copy).
+#
+#                 Recording is off unless SHELL_METRICS=1. At the end of a pytest session the records
+#                 are written to <SHELL_METRICS_FILE>.json and .csv and a per helper summary is logged
+#                 so the hot paths stand out.
+#
+# Usage:
+#
+# from control.metrics import metrics
+# metrics.summary("caller")          list of per helper totals, most expensive first
+# metrics.dump_json("run.json")
+# metrics.dump_csv("run.csv")
+#
+##################################################################################################
+class shell_metrics:
+    """In-process registry of per command shell timings"""
+
+    # Columns of a record, in csv order
+    FIELDS = ['time', 'host', 'transport', 'command_class', 'caller', 'connect_time', 'exec_time',
+              'decode_time', 'bytes_out', 'bytes_err', 'exit_status', 'command']
+
+    ##############################################################################################
+    #
+    # METHOD: __init__()
+    #
+    # DESCRIPTION: This is the initialization constructor
+    #
+    ##############################################################################################
+    def __init__(self):
+        """__init__():
+              This is the initialization constructor
+              """
+
+        self.records = []
+        self.lock = threading.Lock()
+
+        # The timers of the commands each thread is running (see handshake())
+        self.local = threading.local()
+
+    ##############################################################################################
+    #
+    # METHOD: enabled()
+    #
+    # DESCRIPTION: Returns 1 if SHELL_METRICS is set and calls should be recorded
+    #
+    ##############################################################################################
+    def enabled(self):
+        """enabled():
+              Returns 1 if SHELL_METRICS is set and calls should be recorded
+              """
+
+        return 1 if getOpt('SHELL_METRICS') else 0
+
+    ##############################################################################################
+    #
+    # METHOD: caller()
+    #
+    # DESCRIPTION: Returns the name of the code which issued the command, the first frame outside of the
+    #              shell/metrics modules and asyncio. Methods are named <class>.<method>.
+    #
+    ##############################################################################################
+    def caller(self):
+        """caller():
+              Returns the name of the code which issued the command, the first frame outside of the
+              shell/metrics modules and asyncio. Methods are named <class>.<method>.
+              """
+
+        frame = sys._getframe(1)
+        while frame is not None:
+            filename = frame.f_code.co_filename
+            if not (filename.endswith("shell.py") or filename.endswith("metrics.py") or filename.endswith("agent.py") or
+                    os.sep + "asyncio" + os.sep in filename or filename.endswith("threading.py")):
+                name = frame.f_code.co_name
+                if 'self' in frame.f_locals:
+                    name = frame.f_locals['self'].__class__.__name__ + "." + name
+                return name
+            frame = frame.f_back
+        return ""
+
+    ##############################################################################################
+    #
+    # METHOD: command_class(cmd)
+    #
+    # DESCRIPTION: Reduce a command line to its class so similar calls aggregate, for example
+    #              "sudo tc qdisc del dev eth1 root" is "tc qdisc" and "cd /tmp; curl ..." is "curl"
+    #
+    ##############################################################################################
+    def command_class(self, cmd):
+        """command_class(cmd):
+              Reduce a command line to its class so similar calls aggregate, for example
+              "sudo tc qdisc del dev eth1 root" is "tc qdisc" and "cd /tmp; curl ..." is "curl"
+              """
+
+        words = []
+        for part in cmd.split(";"):
+            words = part.split()
+            # skip cd, sudo and VAR=value prefixes
+            while words and (words[0] in ["sudo", "-i", "exec"] or "=" in words[0]):
+                words = words[1:]
+            if words and words[0] not in ["cd", "export"]:
+                break
+        if len(words) == 0:
+            return ""
+        name = os.path.basename(words[0])
+        if name in ["tc", "ip", "service", "systemctl"] and len(words) > 1:
+            name += " " + words[1]
+        return name
+
+    ##############################################################################################
+    #
+    # METHOD: start(host)
+    #
+    # DESCRIPTION: Returns a call_timer for one command run on host. When recording is off the timer
+    #              does nothing, so the shell can time every call unconditionally.
+    #
+    ##############################################################################################
+    def start(self, host):
+        """start(host):
+              Returns a call_timer for one command run on host. When recording is off the timer
+              does nothing, so the shell can time every call unconditionally.
+              """
+
+        if not self.enabled():
+            return call_timer(None, host, "")
+        timer = call_timer(self, host, self.caller())
+        timer.stack = self.timers()
+        timer.stack.append(timer)
+        return timer
+
+    ##############################################################################################
+    #
+    # METHOD: timers()
+    #
+    # DESCRIPTION: Returns the list of the timers of the commands this thread is running, innermost last
+    #
+    ##############################################################################################
+    def timers(self):
+        """timers():
+              Returns the list of the timers of the commands this thread is running, innermost last
+              """
+
+        if not hasattr(self.local, 'timers'):
+            self.local.timers = []
+        return self.local.timers
+
+    ##############################################################################################
+    #
+    # METHOD: handshake(seconds)
+    #
+    # DESCRIPTION: Called by the ssh master and the agent with the seconds it took to bring the connection
+    #              up, which is the connect time of the command this thread is running
+    #
+    ##############################################################################################
+    def handshake(self, seconds):
+        """handshake(seconds):
+              Called by the ssh master and the agent with the seconds it took to bring the connection
+              up, which is the connect time of the command this thread is running
+              """
+
+        timers = self.timers() if self.enabled() else []
+        if len(timers):
+            timers[-1].handshake += seconds
+
+    ##############################################################################################
+    #
+    # METHOD: record(host, transport, cmd, caller, start, handshake, executed, decoded, bytes_out, bytes_err, status)
+    #
+    # DESCRIPTION: Record one command. start, executed and decoded are time.time() stamps taken when the
+    #              call started, once the command completed and once the output was decoded, handshake
+    #              the seconds spent in between bringing up its connection.
+    #
+    ##############################################################################################
+    def record(self, host, transport, cmd, caller, start, handshake, executed, decoded, bytes_out, bytes_err, status):
+        """record(host, transport, cmd, caller, start, handshake, executed, decoded, bytes_out, bytes_err, status):
+              Record one command. start, executed and decoded are time.time() stamps taken when the
+              call started, once the command completed and once the output was decoded, handshake
+              the seconds spent in between bringing up its connection.
+              """
+
+        entry = {'time'          : start,
+                 'host'          : host,
+                 'transport'     : transport,
+                 'command_class' : self.command_class(cmd),
+                 'caller'        : caller,
+                 'connect_time'  : handshake,
+                 'exec_time'     : max(executed - start - handshake, 0.0),
+                 'decode_time'   : decoded - executed,
+                 'bytes_out'     : bytes_out,
+                 'bytes_err'     : bytes_err,
+                 'exit_status'   : status,
+                 'command'       : cmd}
+        with self.lock:
+            self.records.append(entry)
+
+    ##############################################################################################
+    #
+    # METHOD: clear()
+    #
+    # DESCRIPTION: Forget all records
+    #
+    ##############################################################################################
+    def clear(self):
+        """clear():
+              Forget all records
+              """
+
+        with self.lock:
+            self.records = []
+
+    ##############################################################################################
+    #
+    # METHOD: summary(key)
+    #
+    # DESCRIPTION: Aggregate the records by key ("caller", "command_class", "host" or "transport").
+    #              Returns a list of dictionaries {key, calls, connect_time, exec_time, decode_time,
+    #              total_time, bytes_out} sorted by total_time, most expensive first.
+    #
+    ##############################################################################################
+    def summary(self, key="caller"):
+        """summary(key):
+              Aggregate the records by key ("caller", "command_class", "host" or "transport").
+              Returns a list of dictionaries {key, calls, connect_time, exec_time, decode_time,
+              total_time, bytes_out} sorted by total_time, most expensive first.
+              """
+
+        totals = {}
+        with self.lock:
+            for entry in self.records:
+                total = totals.setdefault(entry[key], {key : entry[key], 'calls' : 0, 'connect_time' : 0.0, 'exec_time' : 0.0,
+                                                       'decode_time' : 0.0, 'total_time' : 0.0, 'bytes_out' : 0})
+                total['calls'] += 1
+                total['bytes_out'] += entry['bytes_out']
+                for field in ['connect_time', 'exec_time', 'decode_time']:
+                    total[field] += entry[field]
+                    total['total_time'] += entry[field]
+
+        return sorted(totals.values(), key=lambda total: total['total_time'], reverse=True)
+
+    ##############################################################################################
+    #
+    # METHOD: dump_json(path)
+    #
+    # DESCRIPTION: Write the records and the per caller/command class summaries to path as JSON
+    #
+    ##############################################################################################
+    def dump_json(self, path):
+        """dump_json(path):
+              Write the records and the per caller/command class summaries to path as JSON
+              """
+
+        with self.lock:
+            records = list(self.records)
+        with open(path, "w") as f:
+            json.dump({'records' : records, 'by_caller' : self.summary("caller"), 'by_command_class' : self.summary("command_class")}, f, indent=1)
+
+    ##############################################################################################
+    #
+    # METHOD: dump_csv(path)
+    #
+    # DESCRIPTION: Write the records to path as CSV, one line per command
+    #
+    ##############################################################################################
+    def dump_csv(self, path):
+        """dump_csv(path):
+              Write the records to path as CSV, one line per command
+              """
+
+        with self.lock:
+            records = list(self.records)
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=self.FIELDS)
+            writer.writeheader()
+            writer.writerows(records)
+
+    ##############################################################################################
+    #
+    # METHOD: report()
+    #
+    # DESCRIPTION: Dump the records to <SHELL_METRICS_FILE>.json/.csv and log the most expensive helpers.
+    #              This is called at the end of a pytest session when SHELL_METRICS is set.
+    #
+    ##############################################################################################
+    def report(self):
+        """report():
+              Dump the records to <SHELL_METRICS_FILE>.json/.csv and log the most expensive helpers.
+              This is called at the end of a pytest session when SHELL_METRICS is set.
+              """
+
+        if not self.enabled() or len(self.records) == 0:
+            return
+
+        base = str(getOpt('SHELL_METRICS_FILE'))
+        self.dump_json(base + ".json")
+        self.dump_csv(base + ".csv")
+
+        log("Shell metrics (" + str(len(self.records)) + " commands) written to " + base + ".json/.csv")
+        for total in self.summary("caller")[:10]:
+            log("   %-40s calls %6d   total %9.3fs   connect %8.3fs   exec %9.3fs" %
+                (total['caller'], total['calls'], total['total_time'], total['connect_time'], total['exec_time']))
+
+###################################################################################################
+#
+# MODULE (Class): call_timer
+#
+# DESCRIPTION   : Time stamps of one shell command as it goes through its phases. The shell calls
+#                 connected() with the transport it picked, executed() when the command has completed
+#                 and done() once the output has been decoded, which records the call. The seconds the
+#                 ssh master or agent took to come up on the way are added to handshake (see
+#                 shell_metrics.handshake()). A timer without a registry (recording off) ignores all of
+#                 them.
+#
+##################################################################################################
+class call_timer:
+    """Time stamps of one shell command as it goes through its phases"""
+
+    def __init__(self, registry, host, caller):
+        self.registry  = registry
+        self.host      = host
+        self.caller    = caller
+        self.transport = ""
+        self.start     = time.time() if registry else 0
+        self.handshake = 0.0
+        self.execute   = self.start
+        self.stack     = []
+
+    def connected(self, transport):
+        """connected(transport):
+              The command is about to be sent, transport is "local", "ssh", "agent" or "scp"
+              """
+        if self.registry:
+            self.transport = transport
+            self.execute = time.time()
+
+    def executed(self):
+        """executed():
+              The command has completed
+              """
+        if self.registry:
+            self.execute = time.time()
+
+    def done(self, cmd, bytes_out, bytes_err, status):
+        """done(cmd, bytes_out, bytes_err, status):
+              The output has been decoded, record the call
+              """
+        if self.registry:
+            self.registry.record(self.host, self.transport, cmd, self.caller, self.start, self.handshake, self.execute,
+                                 time.time(), bytes_out, bytes_err, status)
+            # the stack of the thread which started the call (a generator may be closed from another)
+            if self in self.stack:
+                self.stack.remove(self)
+            self.registry = None
+
+# The registry the shell objects record into
+metrics = shell_metrics()
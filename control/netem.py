@@ -5,6 +5,8 @@
 #
 from util import *
 from .shell import *
+from .netem_state import read_state, qdisc_sampler
+from .profiles import get_catalog, compile_profile
 
 local_shell = shell("local")
 
@@ -65,25 +67,25 @@ class netem:
         # We'll need a shell on the remote machine
         self.netem_shell = shell(self.control_ip, self.user)
 
-        # this is a kludge to allow executing inline tc cmds if non-root we create a set of
-        # netem scripts on the fly (delete, create and change) to control from the device itself.
+        # this is a kludge to allow clearing netem if non-root, clear_netem() runs a netem_delete.sh script
+        # created on the fly on the device itself (set() applies everything as one tc batch, see apply_tc())
         if self.user != "root":
             
             ##### DELETE #####
             log("VERIFYING OR CREATING NETEM_DELETE.SH")
             ndelete_bash = "#!/bin/bash\n\nDEV=\$1\ntc qdisc del dev \$DEV root\n"
-            self.netem_shell.run("if [ ! -f netem_delete.sh ]; then echo \"" +ndelete_bash+ "\" > netem_delete.sh; chmod 777 netem_delete.sh; fi") 
-            
-            ##### CHANGE #####
-            log("VERIFYING OR CREATING NETEM_CHANGE.SH")
-            nchange_bash = "#!/bin/bash\n\nDEV=\$1\nALG=\$2\nRATE=\$3\nDELAY=\$4\nLIMIT=\$5\nPING=\$6\n\nif [ \$LIMIT -gt 0 ]; then tc class change dev \$DEV parent 10: classid 0:1 \$ALG rate \$RATE ceil \$RATE\n\ntc qdisc change dev \$DEV parent 10:1 handle 11: netem delay \$DELAY limit \$LIMIT\n\nping -c 1 \$PING;\nelse\n tc class change dev \$DEV parent 10: classid 0:1 \$ALG rate \$RATE ceil \$RATE\n\ntc qdisc change dev \$DEV parent 10:1 handle 11: netem delay \$DELAY\n\nping -c 1 \$PING;\n fi"
-            self.netem_shell.run("echo \"" +nchange_bash+ "\" > netem_change.sh; chmod 777 netem_change.sh;") 
-            
-            ##### CREATE #####
-            log("VERIFYING OR CREATING NETEM_CREATE.SH")            
-            ncreate_bash = "#!/bin/bash\n\nDEV=\$1\nALG=\$2\nRATE=\$3\nDELAY=\$4\nLIMIT=\$5\nPING=\$6\n\nif [ \$LIMIT -gt 0 ]; then tc qdisc add dev \$DEV root handle 1: prio bands 10\n\ntc qdisc add dev \$DEV parent 1:1 handle 10: \$ALG default 1\n\ntc class add dev \$DEV parent 10: classid 0:1 \$ALG rate \$RATE ceil \$RATE\n\ntc qdisc add dev \$DEV parent 10:1 handle 11: netem delay \$DELAY limit \$LIMIT\n\ntc filter add dev \$DEV protocol ip parent 1:0  prio 1 u32 match ip src 0.0.0.0/0 match ip dst 0.0.0.0/0 flowid 10:1\n\nping -c 1 \$PING\nelse\ntc qdisc add dev \$DEV root handle 1: prio bands 10\n\ntc qdisc add dev \$DEV parent 1:1 handle 10: \$ALG default 1\n\ntc class add dev \$DEV parent 10: classid 0:1 \$ALG rate \$RATE ceil \$RATE\n\ntc qdisc add dev \$DEV parent 10:1 handle 11: netem delay \$DELAY\n\ntc filter add dev \$DEV protocol ip parent 1:0  prio 1 u32 match ip src 0.0.0.0/0 match ip dst 0.0.0.0/0 flowid 10:1\n\nping -c 1 \$PING;\n fi"
-            self.netem_shell.run("echo \"" +ncreate_bash+ "\" > netem_create.sh; chmod 777 netem_create.sh;") 
+            self.netem_shell.run("if [ ! -f netem_delete.sh ]; then echo \"" +ndelete_bash+ "\" > netem_delete.sh; chmod 777 netem_delete.sh; fi")
             
+        # The tree set() last built on each interface {eth : {'rate', 'netem'}}, so the next set() only
+        # has to change what differs. Empty when the state of the interfaces is not known.
+        self.applied = {}
+
+        # The background qdisc statistics sampler (see start_stats())
+        self.sampler = None
+
+        # How far apart the interfaces switched on the last parallel set() (see parallel_results())
+        self.skew = {}
+
         # Don't leave impairment in place if we bomb out
         atexit.register(self.clear_netem)
         
@@ -106,14 +108,16 @@ class netem:
         eths = shlex.split(eths, "/n")
         eths.sort()
         log('DEBUG', "Clearing netem on interfaces on server " + self.control_ip)
+        self.applied = {}
+
+        # Delete the qdiscs of every interface in one round trip, failures (no qdisc to delete) are expected
+        deletes = self.netem_shell.batch()
         for eth in eths:
-            try:
-                if self.user != "root":
-                    self.netem_shell.run("./netem_delete.sh " +eth)
-                else:
-                    self.netem_shell.run("tc qdisc del dev " + eth + " root", 0)
-            except:
-                pass
+            if self.user != "root":
+                deletes.add("./netem_delete.sh " +eth, 0)
+            else:
+                deletes.add("tc qdisc del dev " + eth + " root", 0)
+        deletes.run()
         trace_exit()
         
     ##############################################################################################
@@ -193,204 +197,61 @@ class netem:
             name = profile
 
         if not isinstance(profile, dict):
-            # This is a profile in the netem_testcases.csv file
-            if not csvReader.profileInCsv(profile):
-                msg = 'Profile does not exist in ../netem_scripts/netem_testcases.csv'
+            # This is a profile in the netem_testcases.csv file (loaded and validated once, see control/profiles.py)
+            catalog = get_catalog()
+            if profile not in catalog:
+                msg = 'Profile does not exist in ' + catalog.path
                 msg = "\nERROR: " + self.__class__.__name__ + "(" + name + ") " + msg + "\n"
                 log(msg)
                 sys.exit(msg)
                 
-            loss      = csvReader.getFieldFromCsv(profile, "loss")
-            delay     = csvReader.getFieldFromCsv(profile, "delay")
-            jitter    = csvReader.getFieldFromCsv(profile, "jitter")
-            bandwidth = csvReader.getFieldFromCsv(profile, "bandwidth")
-            profile   = {'name' : profile, 'loss': loss, 'delay' : delay, 'jitter' : jitter, 'bandwidth' : bandwidth}
+            profile   = catalog.get(profile)
             
         elif not 'delay' in profile:
             msg = self.__class__.__name__ + "(" + name + ") Profile dictionary must contain delay:, loss:, jitter:, bandwidth:"
             log(msg)
             sys.exit(msg)
 
-        # we should have what we need do ome text formatting to make 
-        # it easier to create the commands
-        loss      = str(profile['loss']) + "%"
-        delay     = str(float(profile['delay']/2)) + "ms"
-        jitter    = str(float(profile['jitter']/2)) + "ms"
-        bandwidth = str(profile['bandwidth']) + "kbit"
-
-        # netem allows the use of a predefined distribution file to
-        # administer pseudo RTT over time. Check for and set up use.
-        rttdist   = ""
-        dvary     = ""
-        if "rttdist" in profile:
-            rttdist = str(profile['rttdist'])
-            if "dvary" in profile and rttdist != "":
-                # set up sigma delay value for above distribution if included
-                dvary = str(float(profile['dvary']/2)) + "ms"
-
-        # check for reorder directive and set up if found
-        reorder   = ""
-        if "reorder" in profile:
-            reorder = str(profile['reorder'])            
-
-        # Best to clear the netem first if not just doing an update.  
-        # tc qdisc add sometimes errors with RTNETLINK answers: File exists
-        if not update_only and dynQlim == 0:
-            self.clear_netem()
+        # Expand the profile into the tc values (validated, formatted and queue limit sized once per profile)
+        compiled  = compile_profile(profile, dynQlim)
 
         # get ip from "eth" and set up for ip ping marker if pcap-ing
         ping_ip = exec_ping
         log("NETEM PING IP : " +str(ping_ip))
 
-        # Apply netem config to all interfaces listed in config
+        if self.method not in ["1", "2"]:
+            msg = 'Metem method: "' + self.method + '" invalid.  Please specify "1" or "2"'
+            msg = "\nERROR: " + self.__class__.__name__ + "(" + name + ") " + msg + "\n"
+            log(msg)
+            sys.exit(msg)
+
+        # Compile the profile for all interfaces listed in config into one tc batch script. If set() built the
+        # trees on all of them the existing trees are just changed where they differ from the new profile
         log('DEBUG', 'Applying netem profile "' + name + '": ' + str(profile))
-        for element in self.testbed.find("netem_server").findall("interface"):
+        eths = self.interfaces()
+        incremental = self.method == "2" and len(eths) > 0 and all(eth in self.applied for eth in eths)
 
-            eth = element.find("name").text
-            log("FOUND NETEM INTF : " + eth)
+        lines = []
+        tree = {}
+        for eth in eths:
+            tree[eth] = {'rate' : compiled.bandwidth, 'netem' : compiled.netem}
+            if incremental:
+                lines += self.tc_changes(eth, self.applied[eth], tree[eth])
+            else:
+                lines += self.tc_lines(eth, compiled, update_only)
 
-            # Again if not doing an update clear out the old settings (although this
-            # appears to be redundant as we did a clear netem above)
-            if not update_only and dynQlim == 0:
-                self.netem_shell.run("tc qdisc del dev " + eth + " root", 0)
-            
-            # if indicated size the netem queue limit dynamically based of bandwidth and delay
-            limit = 0
-            if dynQlim:
-
-                # this is for buffer bloat experimentation (congestion network) by allowing a multiplier
-                # for qdepth we can simulate network buffering along the pipe.
-                if 'bwmult' in profile:
-                    bwmult = profile['bwmult']
-                    # calculate qdepth based on full RTT if < 30 use 30 as base limit else use calculated.
-                    limit = int(1.2 * (((int(profile['bandwidth']) * 1024) * ((int(profile['delay']))/1000))/11160)) + 30
-                    limit = int(limit * bwmult)
-                else:
-                    # calculate qdepth based on full RTT if < 30 use 30 as base limit else use calculated.
-                    limit = int(1.2 * (((int(profile['bandwidth']) * 1024) * ((int(profile['delay']))/1000))/11160)) + 30
-
-                log("HTB QLIMIT Formula( limit = 1.2 * (<bandwidth> * 1024) * ((delay/2)/1000) /<data bits in pkt>)")
-                log("UNI-DIRECTIONAL Q LIMIT : "+str(limit))
-                log("BANDWIDTH               : "+str(profile['bandwidth']))
-                log("DELAY IN MS             : "+str(profile['delay']))
-
-            # Here we set up netem according to the kernel as it varies between: >= 3.8 vs < 3.8
-            if self.method == "2":
-                log('DEBUG', "Setting netem method 2 3.8 kernel or >")
-
-                # see if we are only doing a tc qdisc dynamic update
-                if update_only:
-
-                    # just make the update on the same netem instance(s).. note: if we are root we handle it
-                    # via shell else we have to call the scripts placed earlier on the target device.
-                    if self.user == "root":
-                        # this is a root user based update we can use the shell
-                        cmd = "tc class change dev "  + eth + " parent 10: classid 0:1 htb rate " + bandwidth + " ceil " + bandwidth
-
-                        # if we have a dynamic queue length then use it
-                        if dynQlim:
-                            cmd += "; tc qdisc change dev "  + eth + " parent 10:1 handle 11: netem"
-                            if int(profile['delay']) > 0:
-                                # see if we are implimwenting a distirbution
-                                if rttdist == "":
-                                    # no.. use delay as is
-                                    cmd += " delay " +delay
-                                else:
-                                    # this is a distribution table file request apply dvary and dist
-                                    cmd += " delay " +delay+ " " +dvary+ " distribution " +rttdist
-                            if reorder != "":
-                                # apply a reorder
-                                cmd += " reorder " +reorder
-                            if int(profile['jitter']) > 0:
-                                # apply a jitter
-                                cmd += " " + jitter
-                            if float(profile['loss']) > 0.0:
-                                # apply a loss
-                                cmd += " loss " +loss
-                            # all else.. apply a qlimit
-                            cmd += " limit " +str(limit)
-                                                
-                            # append a ping if we requested (allows us to mark the change within a tshark)
-                            if ping_ip:
-                                cmd += "; ping -c 1 " +ping_ip
-                        else:
-                            # standard qlimit
-                            cmd = "tc class change dev "  + eth + " parent 10: classid 0:1 htb rate " + bandwidth + " ceil " + bandwidth
-                            self.netem_shell.run(cmd+ "; tc qdisc change dev "  + eth + " parent 10:1 handle 11: netem delay " + delay + " " + jitter + " loss " + loss)
-                    else:
-                        # non-root user.. use the scripts on the target machine (note: DRM add distribution if deemed necessary - future)
-                        cmd = "./netem_change.sh " +str(eth)+ " htb " +str(bandwidth)+ " " +str(delay)+ " " +str(limit)+ " " +str(ping_ip)
-
-                    # execute update
-                    self.netem_shell.run(cmd)
-
-                else:
-                    # create a new tc qdisc and instantiate a new netem instance
-                    if self.user == "root":
-                        # this is a root user request.. set it all up as one command line for efficiency
-                        cmd = "tc qdisc add dev "  + eth + " root handle 1: prio bands 10; tc qdisc add dev "  + eth + " parent 1:1 handle 10: htb default 1; tc class add dev "  + eth + " parent 10: classid 0:1 htb rate " + bandwidth + " ceil " + bandwidth
-
-                        # if we have a dynamic queue length then use it (note: DRM think about a method for this might be cleaner)
-                        if dynQlim:
-                            cmd += "; tc qdisc add dev "  + eth + " parent 10:1 handle 11: netem"             
-                            if int(profile['delay']) > 0:
-                                # see if we are implimwenting a distirbution
-                                if rttdist == "":
-                                    # no.. use delay as is
-                                    cmd += " delay " +delay
-                                else:
-                                    # this is a distribution table file request apply dvary and dist
-                                    cmd += " delay " +delay+ " " +dvary+ " distribution " +rttdist
-                            if reorder != "":
-                                # apply reorder
-                                cmd += " reorder " +reorder
-                            if int(profile['jitter']) > 0:
-                                # apply jitter
-                                cmd += " " + jitter
-                            if float(profile['loss']) > 0.0:
-                                # apply loss
-                                cmd += " loss " +loss
-                            # all else apply qlimit
-                            cmd += " limit " +str(limit)
-                                
-                        else:
-                            # standard qlimit
-                            cmd += "; tc qdisc add dev "  +eth+ " parent 10:1 handle 11: netem delay " +delay+ " " +jitter+ " loss " +loss
-
-                        # fimish with a generic filter
-                            cmd += "; tc filter add dev " + eth + " protocol ip parent 1:0  prio 1 u32 match ip src 0.0.0.0/0 match ip dst 0.0.0.0/0 flowid 10:1"
-                        
-                        # add ping if requested (allows us to mark the change within a tshark)
-                        if ping_ip:
-                            cmd += "; ping -c 1 " +ping_ip
-
-                    else:
-                        # non-root user.. use the scripts on the target machine (note: DRM add distribution if deemed necessary - future)
-                        cmd = "./netem_create.sh " +str(eth)+ " htb " +str(bandwidth)+ " " +str(delay)+ " " +str(limit)+ " " +str(ping_ip)
-
-                    # execute create
-                    self.netem_shell.run(cmd)
-
-                    # Verify the settings took. (NOT_TO_SELF:  work on this later when hardware is in place)
-#                    if netem.verify(self, eth, profile['bandwidth'], profile['delay'], profile['loss'], profile['jitter']):
-#                        log("NETEM CONFIGURE FAILURE")
-#                        assert(False)
-
-            elif self.method == "1":
-                # earlier than 3.8 kerenls (this is really defunct but as a safety we'll keep it)
-                log('DEBUG', "Setting netem method 1 (< 3.8 kernel)")
-                self.netem_shell.run("tc qdisc add dev " + eth + " root handle 1: netem delay " + delay + " " + jitter + " loss " + loss + " limit " +str(limit))
-                self.netem_shell.run("tc qdisc add dev " + eth + " parent 1:1 handle 10: htb default 1 r2q 10")
-                self.netem_shell.run("tc class add dev " + eth + " parent 10: classid 0:1 htb rate " + bandwidth + " ceil " + bandwidth)
+        if len(lines) == 0 and not ping_ip:
+            log('DEBUG', 'Netem profile "' + name + '" is already applied')
+            return(profile)
 
-            else:
-                msg = 'Metem method: "' + self.method + '" invalid.  Please specify "1" or "2"'
-                msg = "\nERROR: " + self.__class__.__name__ + "(" + name + ") " + msg + "\n"
-                log(msg)
-                sys.exit(msg)
+        # Best to clear the netem first if not just doing an update.  
+        # tc qdisc add sometimes errors with RTNETLINK answers: File exists
+        self.applied = {}
+        output = self.apply_tc(lines, not incremental and not update_only and dynQlim == 0, ping_ip)
+        if self.method == "2":
+            self.applied = tree
 
         # Display the settings
-        output = self.netem_shell.run("tc qdisc")
         log('DEBUG', output)
 
         # Return the profile as a dictionary
@@ -398,103 +259,371 @@ class netem:
 
     #########################################################################
     #
-    # METHOD: verify(<interface>, <curr_bw>, <curr_delay>, <curr_loss>, <curr_jitter>)
+    # METHOD: interfaces()
     #
-    # DESRCRIPTION: Verify the netem settings currently configured using the values from the last set
-    #                  <interface> - interface for verification
-    #                  badnwidth - current bandwidth
-    #                  delay     - current delay
-    #                  loss      - current loss 
-    #                  jitter    - current jitter
-    #                  dvary     - current dvary if distribution
-    #                  dist      - distribution name if supplied
+    # DESCRIPTION: The names of the netem interfaces listed in the testbed config
     #
-    #               returns 1 if any items is a fail 0 if success al items correct
+    #########################################################################
+    def interfaces(self):
+        """interfaces():
+              The names of the netem interfaces listed in the testbed config
+              """
+
+        return [element.find("name").text for element in self.testbed.find("netem_server").findall("interface")]
+
+    #########################################################################
+    #
+    # METHOD: tc_lines(eth, compiled, update_only)
+    #
+    # DESCRIPTION: The tc batch lines (tc commands without the "tc") which apply a compiled_profile (see
+    #              control/profiles.py) to one interface. With update_only the existing tree is changed in place.
     #
-    # NOT_TO_SELF: Rework this when hardare is in place.
-    # 
     #########################################################################
-    def verify(self, eth, bandwidth=0, delay=0, loss=0, jitter=0, dvary=0, dist=""):
-        """verify(<interface>, <curr_bw>, <curr_delay>, <curr_loss>, <curr_jitter>)
-              Verify the netem settings currently configured using the values from the last set
-                 <interface> - interface for verification
-                 badnwidth - current bandwidth
-                 delay     - current delay
-                 loss      - current loss
-                 jitter    - current jitter
-                 dvary     - current dvary if distribution
-                 dist      - distribution name if supploied
-               returns 1 if any items is a fail 0 if success al items correct
-               """
-
-        log("ARGS : " +eth+ " " +str(bandwidth)+ " " +str(delay)+ " " +str(loss)+ " " +str(jitter))
-        
-        # query the current netem settings
-        netem_settings = self.netem_shell.run("tc qdisc show dev " +eth)
-        netem_settings.strip()
-        
-        lines = netem_settings.split("\n")
+    def tc_lines(self, eth, compiled, update_only=0):
+        """tc_lines(eth, compiled, update_only):
+              The tc batch lines (tc commands without the "tc") which apply a compiled_profile (see
+              control/profiles.py) to one interface. With update_only the existing tree is changed in place.
+              """
 
-        log("NETEM SETTINGS " +str(lines))
+        bandwidth = compiled.bandwidth
+
+        # Here we set up netem according to the kernel as it varies between: >= 3.8 vs < 3.8
+        if self.method == "1":
+            # earlier than 3.8 kerenls (this is really defunct but as a safety we'll keep it)
+            log('DEBUG', "Setting netem method 1 (< 3.8 kernel)")
+            return ["qdisc add dev " + eth + " root handle 1: netem delay " + compiled.delay + " " + compiled.jitter + " loss " + compiled.loss + " limit " + str(compiled.limit),
+                    "qdisc add dev " + eth + " parent 1:1 handle 10: htb default 1 r2q 10",
+                    "class add dev " + eth + " parent 10: classid 0:1 htb rate " + bandwidth + " ceil " + bandwidth]
+
+        log('DEBUG', "Setting netem method 2 3.8 kernel or >")
+        if update_only:
+            # just make the update on the same netem instance(s)
+            return ["class change dev " + eth + " parent 10: classid 0:1 htb rate " + bandwidth + " ceil " + bandwidth,
+                    "qdisc change dev " + eth + " parent 10:1 handle 11: netem " + compiled.netem]
+
+        # create a new tc qdisc and instantiate a new netem instance, the filter steers all ip traffic to it
+        return ["qdisc add dev " + eth + " root handle 1: prio bands 10",
+                "qdisc add dev " + eth + " parent 1:1 handle 10: htb default 1",
+                "class add dev " + eth + " parent 10: classid 0:1 htb rate " + bandwidth + " ceil " + bandwidth,
+                "qdisc add dev " + eth + " parent 10:1 handle 11: netem " + compiled.netem,
+                "filter add dev " + eth + " protocol ip parent 1:0 prio 1 u32 match ip src 0.0.0.0/0 match ip dst 0.0.0.0/0 flowid 10:1"]
 
-        # for tracking
-        idx = 0
-        for i in lines:
-            log("LINE" +idx+ ": " +i)
-            idx += 1
+    #########################################################################
+    #
+    # METHOD: tc_changes(eth, current, desired)
+    #
+    # DESCRIPTION: The tc batch lines which take the tree set() built on an interface from its current
+    #              {'rate', 'netem'} to the desired one. Only what differs is changed (in place, the queues
+    #              are kept) and nothing at all if they are the same.
+    #
+    #########################################################################
+    def tc_changes(self, eth, current, desired):
+        """tc_changes(eth, current, desired):
+              The tc batch lines which take the tree set() built on an interface from its current
+              {'rate', 'netem'} to the desired one. Only what differs is changed (in place, the queues
+              are kept) and nothing at all if they are the same.
+              """
 
-        # lets process the current vs expected
-        for idx in range(0, len(lines)):
-            
-            fail = 0
-            test = re.match(r'qdisc netem', lines[idx])
-            if test:
-                log("HAVE THE RIGHT NETEM LINE")
-                if int(bandwidth) > 0:
-                    log("BANDWIDTH PRESENT > 0")
-                    test = re.match(r'qdisc netem \d+: parent 10:1 limit (\d+) .*', lines[idx])
-                    if test.group(1) == bandwidth:
-                        log("BANDWIDTH CORRECT")
-                        if  int(delay) > 0:
-                            log("DELAY PRESENT")
-                            test = re.match(r'qdisc netem \d+: parent 10:1 limit \d+ delay (\d+\.?\d*).*', lines[idx])
-                            if test.group(1) == delay:
-                                log("BANDWIDTH CORRECT")
-                                if int(jitter) > 0:
-                                    log("JITTER PRESENT")
-                                    test = re.match(r'qdisc netem \d+: parent 10:1 limit \d+ delay \d+\.?\d*\w+ (\d+\.?\d*).*', lines[idx])
-                                    if test.group(1) == jitter:
-                                        log("JITTER CORRECT")
-                                        if int(loss) > 0:
-                                            log("LOSS PRESENT")
-                                            test = re.match(r'qdisc netem \d+: parent 10:1 limit \d+ delay \d+\.?\d*\w+ \d+\.?\d*\w+ loss (\d+\.?\d*).*', lines[idx])
-                                            if test.group(1) != loss:
-                                                log("LOSS FAILED - " +loss+ " != " +test.group(1))
-                                                fail = 1
-                                    else:
-                                        log("JITTER FAILED - " +jitter+ " != " +test.group(1))
-                                        fail = 1
-                                elif int(loss) > 0:
-                                    log("LOSS PRESENT")
-                                    test = re.match(r'qdisc netem \d+: parent 10:1 limit \d+ delay \d+\.?\d*\w+ \d+\.?\d*\w+ loss (\d+\.?\d*).*', lines[idx])
-                                    if test.group(1) != loss:
-                                        log("LOSS FAILED - " +loss+ " != " +test.group(1))
-                                        fail = 1
-                            else:
-                                log("DELAY FAILED - " +delay+ " != " +test.group(1))
-                                fail =1
-                    else:
-                        log("BANDWIDTH FAILED - " +str(bandwidth)+ " != " +test.group(1))
-                        fail = 1
-                else:
-                    log("NO BANDWIDTH ERROR")
-                    fail = 1
-            else:
-                continue
+        lines = []
+        if current['rate'] != desired['rate']:
+            lines.append("class change dev " + eth + " parent 10: classid 0:1 htb rate " + desired['rate'] + " ceil " + desired['rate'])
+        if current['netem'] != desired['netem']:
+            lines.append("qdisc change dev " + eth + " parent 10:1 handle 11: netem " + desired['netem'])
+        return lines
+
+    #########################################################################
+    #
+    # METHOD: apply_tc(lines, clear, ping_ip)
+    #
+    # DESCRIPTION: Apply tc batch lines on the netem system in one remote invocation: optionally clear the
+    #              qdiscs of every interface first, run the lines through "tc -force -batch", list the
+    #              resulting qdiscs and ping ping_ip (marks the change in a capture). Lines which failed
+    #              end the script with their line number, command and error. Returns the qdisc listing.
+    #
+    #########################################################################
+    def apply_tc(self, lines, clear=1, ping_ip=0):
+        """apply_tc(lines, clear, ping_ip):
+              Apply tc batch lines on the netem system in one remote invocation: optionally clear the
+              qdiscs of every interface first, run the lines through "tc -force -batch", list the
+              resulting qdiscs and ping ping_ip (marks the change in a capture). Lines which failed
+              end the script with their line number, command and error. Returns the qdisc listing.
+              """
+
+        tc = "tc" if self.user == "root" else "sudo tc"
+
+        batch = self.netem_shell.batch()
+        if clear:
+            # there may be no qdisc to delete, that is fine
+            batch.add("for eth in $(tc qdisc | grep qdisc | cut -f 5 -d \" \" | sort -u); do " + tc + " qdisc del dev $eth root 2>/dev/null; done; true", 0)
+        # Several interfaces are switched at the same time (one tc each) unless NETEM_PARALLEL is 0
+        groups = self.group_lines(lines)
+        parallel = getOpt('NETEM_PARALLEL') and len(groups) > 1
+
+        apply = len(batch)
+        if parallel:
+            batch.add(self.parallel_tc(groups, tc), 0)
+        elif len(lines):
+            batch.add("tc -force -batch - <<'PATI_TC'\n" + "\n".join(lines) + "\nPATI_TC", 0)
+        listing = len(batch)
+        batch.add("tc qdisc", 0)
+        if ping_ip:
+            batch.add("ping -c 1 " + str(ping_ip), 0)
+        results = batch.run()
+
+        if parallel:
+            errors = self.parallel_results(groups, results[apply]['stdout'])
+        else:
+            errors = self.tc_errors(lines, results[apply]['stderr']) if len(lines) else []
+        if len(errors):
+            msg = "tc batch failed on " + self.control_ip + ": " + "; ".join("line " + str(n) + " [" + line + "] " + error for n, line, error in errors)
+            msg = "\nERROR: " + self.__class__.__name__ + "() " + msg + "\n"
+            log(msg)
+            sys.exit(msg)
+
+        return results[listing]['stdout']
+
+    #########################################################################
+    #
+    # METHOD: group_lines(lines)
+    #
+    # DESCRIPTION: Split tc batch lines up by the interface ("dev <eth>") they apply to. Returns a list of
+    #              [eth, lines] in the order the interfaces first appear.
+    #
+    #########################################################################
+    def group_lines(self, lines):
+        """group_lines(lines):
+              Split tc batch lines up by the interface ("dev <eth>") they apply to. Returns a list of
+              [eth, lines] in the order the interfaces first appear.
+              """
 
-        if fail:
+        groups = []
+        index = {}
+        for line in lines:
+            dev = re.search(r'\bdev (\S+)', line)
+            eth = dev.group(1) if dev else ""
+            if eth not in index:
+                index[eth] = len(groups)
+                groups.append([eth, []])
+            groups[index[eth]][1].append(line)
+        return groups
+
+    #########################################################################
+    #
+    # METHOD: parallel_tc(groups, tc)
+    #
+    # DESCRIPTION: The shell script which applies the lines of each interface with its own tc, all started
+    #              together once every interface's lines are in place (the barrier). Each interface reports
+    #              "@@PATI_IF <eth> <rc> <start ns> <end ns>" followed by the errors of its tc.
+    #
+    #########################################################################
+    def parallel_tc(self, groups, tc):
+        """parallel_tc(groups, tc):
+              The shell script which applies the lines of each interface with its own tc, all started
+              together once every interface's lines are in place (the barrier). Each interface reports
+              "@@PATI_IF <eth> <rc> <start ns> <end ns>" followed by the errors of its tc.
+              """
+
+        script = ['cd "$(mktemp -d)" || exit 1']
+        for idx, (eth, lines) in enumerate(groups):
+            script.append("cat > " + str(idx) + ".tc <<'PATI_TC'\n" + "\n".join(lines) + "\nPATI_TC")
+        for idx, (eth, lines) in enumerate(groups):
+            n = str(idx)
+            script.append("( s=$(date +%s%N); " + tc + " -force -batch " + n + ".tc 2> " + n + ".err; echo $? $s $(date +%s%N) > " + n + ".done ) &")
+        script.append("wait")
+        for idx, (eth, lines) in enumerate(groups):
+            n = str(idx)
+            script.append("echo \"@@PATI_IF " + eth + " $(cat " + n + ".done)\"; cat " + n + ".err")
+        script.append('d=$(pwd); cd /; rm -rf "$d"')
+        return "\n".join(script)
+
+    #########################################################################
+    #
+    # METHOD: parallel_results(groups, output)
+    #
+    # DESCRIPTION: Pick the per interface results out of the output of parallel_tc(). The times each
+    #              interface started and finished switching are kept in self.skew {'start', 'done',
+    #              'interfaces' : {eth : [start, done]}} (seconds, start/done are the spread across the
+    #              interfaces) and logged. Returns the failed lines like tc_errors().
+    #
+    #########################################################################
+    def parallel_results(self, groups, output):
+        """parallel_results(groups, output):
+              Pick the per interface results out of the output of parallel_tc(). The times each
+              interface started and finished switching are kept in self.skew {'start', 'done',
+              'interfaces' : {eth : [start, done]}} (seconds, start/done are the spread across the
+              interfaces) and logged. Returns the failed lines like tc_errors().
+              """
+
+        lines = dict((eth, eth_lines) for eth, eth_lines in groups)
+        sections = re.split(r'^@@PATI_IF (\S+) ?(.*)$', output, flags=re.MULTILINE)
+
+        errors = []
+        times = {}
+        for idx in range(1, len(sections) - 1, 3):
+            eth, report, stderr = sections[idx], sections[idx + 1].split(), sections[idx + 2]
+            errors += self.tc_errors(lines.get(eth, []), stderr)
+            if len(report) == 3 and report[1].isdigit() and report[2].isdigit():
+                times[eth] = [int(report[1]) / 1e9, int(report[2]) / 1e9]
+        for eth in lines:
+            if eth not in times:
+                errors.append([0, "", "no result from tc for " + eth])
+
+        if len(times):
+            starts = [start for start, done in times.values()]
+            dones = [done for start, done in times.values()]
+            self.skew = {'start' : max(starts) - min(starts), 'done' : max(dones) - min(dones), 'interfaces' : times}
+            log('DEBUG', "Netem switched " + str(len(times)) + " interfaces, start skew %.1fms, done skew %.1fms" %
+                (self.skew['start'] * 1000, self.skew['done'] * 1000))
+        return errors
+
+    #########################################################################
+    #
+    # METHOD: tc_errors(lines, stderr)
+    #
+    # DESCRIPTION: Pick the failed lines out of the stderr of "tc -batch". tc prints the error of a line
+    #              followed by "Command failed -:<line number>". Returns a list of [line number, line, error]
+    #              (line number 0 for errors which belong to no line, like tc itself not running).
+    #
+    #########################################################################
+    def tc_errors(self, lines, stderr):
+        """tc_errors(lines, stderr):
+              Pick the failed lines out of the stderr of "tc -batch". tc prints the error of a line
+              followed by "Command failed -:<line number>". Returns a list of [line number, line, error]
+              (line number 0 for errors which belong to no line, like tc itself not running).
+              """
+
+        errors = []
+        pending = []
+        for text in stderr.splitlines():
+            failed = re.match(r'Command failed \S*:(\d+)', text.strip())
+            if failed:
+                n = int(failed.group(1))
+                errors.append([n, lines[n - 1] if 0 < n <= len(lines) else "", " ".join(pending)])
+                pending = []
+            elif text.strip():
+                pending.append(text.strip())
+        if len(pending):
+            errors.append([0, "", " ".join(pending)])
+        return errors
+
+    #########################################################################
+    #
+    # METHOD: state()
+    #
+    # DESCRIPTION: Read the qdiscs and classes of the configured interfaces (with statistics) in one call.
+    #              Returns {eth : interface_state}, see control/netem_state.py.
+    #
+    #########################################################################
+    def state(self):
+        """state():
+              Read the qdiscs and classes of the configured interfaces (with statistics) in one call.
+              Returns {eth : interface_state}, see control/netem_state.py.
+              """
+
+        return read_state(self.netem_shell, self.interfaces())
+
+    #########################################################################
+    #
+    # METHOD: start_stats(interval, handle)
+    #
+    # DESCRIPTION: Start sampling the qdisc statistics (bytes, packets, drops, overlimits, backlog ...) of
+    #              the configured interfaces every interval seconds (default NETEM_STATS_INTERVAL) in the
+    #              background. handle picks the qdisc ("11:" is the netem one), default the root qdisc.
+    #              Returns the qdisc_sampler, see control/netem_state.py.
+    #
+    #########################################################################
+    def start_stats(self, interval=None, handle=None):
+        """start_stats(interval, handle):
+              Start sampling the qdisc statistics (bytes, packets, drops, overlimits, backlog ...) of
+              the configured interfaces every interval seconds (default NETEM_STATS_INTERVAL) in the
+              background. handle picks the qdisc ("11:" is the netem one), default the root qdisc.
+              Returns the qdisc_sampler, see control/netem_state.py.
+              """
+
+        self.stop_stats()
+        if interval is None:
+            interval = getOpt('NETEM_STATS_INTERVAL')
+        self.sampler = qdisc_sampler(self.netem_shell, self.interfaces(), interval, handle)
+        self.sampler.start()
+        return self.sampler
+
+    #########################################################################
+    #
+    # METHOD: stop_stats()
+    #
+    # DESCRIPTION: Stop the statistics sampler. Returns {eth : time_series} of the samples taken (empty if
+    #              it was not running), the sampler stays in self.sampler for export().
+    #
+    #########################################################################
+    def stop_stats(self):
+        """stop_stats():
+              Stop the statistics sampler. Returns {eth : time_series} of the samples taken (empty if
+              it was not running), the sampler stays in self.sampler for export().
+              """
+
+        if self.sampler is None:
+            return {}
+        return self.sampler.stop()
+
+    #########################################################################
+    #
+    # METHOD: verify(profile, limit, dynQlim)
+    #
+    # DESRCRIPTION: Verify the netem settings currently configured on every interface against a profile
+    #               (the dictionary returned by set()) in one pass:
+    #                  profile - {'delay', 'jitter', 'loss', 'bandwidth'} and optionally 'dvary'
+    #                  limit   - the netem queue limit expected, 0 to not check it
+    #                  dynQlim - the dynQlim the profile was set() with (rttdist/dvary only apply with it)
+    #
+    #               returns the list of mismatches [eth, field, expected, actual], an empty list (false)
+    #               if everything is as requested
+    #
+    #########################################################################
+    def verify(self, profile, limit=0, dynQlim=0):
+        """verify(profile, limit, dynQlim):
+              Verify the netem settings currently configured on every interface against a profile
+              (the dictionary returned by set()) in one pass:
+                 profile - {'delay', 'jitter', 'loss', 'bandwidth'} and optionally 'dvary'
+                 limit   - the netem queue limit expected, 0 to not check it
+                 dynQlim - the dynQlim the profile was set() with (rttdist/dvary only apply with it)
+              returns the list of mismatches [eth, field, expected, actual], an empty list (false)
+              if everything is as requested
+              """
+
+        # The tree set() builds: the delay is applied in each direction so tc has half of the profile
+        expected = {'delay_ms'  : float(profile['delay']) / 2,
+                    'jitter_ms' : float(profile.get('dvary', profile['jitter']) if dynQlim and profile.get('rttdist') else profile['jitter']) / 2,
+                    'loss_pct'  : float(profile['loss']),
+                    'rate_kbit' : float(profile['bandwidth'])}
+        if limit:
+            expected['limit'] = limit
+
+        mismatches = []
+        state = self.state()
+        for eth in self.interfaces():
+            interface = state.get(eth)
+            netem = interface.qdisc(kind="netem") if interface else None
+            htb = interface.tclass("10:1") if interface else None
+            if netem is None:
+                mismatches.append([eth, "netem", "qdisc", None])
+                continue
+            if self.method == "2" and htb is None:
+                mismatches.append([eth, "htb", "class 10:1", None])
+
+            actual = {'delay_ms' : netem.delay_ms, 'jitter_ms' : netem.jitter_ms, 'loss_pct' : netem.loss_pct,
+                      'limit' : netem.limit, 'rate_kbit' : htb.rate_kbit if htb else None}
+            for field in expected:
+                if actual[field] is None:
+                    continue
+                # tc stores times in ticks and rates in bytes, allow for the rounding
+                if abs(actual[field] - expected[field]) > max(0.01, abs(expected[field]) * 0.01):
+                    mismatches.append([eth, field, expected[field], actual[field]])
+
+        for eth, field, want, got in mismatches:
+            log("NETEM " + eth + " " + field + " FAILED - expected " + str(want) + " got " + str(got))
+        if len(mismatches):
             log("NETEM DID MOT CONFIGURE AS REQUESTED")
         else:
             log("NETEM RECONFIGURED")
-            
-        return(fail)
+
+        return(mismatches)
@@ -0,0 +1,388 @@
+#!/usr/bin/python3
+
+#
+# Copyright 2016, Dan Malone, All Rights Reserved
+#
+from util.globals import *
+
+import re
+import json
+import threading
+from .series import time_series
+
+###################################################################################################
+#
+# MODULE (Class): tc_qdisc
+#
+# DESCRIPTION   : One qdisc as reported by "tc -j -s qdisc show". The common fields and statistics are
+#                 attributes, the kind specific options stay in options. For a netem qdisc delay_ms,
+#                 jitter_ms, loss_pct and limit give the impairment in the units the profiles use.
+#
+##################################################################################################
+class tc_qdisc:
+    """One qdisc of an interface"""
+
+    def __init__(self, entry):
+        """__init__(entry):
+              This is the initialization constructor, entry is one object of the tc json output
+              """
+
+        self.kind       = entry.get('kind', "")
+        self.handle     = entry.get('handle', "")
+        self.parent     = "root" if entry.get('root') else entry.get('parent', "")
+        self.dev        = entry.get('dev', "")
+        self.options    = entry.get('options', {})
+        self.bytes      = entry.get('bytes', 0)
+        self.packets    = entry.get('packets', 0)
+        self.drops      = entry.get('drops', 0)
+        self.overlimits = entry.get('overlimits', 0)
+        self.requeues   = entry.get('requeues', 0)
+        self.backlog    = entry.get('backlog', 0)
+        self.qlen       = entry.get('qlen', 0)
+
+        # netem: times are reported in seconds, loss as a fraction
+        delay = self.options.get('delay', {})
+        if not isinstance(delay, dict):
+            delay = {'delay' : delay}
+        self.delay_ms  = float(delay.get('delay', 0)) * 1000
+        self.jitter_ms = float(delay.get('jitter', 0)) * 1000
+        loss = self.options.get('loss-random', self.options)
+        self.loss_pct  = float(loss.get('loss', 0)) * 100
+        self.limit     = self.options.get('limit', 0)
+
+    def __repr__(self):
+        return "tc_qdisc(" + self.kind + " " + self.handle + " parent " + self.parent + " dev " + self.dev + ")"
+
+###################################################################################################
+#
+# MODULE (Class): tc_class
+#
+# DESCRIPTION   : One class as reported by "tc -s class show" (see parse_class_show()). rate_kbit and
+#                 ceil_kbit are in tc kbit (1000 bits) per second like the profile bandwidth.
+#
+##################################################################################################
+class tc_class:
+    """One class of an interface"""
+
+    def __init__(self, entry, dev=""):
+        """__init__(entry, dev):
+              This is the initialization constructor, entry is one object of parse_class_show()
+              """
+
+        self.kind      = entry.get('class', "")
+        self.handle    = entry.get('handle', "")
+        self.parent    = "root" if entry.get('root') else entry.get('parent', "")
+        self.leaf      = entry.get('leaf', "")
+        self.dev       = dev
+
+        # rates are reported in bytes per second
+        self.rate_kbit = float(entry.get('rate', 0)) * 8 / 1000
+        self.ceil_kbit = float(entry.get('ceil', 0)) * 8 / 1000
+
+        stats = entry.get('stats', entry)
+        self.bytes     = stats.get('bytes', 0)
+        self.packets   = stats.get('packets', 0)
+        self.drops     = stats.get('drops', 0)
+        self.backlog   = stats.get('backlog', 0)
+        self.qlen      = stats.get('qlen', 0)
+
+    def __repr__(self):
+        return "tc_class(" + self.kind + " " + self.handle + " parent " + self.parent + " dev " + self.dev + ")"
+
+###################################################################################################
+#
+# MODULE (Class): interface_state
+#
+# DESCRIPTION   : The qdiscs and classes of one interface
+#
+##################################################################################################
+class interface_state:
+    """The qdiscs and classes of one interface"""
+
+    def __init__(self, dev):
+        self.dev     = dev
+        self.qdiscs  = []
+        self.classes = []
+
+    def qdisc(self, handle=None, kind=None):
+        """qdisc(handle, kind):
+              Returns the first qdisc with the handle (like "11:") and/or kind (like "netem"), or None
+              """
+        for qdisc in self.qdiscs:
+            if (handle is None or qdisc.handle == handle) and (kind is None or qdisc.kind == kind):
+                return qdisc
+        return None
+
+    def tclass(self, handle):
+        """tclass(handle):
+              Returns the class with the handle (like "10:1"), or None
+              """
+        for tclass in self.classes:
+            if tclass.handle == handle:
+                return tclass
+        return None
+
+    def __repr__(self):
+        return "interface_state(" + self.dev + " " + str(self.qdiscs) + " " + str(self.classes) + ")"
+
+# tc rate and size suffixes: rates are in bits (1000 based, 1024 for the -iec "Kibit" forms), sizes in bytes
+# (1024 based)
+RATE_UNITS = {'' : 1, 'K' : 1e3, 'M' : 1e6, 'G' : 1e9, 'T' : 1e12,
+              'Ki' : 1024.0, 'Mi' : 1024.0 ** 2, 'Gi' : 1024.0 ** 3, 'Ti' : 1024.0 ** 4}
+SIZE_UNITS = {'' : 1, 'K' : 1024, 'M' : 1024 ** 2, 'G' : 1024 ** 3}
+
+##############################################################################################
+#
+# METHOD: parse_class_show(output)
+#
+# DESCRIPTION: Returns the classes of the text output of "tc -s class show dev <eth>" as entries shaped
+#              like the objects of the tc json output (iproute2 ignores -j for classes), rates in bytes
+#              per second:
+#                 {'class', 'handle', 'parent' or 'root', 'leaf', 'rate', 'ceil',
+#                  'stats' : {'bytes', 'packets', 'drops', 'overlimits', 'requeues', 'backlog', 'qlen'}}
+#
+##############################################################################################
+def parse_class_show(output):
+    """parse_class_show(output):
+          Returns the classes of the text output of "tc -s class show dev <eth>" as entries shaped
+          like the objects of the tc json output (iproute2 ignores -j for classes), rates in bytes
+          per second:
+             {'class', 'handle', 'parent' or 'root', 'leaf', 'rate', 'ceil',
+              'stats' : {'bytes', 'packets', 'drops', 'overlimits', 'requeues', 'backlog', 'qlen'}}
+          """
+
+    entries = []
+    for line in output.splitlines():
+        words = line.split()
+        if len(words) >= 3 and words[0] == "class":
+            # class htb 10:1 root leaf 11: prio 0 rate 2Mbit ceil 2500Kbit burst 1600b cburst 1600b
+            entry = {'class' : words[1], 'handle' : words[2], 'stats' : {}}
+            for key, value in zip(words[3:], words[4:] + [""]):
+                if key in ('parent', 'leaf'):
+                    entry[key] = value
+                elif key in ('rate', 'ceil'):
+                    match = re.match(r"([\d.]+)([KMGT]?i?)bit$", value)
+                    if match:
+                        entry[key] = float(match.group(1)) * RATE_UNITS[match.group(2)] / 8
+                elif key == "root":
+                    entry['root'] = True
+            entries.append(entry)
+            continue
+        if len(entries) == 0:
+            continue
+
+        # Sent 90 bytes 1 pkt (dropped 0, overlimits 0 requeues 0)
+        # backlog 0b 0p requeues 0
+        stats = entries[-1]['stats']
+        match = re.match(r"\s*Sent (\d+) bytes (\d+) pkts? \(dropped (\d+), overlimits (\d+) requeues (\d+)\)", line)
+        if match:
+            for key, value in zip(['bytes', 'packets', 'drops', 'overlimits', 'requeues'], match.groups()):
+                stats[key] = int(value)
+        match = re.match(r"\s*backlog ([\d.]+)([KMG]?)b (\d+)p", line)
+        if match:
+            stats['backlog'] = int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+            stats['qlen'] = int(match.group(3))
+    return entries
+
+##############################################################################################
+#
+# METHOD: read_state(host_shell, eths)
+#
+# DESCRIPTION: Read the qdiscs (all interfaces) and the classes of eths, with statistics, in one remote
+#              call. Returns {dev : interface_state}. Interfaces tc could not be read for are missing
+#              (an old tc without -j support for qdiscs gives an empty dictionary, logged).
+#
+##############################################################################################
+def read_state(host_shell, eths=None):
+    """read_state(host_shell, eths):
+          Read the qdiscs (all interfaces) and the classes of eths, with statistics, in one remote
+          call. Returns {dev : interface_state}. Interfaces tc could not be read for are missing
+          (an old tc without -j support for qdiscs gives an empty dictionary, logged).
+          """
+
+    eths = eths or []
+    batch = host_shell.batch()
+    batch.add("tc -j -s qdisc show", 0)
+    for eth in eths:
+        batch.add("tc -s class show dev " + eth, 0)
+    results = batch.run()
+
+    state = {}
+    try:
+        for entry in json.loads(results[0]['stdout'] or "[]"):
+            qdisc = tc_qdisc(entry)
+            state.setdefault(qdisc.dev, interface_state(qdisc.dev)).qdiscs.append(qdisc)
+    except ValueError:
+        log("ERROR", "tc on " + host_shell.ip + " did not give json: " + (results[0]['stderr'] or results[0]['stdout'])[:200])
+        return {}
+
+    for eth, result in zip(eths, results[1:]):
+        if result['rc'] != 0:
+            log("ERROR", "tc class show dev " + eth + " on " + host_shell.ip + " failed: " + result['stderr'])
+            continue
+        entries = parse_class_show(result['stdout'])
+        interface = state.setdefault(eth, interface_state(eth))
+        interface.classes = [tc_class(entry, eth) for entry in entries]
+
+    return state
+
+###################################################################################################
+#
+# MODULE (Class): qdisc_sampler
+#
+# DESCRIPTION   : This class samples the qdisc statistics of interfaces in the background. One loop is
+#                 launched on the system (one ssh channel for the whole run) which prints a time stamp and
+#                 "tc -j -s qdisc show" every interval, a reader thread turns that into one time_series
+#                 per interface of: bytes, packets, drops, overlimits, requeues, backlog and qlen.
+#
+#                 By default the root qdisc of each interface is sampled (it accounts for the whole
+#                 tree), handle picks another one like "11:" for the netem qdisc itself.
+#
+# Usage:
+#
+# sampler = qdisc_sampler(netem_shell, ["eth1", "eth2"], 0.5)
+# sampler.start()
+# ... run transfers ...
+# sampler.stop()
+# files = sampler.export("/tmp/plots/", ["backlog", "drops"])    -> ["eth1_backlog.txt", ...]
+#
+##################################################################################################
+class qdisc_sampler:
+    """Samples the qdisc statistics of interfaces in the background"""
+
+    # The statistics kept for every sample
+    FIELDS = ['bytes', 'packets', 'drops', 'overlimits', 'requeues', 'backlog', 'qlen']
+
+    # Marks the start of a sample in the output of the remote loop
+    MARK = "@@PATI_SAMPLE"
+
+    def __init__(self, host_shell, eths, interval=0.5, handle=None):
+        """__init__(host_shell, eths, interval, handle):
+              This is the initialization constructor:
+                 host_shell - the shell of the system with the interfaces
+                 eths       - the interfaces to sample
+                 interval   - seconds between samples
+                 handle     - the qdisc to sample (like "11:"), None for the root qdisc
+              """
+
+        self.shell    = host_shell
+        self.eths     = list(eths)
+        self.interval = interval
+        self.handle   = handle
+        self.series   = {eth : time_series(self.FIELDS) for eth in self.eths}
+        self.stream   = None
+        self.reader   = None
+        self.errors   = 0
+
+    ##############################################################################################
+    #
+    # METHOD: start()
+    #
+    # DESCRIPTION: Launch the sampling loop and the reader thread
+    #
+    ##############################################################################################
+    def start(self):
+        """start():
+              Launch the sampling loop and the reader thread
+              """
+
+        cmd = "while :; do echo \"" + self.MARK + " $(date +%s.%N)\"; tc -j -s qdisc show 2>&1; sleep " + str(self.interval) + "; done"
+        self.stream = self.shell.launch(cmd)
+        self.reader = threading.Thread(target=self.read)
+        self.reader.daemon = True
+        self.reader.start()
+
+    ##############################################################################################
+    #
+    # METHOD: read()
+    #
+    # DESCRIPTION: The reader thread, parses the samples until the loop ends
+    #
+    ##############################################################################################
+    def read(self):
+        """read():
+              The reader thread, parses the samples until the loop ends
+              """
+
+        stamp = None
+        for line in self.stream.stdout:
+            line = line.decode('utf-8', 'replace').strip()
+            if line.startswith(self.MARK):
+                try:
+                    stamp = float(line.split()[1])
+                except (IndexError, ValueError):
+                    stamp = None
+                continue
+            if stamp is None or line == "":
+                continue
+            try:
+                entries = json.loads(line)
+            except ValueError:
+                self.errors += 1
+                if self.errors == 1:
+                    log("ERROR", "qdisc sampler on " + self.shell.ip + ": " + line)
+                continue
+            self.add(stamp, entries)
+            stamp = None
+
+    ##############################################################################################
+    #
+    # METHOD: add(stamp, entries)
+    #
+    # DESCRIPTION: Add one sample (the entries of "tc -j -s qdisc show") taken at time stamp
+    #
+    ##############################################################################################
+    def add(self, stamp, entries):
+        """add(stamp, entries):
+              Add one sample (the entries of "tc -j -s qdisc show") taken at time stamp
+              """
+
+        for entry in entries:
+            qdisc = tc_qdisc(entry)
+            if qdisc.dev not in self.series:
+                continue
+            if (self.handle is None and qdisc.parent == "root") or qdisc.handle == self.handle:
+                self.series[qdisc.dev].append(stamp, qdisc.__dict__)
+
+    ##############################################################################################
+    #
+    # METHOD: stop()
+    #
+    # DESCRIPTION: Stop the sampling loop and wait for the reader. Returns {eth : time_series}.
+    #
+    ##############################################################################################
+    def stop(self):
+        """stop():
+              Stop the sampling loop and wait for the reader. Returns {eth : time_series}.
+              """
+
+        if self.stream is not None:
+            self.shell.end_groups([self.stream], 1)
+            self.reader.join()
+            self.shell.release(self.stream)
+            self.stream = None
+        return self.series
+
+    ##############################################################################################
+    #
+    # METHOD: export(path, fields, rate_fields)
+    #
+    # DESCRIPTION: Write the samples as "<time> <value>" files named <eth>_<field>.txt in the directory
+    #              path (which must end with "/", generic_tplot() prepends it to the names). Fields in
+    #              rate_fields (like bytes) are written as a rate per second. Returns the file names.
+    #
+    ##############################################################################################
+    def export(self, path, fields=['backlog', 'drops'], rate_fields=['bytes', 'packets']):
+        """export(path, fields, rate_fields):
+              Write the samples as "<time> <value>" files named <eth>_<field>.txt in the directory
+              path (which must end with "/", generic_tplot() prepends it to the names). Fields in
+              rate_fields (like bytes) are written as a rate per second. Returns the file names.
+              """
+
+        names = []
+        for eth in self.eths:
+            for field in fields:
+                name = eth + "_" + field + ".txt"
+                self.series[eth].export(path + name, field, field in rate_fields)
+                names.append(name)
+        return names
@@ -0,0 +1,291 @@
+#!/usr/bin/python3
+
+#
+# Copyright 2016, Dan Malone, All Rights Reserved
+#
+from util.globals import *
+from .shell import shell
+
+import os
+import sys
+import atexit
+import xml.etree.ElementTree as etree
+from time import sleep
+
+###################################################################################################
+#
+# MODULE (Class): nsbed
+#
+# DESCRIPTION   : This class builds the test bed on this one Linux system out of network namespaces, so
+#                 netem application, transfers and captures can be run without the lab machines:
+#
+#                    <prefix>_client           <prefix>_netem                  <prefix>_server
+#                    eth0 10.77.1.2  <-veth->  eth1 10.77.1.1  eth2 10.77.2.1  <-veth->  eth0 10.77.2.2
+#                                              (routes between eth1 and eth2)     http content on port 80
+#
+#                 The netem namespace shapes both directions (eth1 towards the client, eth2 towards the
+#                 server). The content server serves the files of CONTENT (sparse files, created once)
+#                 out of <content dir> with python's http.server.
+#
+#                 config() returns a <test_bed> element shaped like the ones of the testbed xml, with
+#                 the hosts given as "ns:<namespace>" so shell(), netem() and transfer() run their
+#                 commands inside the namespaces. TestBed.get_config() returns it when TESTBED_BACKEND
+#                 is "netns". Building the test bed needs root (or sudo) and iproute2.
+#
+# Usage:
+#
+# bed = nsbed()
+# testbed = bed.up()               (also torn down at exit)
+# netem_server = netem.netem(testbed, 1, 1)
+# bed.down()
+#
+##################################################################################################
+class nsbed:
+    """Test bed built from network namespaces on the local system"""
+
+    # Content files served by the content server {path : size in MB}
+    CONTENT = {'files/test1M' : 1, 'files/test5M' : 5, 'test100M' : 100}
+
+    # Addresses of the two links
+    CLIENT_NET = "10.77.1"
+    SERVER_NET = "10.77.2"
+
+    # Seconds to wait for the content server to answer
+    START_WAIT = 10
+
+    ##############################################################################################
+    #
+    # METHOD: __init__(prefix, content_dir)
+    #
+    # DESCRIPTION: This is the initialization constructor:
+    #                 prefix      - the namespaces are <prefix>_client, <prefix>_netem and <prefix>_server
+    #                               (default NSBED_PREFIX)
+    #                 content_dir - directory the content server serves (default /tmp/<prefix>_content)
+    #
+    ##############################################################################################
+    def __init__(self, prefix=None, content_dir=None):
+        """__init__(prefix, content_dir):
+              This is the initialization constructor:
+                 prefix      - the namespaces are <prefix>_client, <prefix>_netem and <prefix>_server
+                               (default NSBED_PREFIX)
+                 content_dir - directory the content server serves (default /tmp/<prefix>_content)
+                 """
+
+        self.prefix      = prefix or getOpt('NSBED_PREFIX')
+        self.content_dir = content_dir or "/tmp/" + self.prefix + "_content"
+        self.client      = self.prefix + "_client"
+        self.netem       = self.prefix + "_netem"
+        self.server      = self.prefix + "_server"
+        self.local_shell = shell("local")
+        self.server_shell = None
+        self.http        = None
+        self.testbed     = None
+
+    ##############################################################################################
+    #
+    # METHOD: up()
+    #
+    # DESCRIPTION: Build the namespaces, links and content server (replacing any left over from an
+    #              earlier run) and return the test bed element (see config())
+    #
+    ##############################################################################################
+    def up(self):
+        """up():
+              Build the namespaces, links and content server (replacing any left over from an
+              earlier run) and return the test bed element (see config())
+              """
+
+        trace_enter()
+        self.down()
+        log("Building the netns test bed " + self.prefix)
+
+        c, n, s = self.client, self.netem, self.server
+        cnet, snet = self.CLIENT_NET, self.SERVER_NET
+
+        # The veth ends are created under temporary names in this namespace, then moved and renamed
+        lines = []
+        for ns in [c, n, s]:
+            lines.append("ip netns add " + ns)
+            lines.append("ip -n " + ns + " link set lo up")
+        lines += self.link(c, "eth0", n, "eth1", "c")
+        lines += self.link(s, "eth0", n, "eth2", "s")
+        lines += ["ip -n " + c + " addr add " + cnet + ".2/24 dev eth0",
+                  "ip -n " + n + " addr add " + cnet + ".1/24 dev eth1",
+                  "ip -n " + n + " addr add " + snet + ".1/24 dev eth2",
+                  "ip -n " + s + " addr add " + snet + ".2/24 dev eth0",
+                  "ip -n " + c + " link set eth0 up",
+                  "ip -n " + n + " link set eth1 up",
+                  "ip -n " + n + " link set eth2 up",
+                  "ip -n " + s + " link set eth0 up",
+                  "ip -n " + c + " route add default via " + cnet + ".1",
+                  "ip -n " + s + " route add default via " + snet + ".1",
+                  "ip netns exec " + n + " sysctl -q -w net.ipv4.ip_forward=1"]
+        self.run(lines)
+
+        self.create_content()
+        self.start_content_server()
+
+        self.testbed = self.config()
+        atexit.register(self.down)
+        trace_exit()
+        return self.testbed
+
+    ##############################################################################################
+    #
+    # METHOD: link(ns_a, eth_a, ns_b, eth_b, tag)
+    #
+    # DESCRIPTION: Returns the commands for a veth pair between eth_a in ns_a and eth_b in ns_b
+    #
+    ##############################################################################################
+    def link(self, ns_a, eth_a, ns_b, eth_b, tag):
+        """link(ns_a, eth_a, ns_b, eth_b, tag):
+              Returns the commands for a veth pair between eth_a in ns_a and eth_b in ns_b
+              """
+
+        # interface names are limited to 15 characters
+        a = (self.prefix[:10] + "_" + tag + "a")[-15:]
+        b = (self.prefix[:10] + "_" + tag + "b")[-15:]
+        return ["ip link add " + a + " type veth peer name " + b,
+                "ip link set " + a + " netns " + ns_a,
+                "ip link set " + b + " netns " + ns_b,
+                "ip -n " + ns_a + " link set " + a + " name " + eth_a,
+                "ip -n " + ns_b + " link set " + b + " name " + eth_b]
+
+    ##############################################################################################
+    #
+    # METHOD: run(lines)
+    #
+    # DESCRIPTION: Run the setup commands in order on this system, the first one failing ends the script
+    #
+    ##############################################################################################
+    def run(self, lines):
+        """run(lines):
+              Run the setup commands in order on this system, the first one failing ends the script
+              """
+
+        sudo = "sudo " if os.geteuid() != 0 else ""
+        batch = self.local_shell.batch()
+        for line in lines:
+            batch.add(sudo + line, 0)
+        for result in batch.run(stop_on_error=1):
+            if result['rc'] != 0:
+                msg = "\nERROR: " + self.__class__.__name__ + "() " + result['cmd'] + "    " + result['stderr'] + "\n"
+                log(msg)
+                self.down()
+                sys.exit(msg)
+
+    ##############################################################################################
+    #
+    # METHOD: create_content()
+    #
+    # DESCRIPTION: Create the CONTENT files in the content directory (files already there are kept)
+    #
+    ##############################################################################################
+    def create_content(self):
+        """create_content():
+              Create the CONTENT files in the content directory (files already there are kept)
+              """
+
+        for path, size in sorted(self.CONTENT.items()):
+            name = os.path.join(self.content_dir, path)
+            if os.path.isfile(name) and os.path.getsize(name) == size * 1024 * 1024:
+                continue
+            os.makedirs(os.path.dirname(name), exist_ok=True)
+            with open(name, "wb") as f:
+                f.truncate(size * 1024 * 1024)
+
+    ##############################################################################################
+    #
+    # METHOD: start_content_server()
+    #
+    # DESCRIPTION: Launch the http content server in the server namespace and wait until the client
+    #              can reach it through the netem namespace
+    #
+    ##############################################################################################
+    def start_content_server(self):
+        """start_content_server():
+              Launch the http content server in the server namespace and wait until the client
+              can reach it through the netem namespace
+              """
+
+        self.server_shell = shell("ns:" + self.server)
+        self.http = self.server_shell.launch("cd " + self.content_dir + " && exec python3 -m http.server 80 --bind " +
+                                             self.SERVER_NET + ".2", no_atexit=1)
+
+        client_shell = shell("ns:" + self.client)
+        url = "http://" + self.SERVER_NET + ".2/"
+        for attempt in range(self.START_WAIT * 10):
+            if client_shell.run("curl -s -o /dev/null -w '%{http_code}' " + url, 0) == "200":
+                return
+            sleep(0.1)
+
+        msg = "\nERROR: " + self.__class__.__name__ + "() content server " + url + " did not come up\n"
+        log(msg)
+        self.down()
+        sys.exit(msg)
+
+    ##############################################################################################
+    #
+    # METHOD: down()
+    #
+    # DESCRIPTION: Stop the content server and delete the namespaces (and with them the links)
+    #
+    ##############################################################################################
+    def down(self):
+        """down():
+              Stop the content server and delete the namespaces (and with them the links)
+              """
+
+        if self.http is not None:
+            self.server_shell.stop(self.http, grace=1)
+            self.http = None
+
+        sudo = "sudo " if os.geteuid() != 0 else ""
+        existing = self.local_shell.run(sudo + "ip netns list", 0).split()
+        batch = self.local_shell.batch()
+        for ns in [self.client, self.netem, self.server]:
+            if ns in existing:
+                batch.add(sudo + "ip netns del " + ns, 0)
+        batch.run()
+        self.testbed = None
+
+    ##############################################################################################
+    #
+    # METHOD: config(testbed_id)
+    #
+    # DESCRIPTION: Returns the <test_bed> element of the namespace test bed (default id TESTBED_ID)
+    #
+    ##############################################################################################
+    def config(self, testbed_id=None):
+        """config(testbed_id):
+              Returns the <test_bed> element of the namespace test bed (default id TESTBED_ID)
+              """
+
+        testbed_id = str(testbed_id or getOpt('TESTBED_ID'))
+        testbed = etree.Element("test_bed", id=testbed_id)
+        etree.SubElement(testbed, "name").text = "netns"
+        etree.SubElement(testbed, "description").text = "Network namespace test bed " + self.prefix + " on this system"
+
+        def host(tag, ip, **extra):
+            element = etree.SubElement(testbed, tag, id="1")
+            etree.SubElement(element, "ip").text = ip
+            for key, value in extra.items():
+                etree.SubElement(element, key).text = value
+            return element
+
+        host("test_server", "ns:" + self.server)
+        host("control_server", "local")
+        host("content_server", self.SERVER_NET + ".2")
+        netem = host("netem_server", "ns:" + self.netem, method="2")
+        for idx, eth in enumerate(["eth1", "eth2"]):
+            interface = etree.SubElement(netem, "interface", id=str(idx + 1))
+            etree.SubElement(interface, "name").text = eth
+        host("test_client", "ns:" + self.client, os="linux")
+        host("control_client", "local", os="linux", path=os.getcwd() + "/")
+
+        for tag in ["username", "root_username"]:
+            user = etree.SubElement(testbed, tag, id="1")
+            etree.SubElement(user, "name").text = "root"
+        capture = etree.SubElement(testbed, "capture", id="1")
+        etree.SubElement(capture, "tcp").text = "0"
+        return testbed
@@ -5,6 +5,7 @@
 #
 from util import utilities
 from util.globals import getOpt
+from control.sudo import load_sudo_policies
 
 import re
 import shlex
@@ -121,6 +122,18 @@ class TestBed:
 
         self.testbed_id = getOpt('TESTBED_ID')
         self.testbed_xml    = getOpt('TESTBED_XML')
+        self.backend    = getOpt('TESTBED_BACKEND')
+        self.nsbed      = None
+
+        # The test bed may be built on this system instead of read from the xml file
+        if self.backend == "netns":
+            # imported here, control.nsbed needs control.shell which imports this module (through util.utilities)
+            from control.nsbed import nsbed
+            self.nsbed = nsbed()
+            print("Using netns testbed: " + self.nsbed.prefix + '  test_bed=<"' + str(self.testbed_id) + '">')
+            return
+        elif self.backend:
+            sys.exit("\nERROR: " + self.__class__.__name__ + "() unknown TESTBED_BACKEND " + str(self.backend) + "\n")
     
         # Testbed xml file may be in the home directory
         self.testbed_config_file = os.environ['HOME'] + "/" + self.testbed_xml
@@ -135,7 +148,8 @@ class TestBed:
     #
     # METHOD: get_config()
     #
-    # DESCRIPTION: This method returns the xml tree structure
+    # DESCRIPTION: This method returns the xml tree structure and applies any <sudo_policy> it declares.
+    #              With TESTBED_BACKEND=netns the namespace test bed is built (once) and its tree returned.
     #
     ##############################################################################################
     def get_config(self):
@@ -143,7 +157,13 @@ class TestBed:
               Returns the xml tree structure
               """
 
+        if self.nsbed is not None:
+            return self.nsbed.testbed if self.nsbed.testbed is not None else self.nsbed.up()
+
         tree = etree.parse(self.testbed_config_file)
         root = tree.getroot()
         testbed = root.find(".//test_bed[@id='"+ str(self.testbed_id) +"']")
+
+        # The shells wrap non-root commands in sudo as declared by the testbed
+        load_sudo_policies(testbed)
         return (testbed)
@@ -4,7 +4,7 @@
 # Copyright 2016, Dan Malone, All rights reserved
 #
 import util.utilities
-from control.shell import shell
+from control.shell import shell, run_many, get_files
 
 from util.globals import log
 
@@ -72,12 +72,12 @@ class packet_capture:
         # Shell for local processing
         self.local_shell     = shell("local")
         
-        # kill any tcpdumps still running on each system and remove any residual pcaps
+        # kill any tcpdumps still running on each system and remove any residual pcaps (all systems at once)
         if clean:
-            self.server_shell.run("sudo pkill tcpdump; rm -f *.pcap")
-            self.client_shell.run("sudo pkill tcpdump; rm -f *.pcap")
-            self.netem_shell.run("sudo pkill tcpdump; rm -f *.pcap")
-            self.content_shell.run("sudo pkill tcpdump; rm -f *.pcap")
+            run_many({self.server_shell  : "sudo pkill tcpdump; rm -f *.pcap",
+                      self.client_shell  : "sudo pkill tcpdump; rm -f *.pcap",
+                      self.netem_shell   : "sudo pkill tcpdump; rm -f *.pcap",
+                      self.content_shell : "sudo pkill tcpdump; rm -f *.pcap"})
 
         # Keep track of the pcaps we launch
         self.pcaps = []
@@ -208,16 +208,18 @@ class packet_capture:
                  packet_capture.client_lo_pcap   (the client pcap of the local       / the loopback interface)
                  packet_capture.client_eth_pcap  (the client pcap of all intf        / all interfaces)
                  """
-        # Stop each of the tcpdumps we have started and retrieve the pcap file
+        # Stop the tcpdumps we have started, all of those on a system in one go
+        shells = []
         for info in self.pcaps:
-            shell   = info[0]
-            tcpdump = info[1]
-            pcap    = info[2]
-            shell.stop(tcpdump)
+            if info[0] not in shells:
+                shells.append(info[0])
+        for shell in shells:
+            shell.stop_all([info[1] for info in self.pcaps if info[0] is shell])
                         
-            # Retrieve the pcaps
-            log("Retreiving packet capture:  " + pcap)
-            shell.get_file(pcap)
+        # Retrieve the pcaps, all hosts at once
+        for info in self.pcaps:
+            log("Retreiving packet capture:  " + info[2])
+        get_files([(info[0], info[2]) for info in self.pcaps])
             
         self.pcaps = []
 
@@ -286,8 +288,31 @@ class packet_capture:
               Blindly kill all tcpdumps on the client and server.  This is intended for the atexit 
               """
         # Clean out old tcpdumps on each system
-        self.server_shell.run("sudo pkill tcpdump")
-        self.client_shell.run("sudo pkill tcpdump")
+        run_many({self.server_shell : "sudo pkill tcpdump",
+                  self.client_shell : "sudo pkill tcpdump"})
+
+    ##############################################################################################
+    #
+    # METHOD: pcap_record(line, fields)
+    #
+    # DESCRIPTION: Translate one line of tshark -T fields output into a dictionary keyed by the
+    #              requested fields
+    #
+    ##############################################################################################
+    def pcap_record(self, line, fields):
+        """pcap_record(line, fields):
+              Translate one line of tshark -T fields output into a dictionary keyed by the
+              requested fields
+              """
+
+        #log(line)
+        values={}
+        j = 0
+        for value in line.split("\t"):
+            values[fields[j]] = value
+            j += 1
+
+        return values
 
     ##############################################################################################
     #
@@ -326,33 +351,20 @@ class packet_capture:
             for field in fields:
                 cmd = cmd + ' -e ' + field
 
-        # Python seems to have an issue capturing lots of output (in this case from tshark) so redirect to a 
-        # file then read in the file We can't use the -w <outfile> option of tshark because -w means write the 
-        # raw binary (filtered) data to the file.  We need text
-        cmd = cmd + " > __tshark.log"
-        
-        # Run tshark
-        output = self.local_shell.run(cmd, 0)
-
-        # Read in the redirected file
-        datafile = open("__tshark.log", "r")
-        content = datafile.read()
-        datafile.close
+        # tshark output can be very large so stream it (line by line as tshark produces it) rather than
+        # capturing it all at once. We can't use the -w <outfile> option of tshark because -w means write 
+        # the raw binary (filtered) data to the file.  We need text
         
-        # Translate the content into a list of dictionaries
+        # Run tshark and translate the content into a list of dictionaries. Lines are split exactly as
+        # content.split("\n") would, so output ending in a newline (or no output) still gives a last,
+        # empty record
         info = []
-        lines = content.split("\n")
-        i = 0
-        for line in lines:
-            #log(str(i) + "\t" + line)
-            line = line.split("\t")
-            values={}
-            j = 0
-            for value in line:
-                values[fields[j]] = value
-                j += 1
-            i += 1
-            info.append(values)
+        ended = True
+        for line in self.local_shell.run_stream(cmd, 0, keepends=1):
+            ended = line.endswith("\n")
+            info.append(self.pcap_record(line[:-1] if ended else line, fields))
+        if ended:
+            info.append(self.pcap_record("", fields))
 
         # Return the list of dictionaries
         return info
@@ -422,32 +434,20 @@ class packet_capture:
 
         log("RUNNING TSHARK CMD : " +cmd)
 
-        # Python seems to have an issue capturing lots of output (in this case from tshark) so redirect to a file then read in the file
-        # We can't use the -w <outfile> option of tshark because -w means write the raw binary (filtered) data to the file.  We need text
-        cmd = cmd + " > __tshark.log"
-        
-        # Run tshark
-        output = self.local_shell.run(cmd, 0)
-
-        # Read in the redirected file
-        datafile = open("__tshark.log", "r")
-        content = datafile.read()
-        datafile.close
+        # tshark output can be very large so stream it (line by line as tshark produces it) rather than
+        # capturing it all at once. We can't use the -w <outfile> option of tshark because -w means write 
+        # the raw binary (filtered) data to the file.  We need text
         
-        # Translate the content into a list of dictionaries
+        # Run tshark and translate the content into a list of dictionaries. Lines are split exactly as
+        # content.split("\n") would, so output ending in a newline (or no output) still gives a last,
+        # empty record
         info = []
-        lines = content.split("\n")
-        i = 0
-        for line in lines:
-            #log(str(i) + "\t" + line)
-            line = line.split("\t")
-            values={}
-            j = 0
-            for value in line:
-                values[fields[j]] = value
-                j += 1
-            i += 1
-            info.append(values)
+        ended = True
+        for line in self.local_shell.run_stream(cmd, 0, keepends=1):
+            ended = line.endswith("\n")
+            info.append(self.pcap_record(line[:-1] if ended else line, fields))
+        if ended:
+            info.append(self.pcap_record("", fields))
 
         # Return the list of dictionaries
         return info
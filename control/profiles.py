@@ -0,0 +1,458 @@
+#!/usr/bin/python3
+
+#
+# Copyright 2016, Dan Malone, All Rights Reserved
+#
+from util.globals import *
+
+import os
+import sys
+import csv
+import threading
+from collections import namedtuple
+
+###################################################################################################
+#
+# MODULE (Class): profile_catalog
+#
+# DESCRIPTION   : This class holds the netem profiles of a csv file (netem_testcases.csv) as a table
+#                 indexed by profile name. The file is read and validated once and read again only
+#                 when its modification time changes. The first line of the file names the columns:
+#
+#                    name,delay,loss,jitter,bandwidth[,<optional columns like rttdist, dvary, reorder, bwmult>]
+#
+#                 delay and jitter are RTT milliseconds, loss a percentage and bandwidth kbit, the same
+#                 as a profile dictionary passed to netem.set(). Numbers are converted to int/float,
+#                 anything else (like a distribution name) stays a string, empty cells are left out.
+#
+# Usage:
+#
+# catalog = get_catalog()
+# if "3g_lossy" in catalog:
+#     profile = catalog.get("3g_lossy")          {'name' : '3g_lossy', 'delay' : 300, ...}
+# slow = catalog.select(delay=(200, None))         all profiles with delay >= 200ms
+# lossy = catalog.select(lambda p: p['loss'] > 0 and p['bandwidth'] < 1000)
+#
+##################################################################################################
+class profile_catalog:
+    """Indexed, cached table of the netem profiles of a csv file"""
+
+    # Columns every profile must have
+    REQUIRED = ['name', 'delay', 'loss', 'jitter', 'bandwidth']
+
+    ##############################################################################################
+    #
+    # METHOD: __init__(path)
+    #
+    # DESCRIPTION: This is the initialization constructor, path is the csv file (default NETEM_PROFILES)
+    #
+    ##############################################################################################
+    def __init__(self, path=None):
+        """__init__(path):
+              This is the initialization constructor, path is the csv file (default NETEM_PROFILES)
+              """
+
+        self.path     = path or getOpt('NETEM_PROFILES')
+        self.mtime    = None
+        self.profiles = {}
+        self.order    = []
+        self.lock     = threading.Lock()
+
+    ##############################################################################################
+    #
+    # METHOD: refresh()
+    #
+    # DESCRIPTION: (Re)load the csv file if it changed since it was last read
+    #
+    ##############################################################################################
+    def refresh(self):
+        """refresh():
+              (Re)load the csv file if it changed since it was last read
+              """
+
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            msg = "\nERROR: " + self.__class__.__name__ + "(" + self.path + ") profile file does not exist\n"
+            log(msg)
+            sys.exit(msg)
+
+        if mtime == self.mtime:
+            return
+        with self.lock:
+            if mtime != self.mtime:
+                self.load()
+                self.mtime = mtime
+
+    ##############################################################################################
+    #
+    # METHOD: load()
+    #
+    # DESCRIPTION: Read and validate every profile of the csv file. A bad file ends the script with the
+    #              line of the first problem.
+    #
+    ##############################################################################################
+    def load(self):
+        """load():
+              Read and validate every profile of the csv file. A bad file ends the script with the
+              line of the first problem.
+              """
+
+        profiles = {}
+        order = []
+        with open(self.path, newline="") as f:
+            reader = csv.DictReader(f, skipinitialspace=True)
+            missing = [column for column in self.REQUIRED if column not in (reader.fieldnames or [])]
+            if missing:
+                self.error(1, "missing columns " + ", ".join(missing))
+
+            for row in reader:
+                line = reader.line_num
+                profile = {}
+                for column, value in row.items():
+                    if column is None or value is None or value.strip() == "":
+                        continue
+                    profile[column.strip()] = self.convert(value.strip())
+
+                name = profile.get('name')
+                if name is None:
+                    continue
+                name = str(name)
+                profile['name'] = name
+                if name in profiles:
+                    self.error(line, "profile " + name + " is defined twice")
+                for column in self.REQUIRED[1:]:
+                    if not isinstance(profile.get(column), (int, float)) or profile[column] < 0:
+                        self.error(line, "profile " + name + " " + column + " must be a number >= 0, not " + str(profile.get(column)))
+                if profile['loss'] > 100:
+                    self.error(line, "profile " + name + " loss is a percentage, not " + str(profile['loss']))
+
+                profiles[name] = profile
+                order.append(name)
+
+        self.profiles = profiles
+        self.order = order
+        log('DEBUG', "Loaded " + str(len(order)) + " netem profiles from " + self.path)
+
+    ##############################################################################################
+    #
+    # METHOD: convert(value)
+    #
+    # DESCRIPTION: Returns value as an int or float if it is a number, otherwise the string
+    #
+    ##############################################################################################
+    def convert(self, value):
+        """convert(value):
+              Returns value as an int or float if it is a number, otherwise the string
+              """
+
+        try:
+            return int(value)
+        except ValueError:
+            pass
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+    ##############################################################################################
+    #
+    # METHOD: error(line, msg)
+    #
+    # DESCRIPTION: End the script for a problem on line of the csv file
+    #
+    ##############################################################################################
+    def error(self, line, msg):
+        """error(line, msg):
+              End the script for a problem on line of the csv file
+              """
+
+        msg = "\nERROR: " + self.__class__.__name__ + "(" + self.path + ":" + str(line) + ") " + msg + "\n"
+        log(msg)
+        sys.exit(msg)
+
+    def __contains__(self, name):
+        self.refresh()
+        return name in self.profiles
+
+    def __len__(self):
+        self.refresh()
+        return len(self.order)
+
+    ##############################################################################################
+    #
+    # METHOD: names()
+    #
+    # DESCRIPTION: Returns the profile names in file order
+    #
+    ##############################################################################################
+    def names(self):
+        """names():
+              Returns the profile names in file order
+              """
+
+        self.refresh()
+        return list(self.order)
+
+    ##############################################################################################
+    #
+    # METHOD: get(name)
+    #
+    # DESCRIPTION: Returns a copy of the profile dictionary called name, or None if there is none
+    #
+    ##############################################################################################
+    def get(self, name):
+        """get(name):
+              Returns a copy of the profile dictionary called name, or None if there is none
+              """
+
+        self.refresh()
+        profile = self.profiles.get(name)
+        return dict(profile) if profile is not None else None
+
+    ##############################################################################################
+    #
+    # METHOD: select(predicate, **ranges)
+    #
+    # DESCRIPTION: Returns copies of the profiles (in file order) matching all of the conditions:
+    #                 predicate - a function of the profile dictionary returning true to select it
+    #                 ranges    - column=(low, high) selects low <= column <= high, either may be None
+    #                             column=value selects column == value
+    #              Profiles without a column named in ranges are not selected.
+    #
+    ##############################################################################################
+    def select(self, predicate=None, **ranges):
+        """select(predicate, **ranges):
+              Returns copies of the profiles (in file order) matching all of the conditions:
+                 predicate - a function of the profile dictionary returning true to select it
+                 ranges    - column=(low, high) selects low <= column <= high, either may be None
+                             column=value selects column == value
+              Profiles without a column named in ranges are not selected.
+              """
+
+        self.refresh()
+        selected = []
+        for name in self.order:
+            profile = self.profiles[name]
+            if predicate is not None and not predicate(profile):
+                continue
+            match = 1
+            for column, condition in ranges.items():
+                if column not in profile:
+                    match = 0
+                elif isinstance(condition, tuple):
+                    low, high = condition
+                    if (low is not None and profile[column] < low) or (high is not None and profile[column] > high):
+                        match = 0
+                elif profile[column] != condition:
+                    match = 0
+                if not match:
+                    break
+            if match:
+                selected.append(dict(profile))
+        return selected
+
+
+# The catalogs of the profile files used so far {path : profile_catalog}
+catalogs = {}
+
+##############################################################################################
+#
+# METHOD: get_catalog(path)
+#
+# DESCRIPTION: Returns the shared profile_catalog of the csv file path (default NETEM_PROFILES)
+#
+##############################################################################################
+def get_catalog(path=None):
+    """get_catalog(path):
+          Returns the shared profile_catalog of the csv file path (default NETEM_PROFILES)
+          """
+
+    path = path or getOpt('NETEM_PROFILES')
+    if path not in catalogs:
+        catalogs[path] = profile_catalog(path)
+    return catalogs[path]
+
+###################################################################################################
+#
+# MODULE (Class): compiled_profile
+#
+# DESCRIPTION   : A netem profile expanded into the values tc takes, built once by compile_profile().
+#                 It is an immutable (named) tuple so it can be shared by every set() of a sweep:
+#
+#                    name      - profile name
+#                    loss      - "<loss>%"
+#                    delay     - "<delay/2>ms"      delay, jitter and dvary are RTT values halved as
+#                    jitter    - "<jitter/2>ms"     they are applied in each direction
+#                    bandwidth - "<bandwidth>kbit"
+#                    rttdist   - delay distribution table name or ""
+#                    dvary     - "<dvary/2>ms" with rttdist, otherwise ""
+#                    reorder   - reorder percentage or ""
+#                    limit     - netem queue limit in packets, 0 for the netem default
+#                    netem     - the arguments of the netem qdisc ("delay 10.0ms 0.0ms loss 0%"), rttdist/dvary
+#                                and reorder are only applied with a dynamic queue limit (like set() always did)
+#                    profile   - the profile it was compiled from, as sorted (key, value) pairs
+#
+##################################################################################################
+class compiled_profile(namedtuple('compiled_profile', ['name', 'loss', 'delay', 'jitter', 'bandwidth', 'rttdist',
+                                                       'dvary', 'reorder', 'limit', 'netem', 'profile'])):
+    """A netem profile expanded into the values tc takes"""
+
+    __slots__ = ()
+
+    def as_dict(self):
+        """as_dict():
+              Returns a copy of the profile dictionary it was compiled from
+              """
+        return dict(self.profile)
+
+##############################################################################################
+#
+# METHOD: bdp_queue_limit(profile)
+#
+# DESCRIPTION: Queue limit model sizing the netem queue (packets) to 1.2 times the bandwidth delay
+#              product of the profile plus 30 packets, times the 'bwmult' of the profile if there is one
+#              (buffer bloat experiments)
+#
+##############################################################################################
+def bdp_queue_limit(profile):
+    """bdp_queue_limit(profile):
+          Queue limit model sizing the netem queue (packets) to 1.2 times the bandwidth delay
+          product of the profile plus 30 packets, times the 'bwmult' of the profile if there is one
+          (buffer bloat experiments)
+          """
+
+    # 11160 data bits in a packet, the delay is the full RTT
+    limit = int(1.2 * (((int(profile['bandwidth']) * 1024) * ((int(profile['delay']))/1000))/11160)) + 30
+    if 'bwmult' in profile:
+        limit = int(limit * profile['bwmult'])
+    return limit
+
+##############################################################################################
+#
+# METHOD: fixed_queue_limit(profile)
+#
+# DESCRIPTION: Queue limit model leaving the netem default (1000 packets) times 'bwmult' if there is one
+#
+##############################################################################################
+def fixed_queue_limit(profile):
+    """fixed_queue_limit(profile):
+          Queue limit model leaving the netem default (1000 packets) times 'bwmult' if there is one
+          """
+
+    return int(1000 * profile.get('bwmult', 1))
+
+
+# The queue limit models by network type {name : function(profile) -> packets}. The model of a profile
+# is its 'network' column, or NETEM_QUEUE_MODEL if it has none.
+queue_models = {'bdp' : bdp_queue_limit, 'fixed' : fixed_queue_limit}
+
+##############################################################################################
+#
+# METHOD: register_queue_model(network, model)
+#
+# DESCRIPTION: Use model (a function of the profile dictionary returning the queue limit in packets)
+#              for profiles of the network type network
+#
+##############################################################################################
+def register_queue_model(network, model):
+    """register_queue_model(network, model):
+          Use model (a function of the profile dictionary returning the queue limit in packets)
+          for profiles of the network type network
+          """
+
+    queue_models[network] = model
+    compiled.clear()
+
+
+# The profiles compiled so far {(profile items, dynamic, queue model) : compiled_profile}
+compiled = {}
+COMPILED_SIZE = 4096
+compiled_lock = threading.Lock()
+
+##############################################################################################
+#
+# METHOD: compile_profile(profile, dynamic)
+#
+# DESCRIPTION: Returns the compiled_profile of a profile dictionary (delay, loss, jitter, bandwidth
+#              and optionally rttdist, dvary, reorder, bwmult, network, limit). The queue limit is the
+#              profile's 'limit' if it has one, otherwise with dynamic=1 the one of the queue model of its
+#              network type, otherwise 0. rttdist/dvary and reorder are only applied with dynamic=1. The
+#              result is cached by the profile content so the same profile is validated, expanded and
+#              logged only once. A bad profile ends the script.
+#
+##############################################################################################
+def compile_profile(profile, dynamic=0):
+    """compile_profile(profile, dynamic):
+          Returns the compiled_profile of a profile dictionary (delay, loss, jitter, bandwidth
+          and optionally rttdist, dvary, reorder, bwmult, network, limit). The queue limit is the
+          profile's 'limit' if it has one, otherwise with dynamic=1 the one of the queue model of its
+          network type, otherwise 0. rttdist/dvary and reorder are only applied with dynamic=1. The
+          result is cached by the profile content so the same profile is validated, expanded and
+          logged only once. A bad profile ends the script.
+          """
+
+    # The queue model the limit comes from is part of the key, NETEM_QUEUE_MODEL may change between calls
+    network = profile.get('network', getOpt('NETEM_QUEUE_MODEL')) if dynamic and 'limit' not in profile else ""
+    items = tuple(sorted(profile.items()))
+    key = (items, 1 if dynamic else 0, network)
+    try:
+        result = compiled.get(key)
+    except TypeError:
+        # a value which is not hashable (like a list), compiled every time
+        key = result = None
+    if result is not None:
+        return result
+
+    name = str(profile.get('name', 'default'))
+    for column in profile_catalog.REQUIRED[1:]:
+        if not isinstance(profile.get(column), (int, float)) or profile[column] < 0:
+            msg = "\nERROR: compile_profile(" + name + ") " + column + " must be a number >= 0, not " + str(profile.get(column)) + "\n"
+            log(msg)
+            sys.exit(msg)
+    if profile['loss'] > 100:
+        msg = "\nERROR: compile_profile(" + name + ") loss is a percentage, not " + str(profile['loss']) + "\n"
+        log(msg)
+        sys.exit(msg)
+
+    loss      = str(profile['loss']) + "%"
+    delay     = str(float(profile['delay']/2)) + "ms"
+    jitter    = str(float(profile['jitter']/2)) + "ms"
+    bandwidth = str(profile['bandwidth']) + "kbit"
+
+    # netem allows the use of a predefined distribution file to administer pseudo RTT over time
+    rttdist   = str(profile['rttdist']) if "rttdist" in profile else ""
+    dvary     = str(float(profile['dvary']/2)) + "ms" if "dvary" in profile and rttdist != "" else ""
+    reorder   = str(profile['reorder']) if "reorder" in profile else ""
+
+    limit = 0
+    if 'limit' in profile:
+        limit = int(profile['limit'])
+    elif dynamic:
+        if network not in queue_models:
+            msg = "\nERROR: compile_profile(" + name + ") no queue limit model for network " + str(network) + "\n"
+            log(msg)
+            sys.exit(msg)
+        limit = queue_models[network](profile)
+        log('DEBUG', "Netem queue limit " + str(limit) + " (" + str(network) + " model) for " + name + ": bandwidth " +
+            str(profile['bandwidth']) + " delay " + str(profile['delay']) + "ms")
+
+    netem = "delay " + delay
+    if dynamic and rttdist != "":
+        # this is a distribution table file request apply dvary and dist (the dynamic queue limit path only)
+        netem += " " + dvary + " distribution " + rttdist
+    else:
+        netem += " " + jitter
+    if dynamic and reorder != "":
+        netem += " reorder " + reorder
+    netem += " loss " + loss
+    if limit:
+        netem += " limit " + str(limit)
+
+    result = compiled_profile(name, loss, delay, jitter, bandwidth, rttdist, dvary, reorder, limit, netem, items)
+    if key is not None:
+        with compiled_lock:
+            if len(compiled) >= COMPILED_SIZE:
+                compiled.clear()
+            compiled[key] = result
+    return result
@@ -0,0 +1,427 @@
+#!/usr/bin/python3
+
+#
+# Copyright 2016, Dan Malone, All Rights Reserved
+#
+from util.globals import *
+
+import sys
+import csv
+import json
+import time
+import base64
+import threading
+from .profiles import compile_profile
+
+# #################################################################################################
+#
+# REPLAY_SOURCE
+#
+# This is the scheduler run on the netem system for a remote replay. It reads the plan (json) from stdin:
+#    {"tc" : ["tc"] or ["sudo", "tc"], "origin" : <time.time() of t=0 on the netem system>,
+#     "steps" : [{"step" : <index>, "t" : <seconds>, "lines" : [<tc batch lines>]}, ...]}
+# sleeps until each step is due (the last couple of milliseconds are spun for accuracy), applies its lines
+# with one "tc -force -batch" and writes one json line per step:
+#    {"step", "scheduled", "applied", "done", "rc", "error"}      (times in seconds from t=0)
+#
+# NOTE: Keep this python 3.4 compatible, it runs on whatever the netem system has installed
+#
+# #################################################################################################
+REPLAY_SOURCE = r'''
+import sys, json, time
+from subprocess import Popen, PIPE
+
+plan = json.loads(sys.stdin.read())
+start = plan['origin']
+for step in plan['steps']:
+    target = start + step['t']
+    while 1:
+        left = target - time.time()
+        if left <= 0:
+            break
+        time.sleep(left - 0.002 if left > 0.004 else 0)
+    applied = time.time()
+    tc = Popen(plan['tc'] + ['-force', '-batch', '-'], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    out, err = tc.communicate(("\n".join(step['lines']) + "\n").encode('utf-8'))
+    done = time.time()
+    sys.stdout.write(json.dumps({'step' : step['step'], 'scheduled' : step['t'], 'applied' : applied - start,
+                                 'done' : done - start, 'rc' : tc.returncode,
+                                 'error' : err.decode('utf-8', 'replace').strip()}) + "\n")
+    sys.stdout.flush()
+'''
+
+# Columns of a trace step, the impairment carries over from the previous step when one is missing
+TRACE_FIELDS = ['t', 'bandwidth', 'delay', 'loss', 'jitter']
+
+##############################################################################################
+#
+# METHOD: number(value)
+#
+# DESCRIPTION: Returns value as an int or float if it is a number, otherwise value
+#
+##############################################################################################
+def number(value):
+    """number(value):
+          Returns value as an int or float if it is a number, otherwise value
+          """
+
+    if not isinstance(value, str):
+        return value
+    for kind in [int, float]:
+        try:
+            return kind(value)
+        except ValueError:
+            pass
+    return value
+
+##############################################################################################
+#
+# METHOD: load_trace(source)
+#
+# DESCRIPTION: Returns a trace as a list of step dictionaries {'t', 'bandwidth', 'delay', 'loss', 'jitter'
+#              [, 'limit', ...]} sorted by time. t is seconds from the start of the replay and the other
+#              fields use the units of a netem profile (delay/jitter RTT ms, loss %, bandwidth kbit).
+#                 source - a csv file with a header line naming the columns, or a list of dictionaries,
+#                          or a list of (t, bandwidth, delay, loss, jitter) tuples
+#              Fields missing from a step are carried over from the step before it in time.
+#
+##############################################################################################
+def load_trace(source):
+    """load_trace(source):
+          Returns a trace as a list of step dictionaries {'t', 'bandwidth', 'delay', 'loss', 'jitter'
+          [, 'limit', ...]} sorted by time. t is seconds from the start of the replay and the other
+          fields use the units of a netem profile (delay/jitter RTT ms, loss %, bandwidth kbit).
+             source - a csv file with a header line naming the columns, or a list of dictionaries,
+                      or a list of (t, bandwidth, delay, loss, jitter) tuples
+          Fields missing from a step are carried over from the step before it in time.
+          """
+
+    if isinstance(source, str):
+        with open(source, newline="") as f:
+            rows = [{key.strip() : value.strip() for key, value in row.items() if key and value and value.strip()}
+                    for row in csv.DictReader(f, skipinitialspace=True)]
+    else:
+        rows = [row if isinstance(row, dict) else dict(zip(TRACE_FIELDS, row)) for row in source]
+
+    # Steps carry over from the one before them in time, not in the file
+    for idx, row in enumerate(rows):
+        if 't' not in row:
+            msg = "\nERROR: load_trace() step " + str(idx) + " has no t\n"
+            log(msg)
+            sys.exit(msg)
+    rows.sort(key=lambda row: number(row['t']))
+
+    trace = []
+    current = {'loss' : 0, 'jitter' : 0}
+    for idx, row in enumerate(rows):
+        step = dict(current)
+        for key, value in row.items():
+            step[key] = number(value)
+        missing = [field for field in TRACE_FIELDS if field not in step]
+        if missing:
+            msg = "\nERROR: load_trace() step " + str(idx) + " has no " + ", ".join(missing) + "\n"
+            log(msg)
+            sys.exit(msg)
+        trace.append(step)
+        current = step
+
+    return trace
+
+###################################################################################################
+#
+# MODULE (Class): netem_replay
+#
+# DESCRIPTION   : This class replays a time varying impairment (a trace, see load_trace()) on a netem
+#                 system. The first step is applied with netem.set() (building the tree if needed) and
+#                 that is t=0 of the replay, every later step is compiled up front into the "tc change"
+#                 lines which take the tree from the previous step to it (steps which change nothing are
+#                 dropped) and applied when it is due after t=0.
+#
+#                 mode "remote" ships the compiled timeline to a small scheduler on the netem system
+#                 (REPLAY_SOURCE) so the steps are applied on time without any network round trip.
+#                 mode "local" applies each step from here with one shell.batch() call when it is due,
+#                 which is only as accurate as the ssh round trip.
+#
+#                 Each applied step (the first one included) is logged with its scheduled and actual
+#                 apply time so the accuracy of a run can be checked (see summary()).
+#
+# Usage:
+#
+# replay = netem_replay(netem_server, "lte_drive.csv")
+# replay.start()                      (or replay.run() to block)
+# ... run transfers ...
+# log = replay.wait()                 [{'step', 'scheduled', 'applied', 'done', 'rc', 'error'}, ...]
+#
+##################################################################################################
+class netem_replay:
+    """Replays a time varying impairment on a netem system"""
+
+    ##############################################################################################
+    #
+    # METHOD: __init__(netem_server, trace, mode, lead)
+    #
+    # DESCRIPTION: This is the initialization constructor:
+    #                 netem_server - the netem object of the netem system
+    #                 trace        - the trace (anything load_trace() takes)
+    #                 mode         - "remote" (scheduler on the netem system) or "local"
+    #                 lead         - no longer needed (t=0 is when the first step was applied, a step
+    #                                due while the scheduler starts is logged late) and kept for compatibility
+    #
+    ##############################################################################################
+    def __init__(self, netem_server, trace, mode="remote", lead=0.5):
+        """__init__(netem_server, trace, mode, lead):
+              This is the initialization constructor:
+                 netem_server - the netem object of the netem system
+                 trace        - the trace (anything load_trace() takes)
+                 mode         - "remote" (scheduler on the netem system) or "local"
+                 lead         - no longer needed (t=0 is when the first step was applied, a step
+                                due while the scheduler starts is logged late) and kept for compatibility
+              """
+
+        if mode not in ["remote", "local"]:
+            sys.exit("\nERROR: " + self.__class__.__name__ + "() mode must be remote or local, not " + str(mode) + "\n")
+
+        self.netem   = netem_server
+        self.trace   = load_trace(trace)
+        self.mode    = mode
+        self.lead    = lead
+        self.steps   = []
+        self.final   = {}
+        self.origin  = 0.0
+        self.results = []
+        self.thread  = None
+
+    ##############################################################################################
+    #
+    # METHOD: profile(step)
+    #
+    # DESCRIPTION: The netem profile dictionary of a trace step, the trace's queue limit is kept
+    #
+    ##############################################################################################
+    def profile(self, step):
+        """profile(step):
+              The netem profile dictionary of a trace step, the trace's queue limit is kept
+              """
+
+        profile = {key : value for key, value in step.items() if key != 't'}
+        profile['name'] = "replay"
+        return profile
+
+    ##############################################################################################
+    #
+    # METHOD: compile()
+    #
+    # DESCRIPTION: Apply the first step with netem.set() and compile the later steps into tc batch lines.
+    #              Fills self.steps with [{'step', 't', 'lines'}] (t relative to the first step), sets
+    #              self.origin (t=0) to when the first step was applied and logs it.
+    #
+    ##############################################################################################
+    def compile(self):
+        """compile():
+              Apply the first step with netem.set() and compile the later steps into tc batch lines.
+              Fills self.steps with [{'step', 't', 'lines'}] (t relative to the first step), sets
+              self.origin (t=0) to when the first step was applied and logs it.
+              """
+
+        if len(self.trace) == 0:
+            return
+
+        # Not a dynamic queue limit: the step's own limit is applied (not the queue model's) and set()
+        # clears an existing tree instead of adding on top of it ("File exists")
+        first = self.trace[0]
+        self.origin = time.time()
+        self.netem.set(self.profile(first), dynQlim=0)
+        self.results.append({'step' : 0, 'scheduled' : 0.0, 'applied' : 0.0, 'done' : time.time() - self.origin,
+                             'rc' : 0, 'error' : ""})
+        if self.netem.method != "2" or len(self.netem.applied) == 0:
+            msg = "\nERROR: " + self.__class__.__name__ + "() replay needs a method 2 netem tree on " + self.netem.control_ip + "\n"
+            log(msg)
+            sys.exit(msg)
+
+        tree = dict(self.netem.applied)
+        self.steps = []
+        for idx, step in enumerate(self.trace[1:], 1):
+            compiled = compile_profile(self.profile(step))
+            desired = {'rate' : compiled.bandwidth, 'netem' : compiled.netem}
+            lines = []
+            for eth in tree:
+                lines += self.netem.tc_changes(eth, tree[eth], desired)
+                tree[eth] = desired
+            if len(lines):
+                self.steps.append({'step' : idx, 't' : step['t'] - first['t'], 'lines' : lines})
+        self.final = tree
+
+        log('DEBUG', "Replay of " + str(len(self.trace)) + " steps compiled to " + str(len(self.steps)) + " tc changes")
+
+    ##############################################################################################
+    #
+    # METHOD: run()
+    #
+    # DESCRIPTION: Replay the trace and wait until it is done. Returns the log of applied steps
+    #              [{'step', 'scheduled', 'applied', 'done', 'rc', 'error'}] (times in seconds from t=0).
+    #
+    ##############################################################################################
+    def run(self):
+        """run():
+              Replay the trace and wait until it is done. Returns the log of applied steps
+              [{'step', 'scheduled', 'applied', 'done', 'rc', 'error'}] (times in seconds from t=0).
+              """
+
+        self.results = []
+        self.compile()
+        if len(self.steps):
+            if self.mode == "remote":
+                self.run_remote()
+            else:
+                self.run_local()
+
+        # netem.set() diffs against the tree the replay left behind, unless a step failed
+        failed = [result for result in self.results if result['rc'] != 0]
+        self.netem.applied = {} if failed or len(self.results) != len(self.steps) + 1 else self.final
+
+        for result in failed:
+            log("ERROR", "Replay step " + str(result['step']) + " failed: " + result['error'])
+        self.summary()
+        return self.results
+
+    ##############################################################################################
+    #
+    # METHOD: run_remote()
+    #
+    # DESCRIPTION: Hand the compiled steps to the scheduler on the netem system and collect its log
+    #
+    ##############################################################################################
+    def run_remote(self):
+        """run_remote():
+              Hand the compiled steps to the scheduler on the netem system and collect its log
+              """
+
+        plan = {'tc' : ["tc"] if self.netem.user == "root" else ["sudo", "tc"], 'origin' : self.origin + self.clock_offset(),
+                'steps' : self.steps}
+        source = base64.b64encode(REPLAY_SOURCE.encode('utf-8')).decode('ascii')
+        cmd = "python3 -c 'import base64; exec(base64.b64decode(\"" + source + "\"))' <<'PATI_PLAN'\n" + json.dumps(plan) + "\nPATI_PLAN"
+
+        for line in self.netem.netem_shell.run_stream(cmd, 0, 0, 0):
+            try:
+                self.results.append(json.loads(line))
+            except ValueError:
+                log("Replay: " + line)
+
+    ##############################################################################################
+    #
+    # METHOD: clock_offset()
+    #
+    # DESCRIPTION: Returns how far the clock of the netem system is ahead of ours in seconds, measured
+    #              with one round trip (good to about half of it). 0 when the netem shell is local.
+    #
+    ##############################################################################################
+    def clock_offset(self):
+        """clock_offset():
+              Returns how far the clock of the netem system is ahead of ours in seconds, measured
+              with one round trip (good to about half of it). 0 when the netem shell is local.
+              """
+
+        if self.netem.netem_shell.local:
+            return 0.0
+
+        sent = time.time()
+        remote = self.netem.netem_shell.run("date +%s.%N", 0).strip()
+        received = time.time()
+        try:
+            return float(remote) - (sent + received) / 2
+        except ValueError:
+            log("Replay: could not read the clock of " + self.netem.control_ip + " (" + remote + "), assuming it is ours")
+            return 0.0
+
+    ##############################################################################################
+    #
+    # METHOD: run_local()
+    #
+    # DESCRIPTION: Apply each compiled step from here when it is due
+    #
+    ##############################################################################################
+    def run_local(self):
+        """run_local():
+              Apply each compiled step from here when it is due
+              """
+
+        start = self.origin
+        for step in self.steps:
+            left = start + step['t'] - time.time()
+            if left > 0:
+                time.sleep(left)
+            applied = time.time()
+            result = self.netem.netem_shell.batch().add("tc -force -batch - <<'PATI_TC'\n" + "\n".join(step['lines']) + "\nPATI_TC", 0).run(0, 0)[0]
+            errors = self.netem.tc_errors(step['lines'], result['stderr'])
+            self.results.append({'step' : step['step'], 'scheduled' : step['t'], 'applied' : applied - start,
+                                 'done' : time.time() - start, 'rc' : 1 if errors else result['rc'],
+                                 'error' : "; ".join(error for n, line, error in errors)})
+
+    ##############################################################################################
+    #
+    # METHOD: start() / wait()
+    #
+    # DESCRIPTION: Run the replay in the background (so transfers can run meanwhile) and wait for it.
+    #              wait() returns the log of run().
+    #
+    ##############################################################################################
+    def start(self):
+        """start():
+              Run the replay in the background (so transfers can run meanwhile)
+              """
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def wait(self):
+        """wait():
+              Wait for a replay started with start() and return its log
+              """
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        return self.results
+
+    ##############################################################################################
+    #
+    # METHOD: summary()
+    #
+    # DESCRIPTION: Log and return how far the applied steps were from their schedule:
+    #              {'steps', 'late_mean', 'late_max', 'apply_max'} in seconds
+    #
+    ##############################################################################################
+    def summary(self):
+        """summary():
+              Log and return how far the applied steps were from their schedule:
+              {'steps', 'late_mean', 'late_max', 'apply_max'} in seconds
+              """
+
+        late = [result['applied'] - result['scheduled'] for result in self.results]
+        apply = [result['done'] - result['applied'] for result in self.results]
+        summary = {'steps'     : len(self.results),
+                   'late_mean' : sum(late) / len(late) if late else 0.0,
+                   'late_max'  : max(late) if late else 0.0,
+                   'apply_max' : max(apply) if apply else 0.0}
+
+        log("Replay (" + self.mode + ") applied " + str(summary['steps']) + " of " + str(len(self.steps) + 1) + " steps, late mean %.1fms max %.1fms, apply max %.1fms" %
+            (summary['late_mean'] * 1000, summary['late_max'] * 1000, summary['apply_max'] * 1000))
+        return summary
+
+    ##############################################################################################
+    #
+    # METHOD: dump(path)
+    #
+    # DESCRIPTION: Write the log of applied steps to path as csv
+    #
+    ##############################################################################################
+    def dump(self, path):
+        """dump(path):
+              Write the log of applied steps to path as csv
+              """
+
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=['step', 'scheduled', 'applied', 'done', 'rc', 'error'])
+            writer.writeheader()
+            writer.writerows(self.results)
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+
+#
+# Copyright 2016, Dan Malone, All Rights Reserved
+#
+from util.globals import *
+
+import threading
+from array import array
+
+###################################################################################################
+#
+# MODULE (Class): time_series
+#
+# DESCRIPTION   : A compact time series of samples. The time stamps and each field are kept in their own
+#                 array of doubles (8 bytes a sample, no per sample objects) so long runs sampled many
+#                 times a second stay small. Samples may be appended from a sampling thread while the
+#                 series is being read.
+#
+#                 export() writes a field as "<time> <value>" lines, the format control.plot's
+#                 gnuplot.generic_tplot() plots, with the time in seconds from the first sample.
+#
+# Usage:
+#
+# series = time_series(['bytes', 'drops'])
+# series.append(time.time(), {'bytes' : 1500, 'drops' : 0})
+# series.export("/tmp/plots/eth1_drops.txt", "drops")
+# series.export("/tmp/plots/eth1_rate.txt", "bytes", rate=1)      bytes per second between samples
+#
+##################################################################################################
+class time_series:
+    """A compact time series of samples"""
+
+    def __init__(self, fields):
+        """__init__(fields):
+              This is the initialization constructor, fields are the names of the values of a sample
+              """
+
+        self.fields = list(fields)
+        self.time   = array('d')
+        self.data   = {field : array('d') for field in self.fields}
+        self.lock   = threading.Lock()
+
+    def __len__(self):
+        return len(self.time)
+
+    ##############################################################################################
+    #
+    # METHOD: append(t, values)
+    #
+    # DESCRIPTION: Add a sample taken at time t, values is a dictionary of the fields (missing ones are 0)
+    #
+    ##############################################################################################
+    def append(self, t, values):
+        """append(t, values):
+              Add a sample taken at time t, values is a dictionary of the fields (missing ones are 0)
+              """
+
+        with self.lock:
+            self.time.append(t)
+            for field in self.fields:
+                self.data[field].append(float(values.get(field, 0)))
+
+    ##############################################################################################
+    #
+    # METHOD: points(field, rate)
+    #
+    # DESCRIPTION: Returns the list of (seconds from the first sample, value) of a field. With rate=1 the
+    #              value is the change per second since the previous sample (for counters like bytes).
+    #
+    ##############################################################################################
+    def points(self, field, rate=0):
+        """points(field, rate):
+              Returns the list of (seconds from the first sample, value) of a field. With rate=1 the
+              value is the change per second since the previous sample (for counters like bytes).
+              """
+
+        with self.lock:
+            times = self.time.tolist()
+            values = self.data[field].tolist()
+        if len(times) == 0:
+            return []
+
+        start = times[0]
+        if not rate:
+            return [(t - start, value) for t, value in zip(times, values)]
+
+        points = []
+        for idx in range(1, len(times)):
+            elapsed = times[idx] - times[idx - 1]
+            if elapsed > 0:
+                points.append((times[idx] - start, (values[idx] - values[idx - 1]) / elapsed))
+        return points
+
+    ##############################################################################################
+    #
+    # METHOD: export(path, field, rate)
+    #
+    # DESCRIPTION: Write a field (see points()) to path as "<time> <value>" lines for generic_tplot()
+    #
+    ##############################################################################################
+    def export(self, path, field, rate=0):
+        """export(path, field, rate):
+              Write a field (see points()) to path as "<time> <value>" lines for generic_tplot()
+              """
+
+        with open(path, "w") as f:
+            for t, value in self.points(field, rate):
+                f.write("%.3f %g\n" % (t, value))
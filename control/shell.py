@@ -9,6 +9,9 @@ from util.utilities import *
 from util.globals import *
 
 from .shell import *
+from .agent import get_agent
+from .metrics import metrics
+from .sudo import get_sudo_policy
 
 import re
 import shlex
@@ -18,8 +21,267 @@ import pexpect
 import getpass
 import atexit
 import inspect
+import asyncio
+import signal
+import threading
+import tempfile
+import shutil
+import time
 from time import sleep
-from subprocess import Popen, PIPE, call
+from subprocess import Popen, PIPE, STDOUT, DEVNULL, TimeoutExpired, call
+
+# ################################################################################################
+#
+# CLASS: ssh_master
+#
+# DESCRIPTION:
+#
+# This class owns one persistent (multiplexed) ssh connection to a user@host. The connection is an
+# OpenSSH ControlMaster bound to a private unix socket and every ssh/scp issued by a shell object for
+# that user@host rides on it, so a command only costs a channel open instead of a full TCP connect
+# plus key exchange.
+#
+# Masters are pooled per (user, ip) and shared by every shell object pointing at the same system,
+# use get_ssh_master() to get one and close_ssh_masters() to tear them down (this is also registered
+# with atexit). If the master cannot be brought up the options fall back to a plain ssh connection.
+#
+# Usage Examples:
+#
+# master = get_ssh_master("root", "172.16.0.33")
+# Popen(['ssh'] + master.options() + ['root@172.16.0.33', 'date'])
+# close_ssh_masters()
+#
+# #################################################################################################
+class ssh_master:
+
+    # #############################################################################################
+    #
+    # METHOD: __init__(user, ip)
+    #
+    # DESCRIPTION: This is the initialization constructor:
+    #                 user - login user (ex: root | <userid>)
+    #                 ip   - ip address of the remote
+    #              The connection is not opened until open() is called
+    #
+    # #############################################################################################
+    def __init__(self, user, ip):
+        """__init__(user, ip):
+           This is the initialization constructor:
+              user - login user (ex: root | <userid>)
+              ip   - ip address of the remote
+           The connection is not opened until open() is called
+           """
+
+        self.user = user
+        self.ip = ip
+        self.process = None
+        self.connect_time = 0.0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+        # Keep the socket path short, unix sockets are limited to ~100 characters
+        self.control_path = os.path.join(ssh_control_dir(), user + "@" + ip)
+
+    # #############################################################################################
+    #
+    # METHOD: is_open()
+    #
+    # DESCRIPTION: Returns 1 if the master process is alive and its control socket exists
+    #
+    # #############################################################################################
+    def is_open(self):
+        """is_open():
+           Returns 1 if the master process is alive and its control socket exists
+           """
+
+        if self.process is None or self.process.poll() is not None:
+            return 0
+        return 1 if os.path.exists(self.control_path) else 0
+
+    # #############################################################################################
+    #
+    # METHOD: open()
+    #
+    # DESCRIPTION: Bring up the master connection if it is not already up. Waits up to SSH_MASTER_WAIT
+    #              seconds for the control socket to appear. Returns 1 if the master is usable
+    #              A master which failed to come up is not retried until close() is called.
+    #
+    # #############################################################################################
+    def open(self):
+        """open():
+           Bring up the master connection if it is not already up. Waits up to SSH_MASTER_WAIT
+           seconds for the control socket to appear. Returns 1 if the master is usable
+           A master which failed to come up is not retried until close() is called.
+           """
+
+        with self.lock:
+            if self.is_open():
+                return 1
+            if self.failed:
+                return 0
+
+            # Clean up a master that died underneath us
+            self.shutdown()
+
+            start = time.time()
+            self.process = Popen(['ssh', '-M', '-N', '-S', self.control_path, '-o', 'ControlPersist=no',
+                                  '-o', 'ServerAliveInterval=30', self.user + '@' + self.ip],
+                                 stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+
+            # Wait for the socket, the master exits on its own if it cannot connect
+            deadline = start + float(getOpt('SSH_MASTER_WAIT') or 10)
+            while time.time() < deadline:
+                if self.is_open():
+                    self.connect_time = time.time() - start
+                    metrics.handshake(self.connect_time)
+                    if getOpt('VERBOSE'):
+                        log("SSH master up for " + self.user + "@" + self.ip + " in " + "%.3f" % self.connect_time + "s")
+                    return 1
+                if self.process.poll() is not None:
+                    break
+                sleep(0.02)
+
+            log("SSH master for " + self.user + "@" + self.ip + " did not come up, using plain ssh")
+            self.shutdown()
+            self.failed = 1
+            metrics.handshake(time.time() - start)
+            return 0
+
+    # #############################################################################################
+    #
+    # METHOD: options()
+    #
+    # DESCRIPTION: Returns the ssh/scp options which route a command through this master. If the
+    #              master is not usable an empty list is returned and a plain connection is made.
+    #
+    # #############################################################################################
+    def options(self):
+        """options():
+           Returns the ssh/scp options which route a command through this master. If the
+           master is not usable an empty list is returned and a plain connection is made.
+           """
+
+        if not self.open():
+            return []
+
+        # ControlMaster=no so a dead socket falls back to a direct connection instead of a new master
+        return ['-o', 'ControlPath=' + self.control_path, '-o', 'ControlMaster=no']
+
+    # #############################################################################################
+    #
+    # METHOD: shutdown()
+    #
+    # DESCRIPTION: Tear the master connection down (caller holds the lock)
+    #
+    # #############################################################################################
+    def shutdown(self):
+        """shutdown():
+           Tear the master connection down (caller holds the lock)
+           """
+
+        if self.process is not None:
+            if self.process.poll() is None:
+                # Ask the master to exit cleanly then make sure of it
+                call(['ssh', '-S', self.control_path, '-O', 'exit', self.user + '@' + self.ip],
+                     stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+                try:
+                    self.process.wait(2)
+                except TimeoutExpired:
+                    self.process.kill()
+                    self.process.wait()
+            self.process = None
+
+        if os.path.exists(self.control_path):
+            try:
+                os.remove(self.control_path)
+            except OSError:
+                pass
+
+    # #############################################################################################
+    #
+    # METHOD: close()
+    #
+    # DESCRIPTION: Close the master connection
+    #
+    # #############################################################################################
+    def close(self):
+        """close():
+           Close the master connection
+           """
+
+        with self.lock:
+            self.shutdown()
+            self.failed = 0
+
+
+# Pool of ssh masters keyed by (user, ip) and the lock protecting it
+ssh_masters = {}
+ssh_masters_lock = threading.Lock()
+ssh_dir = ""
+
+# #################################################################################################
+#
+# METHOD: ssh_control_dir()
+#
+# DESCRIPTION: Returns the private directory holding the control sockets for this process
+#
+# #################################################################################################
+def ssh_control_dir():
+    """ssh_control_dir():
+       Returns the private directory holding the control sockets for this process
+       """
+
+    global ssh_dir
+    if ssh_dir == "" or not os.path.isdir(ssh_dir):
+        ssh_dir = tempfile.mkdtemp(prefix="pati-ssh-")
+    return ssh_dir
+
+# #################################################################################################
+#
+# METHOD: get_ssh_master(user, ip)
+#
+# DESCRIPTION: Returns the pooled ssh_master for user@ip, creating it if needed
+#
+# #################################################################################################
+def get_ssh_master(user, ip):
+    """get_ssh_master(user, ip):
+       Returns the pooled ssh_master for user@ip, creating it if needed
+       """
+
+    with ssh_masters_lock:
+        key = (user, ip)
+        if key not in ssh_masters:
+            ssh_masters[key] = ssh_master(user, ip)
+        return ssh_masters[key]
+
+# #################################################################################################
+#
+# METHOD: close_ssh_masters(ip=None)
+#
+# DESCRIPTION: Close the pooled ssh masters. If ip is given only the masters for that ip are closed.
+#              This is registered with atexit and called at the end of a pytest session.
+#
+# #################################################################################################
+def close_ssh_masters(ip=None):
+    """close_ssh_masters(ip=None):
+       Close the pooled ssh masters. If ip is given only the masters for that ip are closed.
+       This is registered with atexit and called at the end of a pytest session.
+       """
+
+    with ssh_masters_lock:
+        for key in list(ssh_masters.keys()):
+            if ip is None or key[1] == ip:
+                ssh_masters[key].close()
+                del ssh_masters[key]
+
+    if ip is None and ssh_dir != "" and os.path.isdir(ssh_dir):
+        try:
+            os.rmdir(ssh_dir)
+        except OSError:
+            pass
+
+# Registered at import so it runs after every shell.stop() registered by launch()
+atexit.register(close_ssh_masters)
 
 # ################################################################################################
 # 
@@ -70,6 +332,7 @@ class shell:
     #                 ip - ip address of the remote
     #                 user - login user (ex: root | <userid>)
     #              If ip is "local", user may be omitted or ""
+    #              If ip is "ns:<name>", commands run locally inside the network namespace <name>
     #
     # #############################################################################################
     def __init__(self, ip, user="root"):
@@ -78,92 +341,243 @@ class shell:
               ip   - ip address of the remote
               user - login user (ex: root | <userid>)
            If ip is "local", user may be omitted or ""
+           If ip is "ns:<name>", commands run locally inside the network namespace <name>
            """
 
         self.launched_cmds = {}
         self.ip = ip
         self.user = user
-        if ip == "local" or ip == "127.0.0.1" or ip == "localhost":
+        self.agent = None
+        self.agent_failed = 0
+
+        # "ns:<name>" is a network namespace on this system (see control/nsbed.py), run like local
+        self.netns = ip[3:] if ip.startswith("ns:") else ""
+        if ip == "local" or ip == "127.0.0.1" or ip == "localhost" or self.netns:
             self.local=1
         else:
             self.local=0
+
+    ##############################################################################################
+    #
+    # METHOD: ssh_options()
+    #
+    # DESCRIPTION: Returns the ssh/scp options to reach this remote. When SSH_MULTIPLEX is set these route
+    #              the command over the pooled persistent master connection for user@ip.
+    #
+    ##############################################################################################
+    def ssh_options(self):
+        """ssh_options():
+           Returns the ssh/scp options to reach this remote. When SSH_MULTIPLEX is set these route
+           the command over the pooled persistent master connection for user@ip.
+           """
+
+        if self.local or not getOpt('SSH_MULTIPLEX'):
+            return []
+        return get_ssh_master(self.user, self.ip).options()
+
+    ##############################################################################################
+    #
+    # METHOD: ssh_argv(cmd)
+    #
+    # DESCRIPTION: Returns the Popen argument list to run cmd on the remote
+    #
+    ##############################################################################################
+    def ssh_argv(self, cmd):
+        """ssh_argv(cmd):
+           Returns the Popen argument list to run cmd on the remote
+           """
+
+        return ['ssh'] + self.ssh_options() + [self.user + '@' + self.ip, cmd]
+
+    ##############################################################################################
+    #
+    # METHOD: close()
+    #
+    # DESCRIPTION: Close the persistent connection to this remote. Any shell object for the same
+    #              user@ip shares it, the next command will simply open a new one.
+    #
+    ##############################################################################################
+    def close(self):
+        """close():
+           Close the persistent connection to this remote. Any shell object for the same
+           user@ip shares it, the next command will simply open a new one.
+           """
+
+        if not self.local:
+            if self.agent is not None:
+                self.agent.stop()
+                self.agent = None
+            master = ssh_masters.get((self.user, self.ip))
+            if master is not None:
+                master.close()
+
+    ##############################################################################################
+    #
+    # METHOD: use_agent(enable)
+    #
+    # DESCRIPTION: Route run()/run_async() through a resident agent on the remote (see control/agent.py)
+    #              instead of a new ssh channel and remote shell per command. Setting SHELL_AGENT=1 does
+    #              this for every remote shell. The agent is shared by every shell object for the same
+    #              user@ip. Returns 1 if the agent is running, 0 if it could not be started (the shell
+    #              keeps using ssh).
+    #                 enable - 1 to start using the agent, 0 to go back to plain ssh for this shell
+    #
+    ##############################################################################################
+    def use_agent(self, enable=1):
+        """use_agent(enable):
+           Route run()/run_async() through a resident agent on the remote (see control/agent.py)
+           instead of a new ssh channel and remote shell per command. Setting SHELL_AGENT=1 does
+           this for every remote shell. The agent is shared by every shell object for the same
+           user@ip. Returns 1 if the agent is running, 0 if it could not be started (the shell
+           keeps using ssh).
+              enable - 1 to start using the agent, 0 to go back to plain ssh for this shell
+              """
+
+        if self.local:
+            return 0
+
+        # agent_failed also keeps SHELL_AGENT from bringing the agent back after use_agent(0)
+        self.agent = get_agent(self, retry=1) if enable else None
+        self.agent_failed = 0 if self.agent is not None else 1
+        return 1 if self.agent is not None else 0
+
+    ##############################################################################################
+    #
+    # METHOD: transport()
+    #
+    # DESCRIPTION: Returns the agent commands should be sent to, or None to use ssh
+    #
+    ##############################################################################################
+    def transport(self):
+        """transport():
+           Returns the agent commands should be sent to, or None to use ssh
+           """
+
+        if self.local:
+            return None
+        if (self.agent is None or not self.agent.alive()) and getOpt('SHELL_AGENT') and not self.agent_failed:
+            self.agent = get_agent(self)
+            self.agent_failed = 0 if self.agent is not None else 1
+        if self.agent is not None and self.agent.alive():
+            return self.agent
+        return None
             
     ##############################################################################################
     #
-    # METHOD: run(command)
+    # METHOD: prepare(cmd, pcommand)
     #
-    # DESCRIPTION: Run a command locally or remotely and wait for completion. NOTE: For remote accesses this can
-    #              ONLY be used if the remote is set up for passwordless SSH connections.
-    #                 cmd          - command to be run in the shell
-    #                 perror       - If perror is 0, the error will not be printed if the command fails
-    #                 redirect_err - If redirect_err is 1, the output will be redirected (>2) and that stderr will be appended to the output
-    #                                This is needed for some commands like curl that seem to use stderr as normal output.
-    #                 decode       - If 1 then UTF-8 decode will be applied to the read data
-    #                 pcommand     - Add command to the output
+    # DESCRIPTION: Build the argument list used to run cmd locally or on the remote. For a non-root remote
+    #              user the command may be wrapped in sudo. Returns (argv, cmd) where cmd is the command
+    #              as it will actually be executed (used for error messages).
+    #                 cmd      - command to be run in the shell
+    #                 pcommand - If 1 and VERBOSE is set the command is logged
     #
     ##############################################################################################
-    def run(self, cmd, perror=1, redirect_err=0, decode=1, pcommand=1):
-        """run(command):
-           Run a command locally or remotely and wait for completion. NOTE: For remote accesses this can
-           ONLY be used if the remote is set up for passwordless SSH connections.
-              perror       - If perror is 0, the error will not be printed if the command fails
-              redirect_err - If redirect_err is 1, the output will be redirected (2>&1) and that stderr will be appended to the output
-                             This is needed for some commands like curl that seem to use stderr as normal output.
+    def prepare(self, cmd, pcommand=1):
+        """prepare(cmd, pcommand):
+           Build the argument list used to run cmd locally or on the remote. For a non-root remote
+           user the command may be wrapped in sudo. Returns (argv, cmd) where cmd is the command
+           as it will actually be executed (used for error messages).
+              cmd      - command to be run in the shell
+              pcommand - If 1 and VERBOSE is set the command is logged
               """
 
         # Check if local
         if self.local:
-            # Run it locally             
+            # Run it locally (same as Popen(cmd, shell=True))
             if getOpt('VERBOSE') and pcommand:
                 log(cmd)
-            stream = Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        else:
-            # Run as remote
+            return self.local_argv(cmd), cmd
 
-            # if we have pcommand and verboise is set
-            if pcommand and getOpt('VERBOSE'):
-                log('ssh ' + self.user + '@'+ self.ip + " "+ cmd)
+        # Run as remote
+
+        # if we have pcommand and verboise is set
+        if pcommand and getOpt('VERBOSE'):
+            log('ssh ' + self.user + '@'+ self.ip + " "+ cmd)
+
+        # check for root user otherwise there are commands that must be run with sudo to work non-root
+        cmd = self.as_user(cmd)
+
+        return self.ssh_argv(cmd), cmd
+
+    ##############################################################################################
+    #
+    # METHOD: local_argv(cmd)
+    #
+    # DESCRIPTION: Returns the argument list to run cmd on this system, inside the network namespace
+    #              when the shell is for "ns:<name>"
+    #
+    ##############################################################################################
+    def local_argv(self, cmd):
+        """local_argv(cmd):
+           Returns the argument list to run cmd on this system, inside the network namespace
+           when the shell is for "ns:<name>"
+           """
+
+        if not self.netns:
+            return ['/bin/sh', '-c', cmd]
+        sudo = ['sudo'] if os.geteuid() != 0 else []
+        return sudo + ['ip', 'netns', 'exec', self.netns, '/bin/sh', '-c', cmd]
+
+    ##############################################################################################
+    #
+    # METHOD: as_user(cmd)
+    #
+    # DESCRIPTION: Returns cmd as it has to be run on the remote by the login user. For a non-root user
+    #              the sudo policy of the host (see control/sudo.py) decides if it needs sudo.
+    #
+    ##############################################################################################
+    def as_user(self, cmd):
+        """as_user(cmd):
+           Returns cmd as it has to be run on the remote by the login user. For a non-root user
+           the sudo policy of the host (see control/sudo.py) decides if it needs sudo.
+           """
+
+        if self.local or self.user == "root":
+            return cmd
+        return get_sudo_policy(self.ip).wrap(cmd)
+
+    ##############################################################################################
+    #
+    # METHOD: finish(cmd, out, err, perror, redirect_err, decode, timer, status)
+    #
+    # DESCRIPTION: Post process the raw output of a command run by run() or run_async(). Errors exit
+    #              the script unless perror is 0. Returns the output of the command. If a metrics
+    #              timer is passed the call is recorded once the output is decoded.
+    #
+    ##############################################################################################
+    def finish(self, cmd, out, err, perror=1, redirect_err=0, decode=1, timer=None, status=None):
+        """finish(cmd, out, err, perror, redirect_err, decode, timer, status):
+           Post process the raw output of a command run by run() or run_async(). Errors exit
+           the script unless perror is 0. Returns the output of the command. If a metrics
+           timer is passed the call is recorded once the output is decoded.
+           """
+
+        size_out = len(out)
+        size_err = len(err)
 
-            # check for root user otherwise there are commands that must be run differently to work non-root
-            if self.user == "root":
-                stream = Popen(['ssh', self.user +'@' + self.ip, cmd], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-            else:
-                # sadly, as non-root certain commands have certain complaints if not handled correctly.. 
-                # NOTE_TO_SELF: need to do this better.. investigate later good for now
-                if "grep" in cmd or "service" in cmd or "sed" in cmd or "ps" in cmd or "pkill" in cmd or ("ps -e" in cmd and "cd" in cmd):
-                    newcmd = "sudo " +cmd
-                elif "cd" in cmd or "bash" in cmd or "curl" in cmd or "ls" in cmd or ("if" in cmd and "tc" in cmd) or "if" in cmd or "exit" in cmd or "tcpdump" in cmd:
-                    newcmd = cmd
-                elif "bash" in cmd:
-                    newcmd = "sudo -i \"" +cmd+ "\""
-                else:
-                    newcmd = "sudo " +cmd
-                    
-                cmd = newcmd
-                stream = Popen(['ssh', self.user +'@' + self.ip, cmd], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-            
-        # Wait for completion (this is a "run", not a "launch")
-        stream.wait()
         if decode:
             # decode using utf-8
-            out = stream.stdout.read().decode('utf-8')
-            err = stream.stderr.read().decode('utf-8')
-        else:
-            out = stream.stdout.read()
-            err = stream.stderr.read()
+            out = out.decode('utf-8')
+            err = err.decode('utf-8')
+
+        if timer is not None:
+            timer.done(cmd, size_out, size_err, status)
 
         if redirect_err:
             # Make the err be part of the output
             out = out + err
-            err = ""
+            err = "" if decode else b""
             
-        if err != "" and perror:
+        if err and perror:
             # Ruh roh, this is not good.. print out the error
             if self.local:
                 msg=cmd
             else:
                 msg = "ssh " + self.user + '@' + self.ip + " " + cmd
             parms=""
+            if not decode:
+                err = err.decode('utf-8', 'replace')
             sys.exit("\nERROR: " + self.__class__.__name__ + "(" + parms + ") " + msg +  "    " + err.strip() + "\n")
             return ""
             
@@ -173,6 +587,200 @@ class shell:
         else:
             return out
 
+    ##############################################################################################
+    #
+    # METHOD: run(command)
+    #
+    # DESCRIPTION: Run a command locally or remotely and wait for completion. NOTE: For remote accesses this can
+    #              ONLY be used if the remote is set up for passwordless SSH connections.
+    #                 cmd          - command to be run in the shell
+    #                 perror       - If perror is 0, the error will not be printed if the command fails
+    #                 redirect_err - If redirect_err is 1, the output will be redirected (>2) and that stderr will be appended to the output
+    #                                This is needed for some commands like curl that seem to use stderr as normal output.
+    #                 decode       - If 1 then UTF-8 decode will be applied to the read data
+    #                 pcommand     - Add command to the output
+    #
+    ##############################################################################################
+    def run(self, cmd, perror=1, redirect_err=0, decode=1, pcommand=1):
+        """run(command):
+           Run a command locally or remotely and wait for completion. NOTE: For remote accesses this can
+           ONLY be used if the remote is set up for passwordless SSH connections.
+              perror       - If perror is 0, the error will not be printed if the command fails
+              redirect_err - If redirect_err is 1, the output will be redirected (2>&1) and that stderr will be appended to the output
+                             This is needed for some commands like curl that seem to use stderr as normal output.
+              """
+
+        timer = metrics.start(self.ip)
+        argv, cmd = self.prepare(cmd, pcommand)
+        out, err, status = self.execute(argv, cmd, timer)
+
+        return self.finish(cmd, out, err, perror, redirect_err, decode, timer, status)
+
+    ##############################################################################################
+    #
+    # METHOD: execute(argv, cmd, timer)
+    #
+    # DESCRIPTION: Run a prepared command (see prepare()) and wait for completion, through the resident
+    #              agent if there is one, otherwise ssh (or locally). Returns (out, err, exit status) with
+    #              the output as bytes.
+    #
+    ##############################################################################################
+    def execute(self, argv, cmd, timer):
+        """execute(argv, cmd, timer):
+           Run a prepared command (see prepare()) and wait for completion, through the resident
+           agent if there is one, otherwise ssh (or locally). Returns (out, err, exit status) with
+           the output as bytes.
+           """
+
+        # One round trip to the resident agent if there is one
+        transport = self.transport()
+        if transport is not None:
+            timer.connected("agent")
+            rc, out, err = transport.run(cmd)
+            if rc is not None:
+                timer.executed()
+                return out, err, rc
+            log("Agent on " + self.ip + " failed (" + err.decode('utf-8') + "), using ssh")
+
+        timer.connected("local" if self.local else "ssh")
+        stream = Popen(argv, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+            
+        # Wait for completion (this is a "run", not a "launch"). Both pipes are drained while the
+        # command runs, waiting first hangs forever once the output is larger than the pipe buffer
+        out, err = stream.communicate()
+        timer.executed()
+
+        return out, err, stream.returncode
+
+    ##############################################################################################
+    #
+    # METHOD: batch()
+    #
+    # DESCRIPTION: Returns a command_batch for this shell. Commands queued on it are all run in one
+    #              remote execution (one ssh round trip) but are reported one by one.
+    #
+    #              Usage:
+    #                 results = remotesys.batch().add("rm -f x.pcap").add("tc qdisc", 0).run()
+    #                 results[1]['stdout'], results[1]['rc'], results[1]['duration']
+    #
+    ##############################################################################################
+    def batch(self):
+        """batch():
+           Returns a command_batch for this shell. Commands queued on it are all run in one
+           remote execution (one ssh round trip) but are reported one by one.
+           """
+
+        return command_batch(self)
+
+    ##############################################################################################
+    #
+    # METHOD: run_stream(command)
+    #
+    # DESCRIPTION: Run a command locally or remotely and hand back its output line by line while it runs.
+    #              This is a generator so large outputs (tshark dumps, tc -s, ps -e) are processed as they
+    #              arrive instead of being buffered in memory. stderr is drained in the background and
+    #              checked once the command completes (same perror handling as run()).
+    #                 cmd          - command to be run in the shell
+    #                 perror       - If perror is 0, the error will not be printed if the command fails
+    #                 redirect_err - If redirect_err is 1, stderr is merged into the yielded lines
+    #                 pcommand     - Add command to the output
+    #                 keepends     - If keepends is 1, lines are yielded with their line ending (the last
+    #                                line has none if the output did not end with one)
+    #
+    #              Stopping the iteration early terminates the command.
+    #
+    #              Usage:
+    #                 for line in remotesys.run_stream("tshark -r big.pcap"):
+    #                     ...
+    #
+    ##############################################################################################
+    def run_stream(self, cmd, perror=1, redirect_err=0, pcommand=1, keepends=0):
+        """run_stream(command):
+           Run a command locally or remotely and hand back its output line by line while it runs.
+           This is a generator so large outputs (tshark dumps, tc -s, ps -e) are processed as they
+           arrive instead of being buffered in memory. stderr is drained in the background and
+           checked once the command completes (same perror handling as run()).
+              perror       - If perror is 0, the error will not be printed if the command fails
+              redirect_err - If redirect_err is 1, stderr is merged into the yielded lines
+              keepends     - If keepends is 1, lines are yielded with their line ending
+           Stopping the iteration early terminates the command.
+           """
+
+        timer = metrics.start(self.ip)
+        argv, cmd = self.prepare(cmd, pcommand)
+        timer.connected("local" if self.local else "ssh")
+        stream = Popen(argv, stdin=DEVNULL, stdout=PIPE, stderr=STDOUT if redirect_err else PIPE)
+        size_out = 0
+
+        # Keep stderr moving so a chatty command cannot block on it while we read stdout
+        errors = []
+        drain = None
+        if not redirect_err:
+            drain = threading.Thread(target=lambda: errors.append(stream.stderr.read()))
+            drain.daemon = True
+            drain.start()
+
+        try:
+            for line in stream.stdout:
+                size_out += len(line)
+                line = line.decode('utf-8', 'replace')
+                yield line if keepends else line.rstrip("\r\n")
+            stream.wait()
+        finally:
+            # The caller may have stopped early, do not leave the command running. Closing our end of
+            # stdout also takes out any child of the shell still writing to it (SIGPIPE)
+            if stream.poll() is None:
+                stream.terminate()
+            stream.stdout.close()
+            stream.wait()
+            if drain is not None:
+                drain.join()
+            timer.executed()
+
+            # Output was decoded line by line as it was consumed, so there is no decode phase to time. This
+            # is recorded (and the timer leaves the stack) even when the caller stopped early
+            timer.done(cmd, size_out, sum(len(error) for error in errors), stream.returncode)
+
+        self.finish(cmd, b"", b"".join(errors), perror, 0, 1)
+
+    ##############################################################################################
+    #
+    # METHOD: run_async(command)
+    #
+    # DESCRIPTION: asyncio version of run(). This is a coroutine which runs the command locally or remotely
+    #              without blocking the event loop so many commands (on many systems) can be in flight at
+    #              once. The arguments and the returned output are the same as run(). See run_many() to fan
+    #              commands out across the testbed without writing any asyncio code.
+    #
+    ##############################################################################################
+    async def run_async(self, cmd, perror=1, redirect_err=0, decode=1, pcommand=1):
+        """run_async(command):
+           asyncio version of run(). This is a coroutine which runs the command locally or remotely
+           without blocking the event loop so many commands (on many systems) can be in flight at
+           once. The arguments and the returned output are the same as run(). See run_many() to fan
+           commands out across the testbed without writing any asyncio code.
+           """
+
+        timer = metrics.start(self.ip)
+        argv, cmd = self.prepare(cmd, pcommand)
+
+        # The agent call blocks so hand it to a worker thread
+        transport = self.transport()
+        if transport is not None:
+            timer.connected("agent")
+            rc, out, err = await asyncio.get_running_loop().run_in_executor(None, transport.run, cmd)
+            if rc is not None:
+                timer.executed()
+                return self.finish(cmd, out, err, perror, redirect_err, decode, timer, rc)
+            log("Agent on " + self.ip + " failed (" + err.decode('utf-8') + "), using ssh")
+
+        timer.connected("local" if self.local else "ssh")
+        stream = await asyncio.create_subprocess_exec(*argv, stdin=DEVNULL, stdout=PIPE, stderr=PIPE)
+        out, err = await stream.communicate()
+        timer.executed()
+
+        return self.finish(cmd, out, err, perror, redirect_err, decode, timer, stream.returncode)
+
     ##############################################################################################
     #
     # METHOD: run_wpasswd(command)
@@ -275,6 +883,26 @@ class shell:
 #        else:
 #            return out
                 
+    # #############################################################################################
+    #
+    # METHOD: pid_wrapper(cmd)
+    #
+    # DESCRIPTION: Wrap a command so the remote shell reports its pid and process group id on the first
+    #              line of stdout ("PATI_PID <pid> <pgid>") and then execs the command in its place. The
+    #              sshd session makes the remote shell a process group leader so everything the command
+    #              starts can be signalled as one group.
+    #
+    # #############################################################################################
+    def pid_wrapper(self, cmd):
+        """pid_wrapper(cmd):
+           Wrap a command so the remote shell reports its pid and process group id on the first
+           line of stdout ("PATI_PID <pid> <pgid>") and then execs the command in its place. The
+           sshd session makes the remote shell a process group leader so everything the command
+           starts can be signalled as one group.
+           """
+
+        return 'echo PATI_PID $$ $(ps -o pgid= -p $$); exec sh -c ' + shlex.quote(cmd)
+
     # #############################################################################################
     #
     # METHOD: launch(command)
@@ -302,32 +930,39 @@ class shell:
            Return a stream which may be passed to launch.pid(stream) and launch.stop(stream)
               """
 
-        # check for a local
-        if self.local:
-            # Run it locally
-            stream = Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        else:
-            # run remote if root just go with it
-            if self.user == "root":
-                stream = Popen(['ssh', self.user +'@' + self.ip, cmd], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-            else:
-                # sadly, as non-root certain commands have certain complaints if not handled correctly.. 
-                # NOTE_TO_SELF need to do this better.. okay for now.. revisit
-                if "grep" in cmd or "service" in cmd or "sed" in cmd or "ps" in cmd or "pkill" in cmd or ("ps -e" in cmd and "cd" in cmd):
-                    newcmd = "sudo " +cmd
-                elif "cd" in cmd or "bash" in cmd or "curl" in cmd or "ls" in cmd or ("if" in cmd and "tc" in cmd) or "if" in cmd or "exit" in cmd:
-                    newcmd = cmd
-                elif "bash" in cmd:
-                    newcmd = "sudo -i \"" +cmd+ "\""
-                else:
-                    newcmd = "sudo " +cmd
-                    
-                cmd = newcmd
-                stream = Popen(['ssh', self.user +'@' + self.ip, cmd], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        # The time to start the program is recorded (exec time), not its run
+        timer = metrics.start(self.ip)
+
+        # non-root remote users run some commands with sudo (same policy as run())
+        cmd = self.as_user(cmd)
 
         if no_check == 1:
-            # this is a no check return immediate
+            # this is a no check return immediate (the process is not tracked so it is not wrapped either)
+            argv = self.local_argv(cmd) if self.local else self.ssh_argv(cmd)
+            timer.connected("local" if self.local else "ssh")
+            stream = Popen(argv, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+            timer.executed()
+            timer.done(cmd, 0, 0, None)
             return stream
+
+        if self.local:
+            # Run it locally as the leader of its own process group so the pid and pgid are known up front
+            timer.connected("local")
+            stream = Popen(self.local_argv(cmd), stdin=PIPE, stdout=PIPE, stderr=PIPE, start_new_session=True)
+            stream.remote_pid = str(stream.pid)
+            stream.remote_pgid = str(stream.pid)
+        else:
+            # Run it remotely through a wrapper which reports the remote pid and process group before it
+            # execs the command (the exec keeps the pid), then pick that report off the front of stdout
+            argv = self.ssh_argv(self.pid_wrapper(cmd))
+            timer.connected("ssh")
+            stream = Popen(argv, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+            stream.remote_pid = ""
+            stream.remote_pgid = ""
+            report = re.match(r'PATI_PID (\d+) +(\d+)', stream.stdout.readline().decode('utf-8', 'replace').strip())
+            if report:
+                stream.remote_pid = report.group(1)
+                stream.remote_pgid = report.group(2)
         
         # Keep track of the streams that we have launched and the corresponding command
         self.launched_cmds[stream] = cmd
@@ -337,34 +972,45 @@ class shell:
             # If script bombs or ctrl-c's, make sure we kill the local or remote process that got launched
             atexit.register(self.stop, stream)
 
-        # pass redirect_err to pid because it will execute a sys exit on fail and if
-        # we allow retries upstream this (redirect_err==1) will prevent exit on first err
-        pid = self.pid(stream, redirect_err)
-        if pid == "":
-            # Sometimes it taks an extra second to launch.  Wait and try again
-            sleep(1)
-            pid = self.pid(stream)
-            if pid == "":
-                # Ruh roh, it didn't start
-                stream.terminate()
-                out = stream.stdout.read().decode('utf-8')
-                err = stream.stderr.read().decode('utf-8')
-                msg = "ssh " + self.user + '@' + self.ip + " " + cmd + "    " + err.strip() + " - " + out.strip()
-                parms=""
-                log("ERROR", msg)
-                
-                if no_check == 2:
-                    return ""
-                else:
-                    sys.exit("\nERROR: " + self.__class__.__name__ + "(" + parms + ") " + msg + "\n")
+        # A program which exits right away with an error (a bad command or arguments) did not start.
+        # The pid report already proves the program was started so by default this is only a poll,
+        # LAUNCH_CHECK seconds may be set to also watch it for that long. One which already ran to
+        # completion cleanly (a short job) did start, its output is left for the caller to read
+        check = float(getOpt('LAUNCH_CHECK') or 0)
+        if check > 0:
+            try:
+                stream.wait(check)
+            except TimeoutExpired:
+                pass
+
+        rc = stream.poll()
+        if stream.remote_pid == "" or (rc is not None and rc != 0):
+            # Ruh roh, it didn't start
+            stream.terminate()
+            out = stream.stdout.read().decode('utf-8')
+            err = stream.stderr.read().decode('utf-8')
+            timer.executed()
+            timer.done(cmd, len(out), len(err), stream.poll())
+            msg = "ssh " + self.user + '@' + self.ip + " " + cmd + "    " + err.strip() + " - " + out.strip()
+            parms=""
+            log("ERROR", msg)
+            del self.launched_cmds[stream]
+            
+            if no_check == 2:
+                return ""
+            else:
+                sys.exit("\nERROR: " + self.__class__.__name__ + "(" + parms + ") " + msg + "\n")
         else:
+            timer.executed()
+            timer.done(cmd, 0, 0, None)
             if self.local:
                 msg = cmd
             else:
                 msg = 'ssh ' + self.user + '@' + self.ip + ' ' + cmd
                 
             if getOpt('VERBOSE'):
-                log("Launched: " + str(msg))
+                log("Launched: " + str(msg) + "  (pid " + stream.remote_pid + " pgid " + stream.remote_pgid + ")" +
+                    ("  already done" if rc is not None else ""))
 
         return stream
         
@@ -374,7 +1020,9 @@ class shell:
     # MODULE: pid(stream)
     #
     # DESCRIPTION: Get the pid of the launched program (for remote, the remote program, NOT the local ssh
-    #              that ran it) In a multi-client environment we have to grep the PID so be careful here
+    #              that ran it). Streams started by launch() carry the pid captured at spawn time so this
+    #              is a lookup, "" is returned once the program has exited. For any other stream we have
+    #              to grep the PID so be careful here
     #
     #                 stream       - original stream identifier from the launch
     #                 pid          - PID for the process created
@@ -385,13 +1033,22 @@ class shell:
     def pid(self, stream, pid=0, redirect_err=0):
         """pid(stream):
            Get the pid of the launched program (for remote, the remote program, NOT the local ssh
-           that ran it) In a multi-client environment we have to grep the PID so be careful here
+           that ran it). Streams started by launch() carry the pid captured at spawn time so this
+           is a lookup, "" is returned once the program has exited. For any other stream we have
+           to grep the PID so be careful here
               stream       - original stream identifier from the launch
               pid          - PID for the process created
               redirect_err - If redirect_err is 1, the output will be redirected (>2) and that stderr will be appended to the output
                              This is needed for some commands like curl that seem to use stderr as normal output.
                              """
 
+        # launch() recorded the pid when it started the program. The program is alive for as long as
+        # the local process (or the ssh carrying it) is, so no remote lookup is needed
+        if hasattr(stream, 'remote_pid'):
+            if stream.poll() is None:
+                return stream.remote_pid
+            return ""
+
         # retrieve the command from the pushed command stream
         cmd = self.launched_cmds[stream]
         
@@ -425,19 +1082,148 @@ class shell:
 
     ##############################################################################################
     #
-    # METHOD: stop(stream, proxyport)
+    # METHOD: signal_groups(streams, sig)
+    #
+    # DESCRIPTION: Send a signal (TERM, KILL, INT, ...) to the whole process group of each of the launched
+    #              programs. For a remote this is a single command however many programs there are.
+    #
+    ##############################################################################################
+    def signal_groups(self, streams, sig="TERM"):
+        """signal_groups(streams, sig):
+           Send a signal (TERM, KILL, INT, ...) to the whole process group of each of the launched
+           programs. For a remote this is a single command however many programs there are.
+           """
+
+        if len(streams) == 0:
+            return
+
+        if self.local:
+            for stream in streams:
+                try:
+                    os.killpg(int(stream.remote_pgid), getattr(signal, "SIG" + sig))
+                except ProcessLookupError:
+                    pass
+                except PermissionError:
+                    # the program was started with sudo
+                    self.run("sudo kill -" + sig + " -- -" + stream.remote_pgid, 0)
+            return
+
+        # Group leaders (always the case under sshd) are signalled as a group, anything else by pid and
+        # children so we never take out somebody else's group. The sudo policy only looks at the start
+        # of a command so it is applied to each command of the chain on its own
+        groups = []
+        cmds = []
+        for stream in streams:
+            if stream.remote_pgid == stream.remote_pid:
+                groups.append("-" + stream.remote_pgid)
+            else:
+                cmds.append(self.as_user("pkill -" + sig + " -P " + stream.remote_pid))
+                cmds.append(self.as_user("kill -" + sig + " " + stream.remote_pid))
+        if groups:
+            cmds.insert(0, self.as_user("kill -" + sig + " -- " + " ".join(groups)))
+
+        # Some may already be gone, that is fine
+        self.run("; ".join(cmds), 0)
+
+    ##############################################################################################
+    #
+    # METHOD: signal_group(stream, sig)
+    #
+    # DESCRIPTION: Send a signal (TERM, KILL, INT, ...) to the whole process group of a launched program
+    #              with a single command
+    #
+    ##############################################################################################
+    def signal_group(self, stream, sig="TERM"):
+        """signal_group(stream, sig):
+           Send a signal (TERM, KILL, INT, ...) to the whole process group of a launched program
+           with a single command
+           """
+
+        self.signal_groups([stream], sig)
+
+    ##############################################################################################
+    #
+    # METHOD: end_groups(streams, grace)
+    #
+    # DESCRIPTION: Terminate the process groups of the launched programs. They get a TERM, then we wait
+    #              for them to exit (the local process/ssh exiting is the exit event) for up to grace
+    #              seconds, anything still running after that gets a KILL. Returns the streams which
+    #              would not die.
+    #
+    ##############################################################################################
+    def end_groups(self, streams, grace):
+        """end_groups(streams, grace):
+           Terminate the process groups of the launched programs. They get a TERM, then we wait
+           for them to exit (the local process/ssh exiting is the exit event) for up to grace
+           seconds, anything still running after that gets a KILL. Returns the streams which
+           would not die.
+           """
+
+        running = [stream for stream in streams if stream.poll() is None]
+        for sig, wait in [("TERM", grace), ("KILL", max(grace, 1.0))]:
+            if len(running) == 0:
+                break
+
+            if sig == "KILL" and getOpt('VERBOSE'):
+                for stream in running:
+                    log("Unable to TERM " + self.launched_cmds.get(stream, "") + " within " + str(grace) + "s   Trying KILL")
+
+            self.signal_groups(running, sig)
+
+            # Wait on the exit of each, all against the same deadline
+            deadline = time.time() + wait
+            for stream in running:
+                try:
+                    stream.wait(max(0.0, deadline - time.time()))
+                except TimeoutExpired:
+                    pass
+            running = [stream for stream in running if stream.poll() is None]
+
+        for stream in running:
+            log("ERROR: PID " + stream.remote_pid + " (" + self.launched_cmds.get(stream, "") + ") did NOT stop")
+        return running
+
+    ##############################################################################################
+    #
+    # METHOD: release(stream)
+    #
+    # DESCRIPTION: Reap a stopped stream, stop tracking it and return its final output
+    #
+    ##############################################################################################
+    def release(self, stream):
+        """release(stream):
+           Reap a stopped stream, stop tracking it and return its final output
+           """
+
+        if stream.poll() is None:
+            stream.terminate()
+        output = ""
+        if not self.local:
+            output = stream.stdout.read().decode('utf-8')
+        del self.launched_cmds[stream]
+        return output
+
+    ##############################################################################################
+    #
+    # METHOD: stop(stream, proxyport, grace)
     #
     # DESCRIPTION: Stop the remote or local launched program and terminate the Popen stream if it 
     #              hasn't been stopped already This is ALWAYS called from atexit for cleanup so we 
     #              have to check it if has already been terminated
     #
+    #              The whole process group of the program gets a TERM and we wait up to grace seconds
+    #              (default STOP_GRACE) for it to exit before escalating to KILL. proxyport is no longer
+    #              needed (the process group covers it) and is kept for compatibility.
+    #
     #              The final output from the program is returned
     #
     ##############################################################################################
-    def stop(self, stream, proxyport=""):
-        """ stop(stream, proxyport)
+    def stop(self, stream, proxyport="", grace=None):
+        """ stop(stream, proxyport, grace)
             Stop the remote or local launched program and terminate the Popen stream if it hasn't been stopped already
             This is ALWAYS called from atexit for cleanup so we have to check it if has already been terminated
+            The whole process group of the program gets a TERM and we wait up to grace seconds (default STOP_GRACE)
+            for it to exit before escalating to KILL. proxyport is no longer needed and is kept for compatibility.
             The final output from the program is returned
             """
 
@@ -450,59 +1236,100 @@ class shell:
                 msg =  "STOPPING: " + self.launched_cmds[stream]
                 call_frame = inspect.getouterframes(inspect.currentframe(), 2)
                 log("TRACE      : " + self.__class__.__name__ + "." + call_frame[0][3] + "(): " + msg)
-                
-            # check if we are running as local
-            if not self.local:
-                # nope.. proccess as a remote.. get the PID
-                pid = self.pid(stream, str(proxyport))
-                if pid != "":
-                    # Using pkill -P kills the process and all of it's children (in case a script was launched which started other programs)
-                    self.run("pkill -TERM -P " + pid)
-
-                    # Make sure the kill worked.  But.. check the original PID, we cannot assume
-                    # we are in a single instance environment. If not, murder it.. 
-                    pid = self.pid(stream, str(proxyport))
-                    
-                    if pid != "":
-                        # Give it a second
-                        time.sleep(1)
-                        if getOpt('VERBOSE'):                                                                                     
-                            log("Unable to pkill " + self.launched_cmds[stream] + "   Trying kill -9") 
-                        self.run("sudo pkill -9 -P " + pid)
-                        pid = self.pid(stream, str(proxyport))
-
-                    if pid != "":
-                        # last ditch effort                                                                                       
-                        process = re.match(r'(\w+) .*', self.launched_cmds[stream])
-                        if process and process.group(1):
-                            self.run("pkill -SIGTERM " +process.group(1))
-                        pid = self.pid(stream, str(proxyport))
-                        if pid != "":
-                            log("ERROR: PID " +str(pid)+ " did NOT stop")
-            else:
-                # localhost needs special handling
-                if proxyport != "":
-                    pid = self.pid(stream, str(proxyport))
-                    temp = self.run("ps ax | grep " +str(proxyport))
-                    pids = pid.split("\n")
-                    for elem in pids:
-                        if elem != "":
-                            self.run("sudo pkill -TERM -P " + elem)
-                    pid = self.pid(stream, str(proxyport))
-                    temp = self.run("ps ax | grep " +str(proxyport))
-                    for elem in pids:
-                        if elem != "":
-                            self.run("sudo pkill -9 -P " + elem)
-            
-            stream.terminate()
-            output = ""
-            if not self.local:
-                output = stream.stdout.read().decode('utf-8')
-            del self.launched_cmds[stream]
+
+            if grace is None:
+                grace = float(getOpt('STOP_GRACE'))
+            self.end_groups([stream], grace)
+
+            output = self.release(stream)
             trace_exit()
             return(output)
         trace_exit()
+
+    ##############################################################################################
+    #
+    # METHOD: stop_all(streams, grace)
+    #
+    # DESCRIPTION: Stop every program launched by this shell (or just those in streams) together. All of
+    #              them are signalled in one batched command and share the same grace period, so stopping
+    #              many programs on a host costs about the same as stopping one.
+    #
+    #              Returns a dictionary of {<stream> : <final output>}
+    #
+    ##############################################################################################
+    def stop_all(self, streams=None, grace=None):
+        """stop_all(streams, grace):
+           Stop every program launched by this shell (or just those in streams) together. All of
+           them are signalled in one batched command and share the same grace period, so stopping
+           many programs on a host costs about the same as stopping one.
+           Returns a dictionary of {<stream> : <final output>}
+           """
+
+        trace_enter()
+        if streams is None:
+            streams = list(self.launched_cmds.keys())
+        streams = [stream for stream in streams if stream in self.launched_cmds]
+
+        if getOpt('VERBOSE'):
+            for stream in streams:
+                log("STOPPING: " + self.launched_cmds[stream])
+
+        if grace is None:
+            grace = float(getOpt('STOP_GRACE'))
+        self.end_groups(streams, grace)
+
+        outputs = {}
+        for stream in streams:
+            outputs[stream] = self.release(stream)
+        trace_exit()
+        return outputs
                            
+    # #############################################################################################
+    #
+    # METHOD: copy_argv(source, dest, put, compress, resume)
+    #
+    # DESCRIPTION: Returns the Popen argument list to copy a file from (or to, if put is 1) this system
+    #                 source   - file to copy (remote path for a get, local path for a put)
+    #                 dest     - where to put it (local path for a get, remote path for a put)
+    #                 put      - If 1 the copy goes from the local system to this system
+    #                 compress - If 1 the data is compressed on the wire
+    #                 resume   - If 1 rsync is used so an interrupted or repeated copy only moves the
+    #                            missing/changed parts (falls back to scp if rsync is not installed)
+    #
+    # #############################################################################################
+    def copy_argv(self, source, dest, put=0, compress=0, resume=0):
+        """copy_argv(source, dest, put, compress, resume):
+           Returns the Popen argument list to copy a file from (or to, if put is 1) this system
+              source   - file to copy (remote path for a get, local path for a put)
+              dest     - where to put it (local path for a get, remote path for a put)
+              put      - If 1 the copy goes from the local system to this system
+              compress - If 1 the data is compressed on the wire
+              resume   - If 1 rsync is used so an interrupted or repeated copy only moves the
+                         missing/changed parts (falls back to scp if rsync is not installed)
+              """
+
+        if self.local:
+            return ['cp', source, dest]
+
+        remote = self.user + '@' + self.ip + ":"
+        if put:
+            dest = remote + dest
+        else:
+            source = remote + source
+
+        if resume and shutil.which('rsync'):
+            # --partial keeps what made it across so the next copy only sends the difference, --stats
+            # reports how much that was (see copy_files_async())
+            argv = ['rsync', '--partial', '--stats', '-e', " ".join(['ssh'] + [shlex.quote(opt) for opt in self.ssh_options()])]
+            if compress:
+                argv.append('-z')
+            return argv + [source, dest]
+
+        argv = ['scp'] + self.ssh_options()
+        if compress:
+            argv.append('-C')
+        return argv + [source, dest]
+
     # #############################################################################################
     #
     # METHOD: get_file(file)
@@ -527,15 +1354,17 @@ class shell:
             if getOpt('VERBOSE'):
                 log("Retrieving " + self.ip + ":" + file)
 
-            if self.user == "root":
-                run=Popen(['scp', 'root@' + self.ip + ":" + file, '.'], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-            else:
-                run=Popen(['scp', self.user + '@' + self.ip + ":" + file, '.'], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-            run.wait()
+            timer = metrics.start(self.ip)
+            argv = ['scp'] + self.ssh_options() + [self.user + '@' + self.ip + ":" + file, '.']
+            timer.connected("scp")
+            run=Popen(argv, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+            out, err = run.communicate()
+            timer.executed()
+            timer.done("scp " + file, len(out), len(err), run.returncode)
             
             # for now decode as utf-8.. this may change
-            out = run.stdout.read().decode('utf-8')
-            err = run.stderr.read().decode('utf-8')
+            out = out.decode('utf-8')
+            err = err.decode('utf-8')
             if err != "":
                 # Ruh roh, print out the error
                 msg='scp ' + 'root@' + self.ip + ":" + "." + "     " + err.strip()
@@ -567,16 +1396,18 @@ class shell:
         if getOpt('VERBOSE'):
             log("Sending local file " + local_file + " to " + self.ip + ":" + dest_path)
 
+        timer = metrics.start(self.ip)
+
         # test if we are local
         if not self.local:
             # nope.. remote transfer
-            if self.user == "root":
-                run=Popen(['scp', local_file, 'root@' + self.ip + ":" + dest_path], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-            else:
-                run=Popen(['scp', local_file, self.user + '@' + self.ip + ":" + dest_path], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+            argv = ['scp'] + self.ssh_options() + [local_file, self.user + '@' + self.ip + ":" + dest_path]
+            timer.connected("scp")
+            run=Popen(argv, stdin=PIPE, stdout=PIPE, stderr=PIPE)
 
         else:
             # local transfer
+            timer.connected("local")
             try:
                 run=Popen(['cp', local_file, dest_path], stdin=PIPE, stdout=PIPE, stderr=PIPE)
             except (RuntimeError, TypeError, NameError):
@@ -586,11 +1417,13 @@ class shell:
                 print("ErrorMsg:     " + str(sys.exc_info()[0]))
                 input("Press Enter to proceed")
             
-        run.wait()
+        out, err = run.communicate()
+        timer.executed()
+        timer.done(("scp " if not self.local else "cp ") + local_file, len(out), len(err), run.returncode)
             
         # run as decode utf-8 for now.. may change later
-        out = run.stdout.read().decode('utf-8')
-        err = run.stderr.read().decode('utf-8')
+        out = out.decode('utf-8')
+        err = err.decode('utf-8')
 
         if self.local and "are the same file" in err:
             err = ""
@@ -604,3 +1437,376 @@ class shell:
         else:
             return ""
         
+
+
+# #################################################################################################
+#
+# MODULE (Class): command_batch
+#
+# DESCRIPTION   : A list of commands for one shell which are sent in a single remote execution and
+#                 reported one by one. Each command runs in its own subshell (so a cd or an exit only
+#                 affects that command, just like separate run() calls) with the non-root sudo policy
+#                 applied to it on its own. Markers written to stdout and stderr around every command
+#                 split the output back up; they carry a random token so command output cannot fake them.
+#
+#                 run() returns one dictionary per queued command:
+#                    {'cmd' : <command>, 'stdout' : <str>, 'stderr' : <str>, 'rc' : <exit status>,
+#                     'duration' : <seconds on the remote>}
+#                 rc and duration are None for commands that did not run (stop_on_error).
+#
+# Usage:
+#
+# batch = remotesys.batch()
+# for eth in eths:
+#     batch.add("tc qdisc del dev " + eth + " root", perror=0)
+# for result in batch.run():
+#     ...
+#
+# #################################################################################################
+class command_batch:
+
+    def __init__(self, host_shell):
+        """__init__(host_shell):
+           This is the initialization constructor, host_shell is the shell the commands are run on
+           """
+
+        self.shell = host_shell
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    # #############################################################################################
+    #
+    # METHOD: add(cmd, perror)
+    #
+    # DESCRIPTION: Queue a command. If perror is 0 its stderr output does not end the script. Returns the
+    #              batch so calls can be chained.
+    #
+    # #############################################################################################
+    def add(self, cmd, perror=1):
+        """add(cmd, perror):
+           Queue a command. If perror is 0 its stderr output does not end the script. Returns the
+           batch so calls can be chained.
+           """
+
+        self.commands.append([cmd, perror])
+        return self
+
+    # #############################################################################################
+    #
+    # METHOD: script(token, stop_on_error)
+    #
+    # DESCRIPTION: Returns the shell script which runs the queued commands between markers
+    #
+    # #############################################################################################
+    def script(self, token, stop_on_error=0):
+        """script(token, stop_on_error):
+           Returns the shell script which runs the queued commands between markers
+           """
+
+        lines = []
+        for idx, (cmd, perror) in enumerate(self.commands):
+            begin = "@@PATI_BEGIN " + token + " " + str(idx)
+            end = "@@PATI_END " + token + " " + str(idx)
+            lines.append("echo '" + begin + "'; echo '" + begin + "' >&2; s=$(date +%s%N)")
+            lines.append("(\n" + self.shell.as_user(cmd) + "\n)")
+            lines.append("r=$?; e=$(date +%s%N); printf '\n%s\n' \"" + end + " $r $s $e\"; printf '\n%s\n' '" + end + "' >&2")
+            if stop_on_error:
+                lines.append("[ $r -eq 0 ] || exit $r")
+        return "\n".join(lines)
+
+    # #############################################################################################
+    #
+    # METHOD: sections(text, token)
+    #
+    # DESCRIPTION: Split the output of the script back up. Returns {idx : (output, [rc, start, end])}
+    #
+    # #############################################################################################
+    def sections(self, text, token):
+        """sections(text, token):
+           Split the output of the script back up. Returns {idx : (output, [rc, start, end])}
+           """
+
+        found = {}
+        pattern = r'@@PATI_BEGIN ' + token + r' (\d+)\n(.*?)\n@@PATI_END ' + token + r' \1( \S+ \S+ \S+)?\n'
+        for match in re.finditer(pattern, text, re.DOTALL):
+            found[int(match.group(1))] = (match.group(2), (match.group(3) or "").split())
+        return found
+
+    # #############################################################################################
+    #
+    # METHOD: run(stop_on_error, pcommand)
+    #
+    # DESCRIPTION: Run the queued commands in one remote execution and return the list of per command
+    #              results (see the class description). A command which wrote to stderr ends the script
+    #              unless it was added with perror=0, the same as run().
+    #                 stop_on_error - If 1 the commands after the first one failing (rc != 0) are not run
+    #                 pcommand      - If 1 and VERBOSE is set the commands are logged
+    #
+    # #############################################################################################
+    def run(self, stop_on_error=0, pcommand=1):
+        """run(stop_on_error, pcommand):
+           Run the queued commands in one remote execution and return the list of per command
+           results (see the class description). A command which wrote to stderr ends the script
+           unless it was added with perror=0, the same as run().
+              stop_on_error - If 1 the commands after the first one failing (rc != 0) are not run
+              pcommand      - If 1 and VERBOSE is set the commands are logged
+           """
+
+        if len(self.commands) == 0:
+            return []
+
+        host = self.shell
+        token = os.urandom(6).hex()
+        script = self.script(token, stop_on_error)
+
+        if pcommand and getOpt('VERBOSE'):
+            where = "" if host.local else "ssh " + host.user + "@" + host.ip + " "
+            log(where + "batch: " + " ; ".join(cmd for cmd, perror in self.commands))
+
+        timer = metrics.start(host.ip)
+        argv = host.local_argv(script) if host.local else host.ssh_argv(script)
+        out, err, status = host.execute(argv, script, timer)
+
+        out = out.decode('utf-8', 'replace')
+        err = err.decode('utf-8', 'replace')
+        timer.done("batch " + self.commands[0][0], len(out), len(err), status)
+
+        outputs = self.sections(out, token)
+        errors = self.sections(err, token)
+
+        results = []
+        for idx, (cmd, perror) in enumerate(self.commands):
+            stdout, stamps = outputs.get(idx, ("", []))
+            stderr = errors.get(idx, ("", []))[0]
+            rc = duration = None
+            if len(stamps) == 3:
+                rc = int(stamps[0])
+                if stamps[1].isdigit() and stamps[2].isdigit():
+                    duration = (int(stamps[2]) - int(stamps[1])) / 1e9
+            results.append({'cmd' : cmd, 'stdout' : stdout.strip(), 'stderr' : stderr.strip(), 'rc' : rc, 'duration' : duration})
+
+            if stderr.strip() and perror:
+                msg = cmd if host.local else "ssh " + host.user + '@' + host.ip + " " + cmd
+                sys.exit("\nERROR: " + host.__class__.__name__ + "() " + msg + "    " + stderr.strip() + "\n")
+
+        # Anything outside the markers (like ssh failing to connect) belongs to no command
+        if len(outputs) == 0 and err.strip():
+            log("ERROR", "batch on " + host.ip + " did not run: " + err.strip())
+
+        return results
+
+# #################################################################################################
+#
+# METHOD: run_many_async(commands, perror, redirect_err, decode)
+#
+# DESCRIPTION: Coroutine which runs every command concurrently and returns the per host results.
+#                 commands - dictionary of {<shell object> : <command>}
+#              Returns a dictionary of {<shell object> : <output>}
+#
+# #################################################################################################
+async def run_many_async(commands, perror=1, redirect_err=0, decode=1):
+    """run_many_async(commands, perror, redirect_err, decode):
+       Coroutine which runs every command concurrently and returns the per host results.
+          commands - dictionary of {<shell object> : <command>}
+       Returns a dictionary of {<shell object> : <output>}
+       """
+
+    hosts = list(commands.keys())
+    outputs = await asyncio.gather(*[host.run_async(commands[host], perror, redirect_err, decode) for host in hosts])
+    return dict(zip(hosts, outputs))
+
+# #################################################################################################
+#
+# METHOD: run_many(commands, perror, redirect_err, decode)
+#
+# DESCRIPTION: Run a command on each of several systems at the same time and wait for all of them. The
+#              wall time is that of the slowest system rather than the sum of all of them.
+#                 commands - dictionary of {<shell object> : <command>}
+#              Returns a dictionary of {<shell object> : <output>}
+#
+#              Usage:
+#                 out = run_many({server_shell : "tc qdisc", client_shell : "tc qdisc"})
+#                 log(out[server_shell])
+#
+# #################################################################################################
+def run_many(commands, perror=1, redirect_err=0, decode=1):
+    """run_many(commands, perror, redirect_err, decode):
+       Run a command on each of several systems at the same time and wait for all of them. The
+       wall time is that of the slowest system rather than the sum of all of them.
+          commands - dictionary of {<shell object> : <command>}
+       Returns a dictionary of {<shell object> : <output>}
+       """
+
+    if len(commands) == 0:
+        return {}
+
+    # Open the ssh masters (and agents) up front so the coroutines do not block the loop doing it
+    for host in commands.keys():
+        host.ssh_options()
+        host.transport()
+
+    return asyncio.run(run_many_async(commands, perror, redirect_err, decode))
+
+# #################################################################################################
+#
+# METHOD: copy_files_async(jobs, parallel, compress, resume)
+#
+# DESCRIPTION: Coroutine which runs the copies in jobs with at most parallel of them in flight. Each job
+#              is (<shell object>, source, dest, put). Returns a list of per file results, see get_files()
+#
+# #################################################################################################
+async def copy_files_async(jobs, parallel=4, compress=0, resume=0):
+    """copy_files_async(jobs, parallel, compress, resume):
+       Coroutine which runs the copies in jobs with at most parallel of them in flight. Each job
+       is (<shell object>, source, dest, put). Returns a list of per file results, see get_files()
+       """
+
+    gate = asyncio.Semaphore(max(1, int(parallel)))
+
+    async def copy_one(host, source, dest, put):
+        async with gate:
+            argv = host.copy_argv(source, dest, put, compress, resume)
+            start = time.time()
+            stream = await asyncio.create_subprocess_exec(*argv, stdin=DEVNULL, stdout=PIPE, stderr=PIPE)
+            out, err = await stream.communicate()
+            seconds = time.time() - start
+
+        # Size the file on our side of the copy
+        local_file = source
+        if not put:
+            local_file = os.path.join(dest, os.path.basename(source)) if os.path.isdir(dest) else dest
+
+        error = ""
+        if stream.returncode != 0:
+            error = err.decode('utf-8', 'replace').strip() or "exit code " + str(stream.returncode)
+            if host.local and "are the same file" in error:
+                error = ""
+
+        size = os.path.getsize(local_file) if os.path.isfile(local_file) else 0
+
+        # scp and cp always copy the whole file, rsync reports what it actually moved (which is all
+        # a resumed or unchanged copy costs)
+        nbytes = size
+        if argv[0] == 'rsync':
+            moved = re.search(r'Total bytes ' + ('sent' if put else 'received') + r': ([\d,.]+)',
+                              out.decode('utf-8', 'replace'))
+            if moved:
+                nbytes = int(re.sub(r'[,.]', '', moved.group(1)))
+
+        return {'host'       : host.ip,
+                'file'       : source,
+                'dest'       : dest,
+                'size'       : size,
+                'bytes'      : nbytes,
+                'seconds'    : seconds,
+                'throughput' : nbytes / seconds if seconds > 0 else 0.0,
+                'error'      : error}
+
+    return await asyncio.gather(*[copy_one(*job) for job in jobs])
+
+# #################################################################################################
+#
+# METHOD: copy_files(jobs, parallel, compress, resume, perror)
+#
+# DESCRIPTION: Run a list of copies concurrently (see copy_files_async()), log the per file results and
+#              exit if any failed unless perror is 0. parallel/compress default to the XFER_PARALLEL and
+#              XFER_COMPRESS options.
+#
+# #################################################################################################
+def copy_files(jobs, parallel=None, compress=None, resume=0, perror=1):
+    """copy_files(jobs, parallel, compress, resume, perror):
+       Run a list of copies concurrently (see copy_files_async()), log the per file results and
+       exit if any failed unless perror is 0. parallel/compress default to the XFER_PARALLEL and
+       XFER_COMPRESS options.
+       """
+
+    if len(jobs) == 0:
+        return []
+
+    if parallel is None:
+        parallel = getOpt('XFER_PARALLEL') or 1
+    if compress is None:
+        compress = getOpt('XFER_COMPRESS')
+    if resume and not shutil.which('rsync'):
+        log("rsync is not installed, resumable copies fall back to scp")
+
+    # Open the ssh masters up front so the coroutines do not block the loop doing it
+    for job in jobs:
+        job[0].ssh_options()
+
+    results = asyncio.run(copy_files_async(jobs, parallel, compress, resume))
+
+    errors = []
+    for result in results:
+        if getOpt('VERBOSE'):
+            log("Copied " + result['host'] + ":" + result['file'] + " " + str(result['bytes']) + " bytes in " +
+                "%.3f" % result['seconds'] + "s (" + "%.0f" % result['throughput'] + " bytes/sec)")
+        if result['error'] != "":
+            errors.append(result['host'] + ":" + result['file'] + "     " + result['error'])
+
+    if errors and perror:
+        sys.exit("\nERROR: copy_files() " + "\n       ".join(errors) + "\n")
+
+    return results
+
+# #################################################################################################
+#
+# METHOD: get_files(files, dest, parallel, compress, resume, perror)
+#
+# DESCRIPTION: Retrieve many files from many systems at once.
+#                 files    - list of (<shell object>, <remote file>) pairs
+#                 dest     - local directory to place the files in
+#                 parallel - maximum number of copies in flight (default XFER_PARALLEL)
+#                 compress - If 1 compress on the wire (default XFER_COMPRESS)
+#                 resume   - If 1 use rsync so large pcaps/logs copied again only move what changed
+#                 perror   - If perror is 0, failed copies are reported but do not exit
+#
+#              Returns a list with one dictionary per file:
+#                 {'host', 'file', 'dest', 'size', 'bytes', 'seconds', 'throughput' (bytes/sec), 'error'}
+#              size is the size of the file, bytes what was moved to copy it (with resume, rsync's
+#              "Total bytes received", otherwise the whole file) and throughput is bytes/seconds
+#
+#              Usage:
+#                 get_files([(server_shell, "a.pcap"), (client_shell, "b.pcap")], parallel=2)
+#
+# #################################################################################################
+def get_files(files, dest=".", parallel=None, compress=None, resume=0, perror=1):
+    """get_files(files, dest, parallel, compress, resume, perror):
+       Retrieve many files from many systems at once.
+          files    - list of (<shell object>, <remote file>) pairs
+          dest     - local directory to place the files in
+          parallel - maximum number of copies in flight (default XFER_PARALLEL)
+          compress - If 1 compress on the wire (default XFER_COMPRESS)
+          resume   - If 1 use rsync so large pcaps/logs copied again only move what changed
+          perror   - If perror is 0, failed copies are reported but do not exit
+       Returns a list with one dictionary per file:
+          {'host', 'file', 'dest', 'size', 'bytes', 'seconds', 'throughput' (bytes/sec), 'error'}
+       size is the size of the file, bytes what was moved to copy it (with resume, rsync's
+       "Total bytes received", otherwise the whole file) and throughput is bytes/seconds
+       """
+
+    return copy_files([(host, file, dest, 0) for host, file in files], parallel, compress, resume, perror)
+
+# #################################################################################################
+#
+# METHOD: put_files(files, dest_path, parallel, compress, resume, perror)
+#
+# DESCRIPTION: Send many local files to many systems at once.
+#                 files     - list of (<shell object>, <local file>) pairs
+#                 dest_path - path on the remote systems to place the files
+#              The remaining arguments and the returned list are the same as get_files() (with resume,
+#              bytes is rsync's "Total bytes sent")
+#
+# #################################################################################################
+def put_files(files, dest_path=".", parallel=None, compress=None, resume=0, perror=1):
+    """put_files(files, dest_path, parallel, compress, resume, perror):
+       Send many local files to many systems at once.
+          files     - list of (<shell object>, <local file>) pairs
+          dest_path - path on the remote systems to place the files
+       The remaining arguments and the returned list are the same as get_files() (with resume,
+       bytes is rsync's "Total bytes sent")
+       """
+
+    return copy_files([(host, file, dest_path, 1) for host, file in files], parallel, compress, resume, perror)
@@ -0,0 +1,230 @@
+#!/usr/bin/python3
+
+#
+# Copyright 2016, Dan Malone, All Rights Reserved
+#
+from util.globals import *
+
+import re
+import shlex
+import threading
+
+###################################################################################################
+#
+# MODULE (Class): sudo_policy
+#
+# DESCRIPTION   : This class decides whether a command run by a non-root user has to be prefixed with
+#                 sudo. The decision is made on the program the command starts with (after any
+#                 VAR=value assignments), matched on word boundaries so "lsb_release" is not "ls" and
+#                 "ifconfig" is not "if":
+#
+#                    sudo    - programs which need root (tc, tcpdump, pkill ...)
+#                    plain   - programs and shell keywords which must run as the login user (cd, curl ...)
+#                    default - "sudo" or "plain" for anything in neither list
+#
+#                 A subshell or group ("(tc qdisc)", "{ tc qdisc; }") is decided by the program it
+#                 starts with and run as "sudo sh -c '<cmd>'" since sudo cannot run one directly.
+#                 Commands which already start with sudo are left alone. The lists are compiled into
+#                 one regular expression each and the answer for every command string is cached, so a
+#                 command issued over and over in a test loop is only scanned once.
+#
+#                 A policy is declared once per host, in code with set_sudo_policy() or in the testbed
+#                 xml, and is shared by shell.run(), run_async(), run_stream() and launch().
+#
+#                 <test_bed>                            default for every host of the test bed
+#                     <sudo_policy>
+#                         <sudo>tc tcpdump pkill</sudo>
+#                         <plain>cd curl ls</plain>
+#                         <default>sudo</default>
+#                     </sudo_policy>
+#                     <netem_server>
+#                         <ip>...</ip>
+#                         <sudo_policy> ... </sudo_policy>     this host only
+#
+##################################################################################################
+class sudo_policy:
+    """Decides which commands a non-root user has to run with sudo"""
+
+    # Programs run with sudo unless a policy says otherwise
+    SUDO  = ['grep', 'service', 'sed', 'ps', 'pkill', 'kill', 'tc', 'tcpdump', 'ip']
+
+    # Programs and shell keywords which run as the login user unless a policy says otherwise
+    PLAIN = ['cd', 'bash', 'curl', 'ls', 'if', 'exit', 'echo', 'for', 'while', 'true', '[', 'test', 'python3', 'python']
+
+    # Cached decisions kept per policy (the commands of a test run are a small, repeating set)
+    CACHE_SIZE = 4096
+
+    ##############################################################################################
+    #
+    # METHOD: __init__(sudo, plain, default)
+    #
+    # DESCRIPTION: This is the initialization constructor:
+    #                 sudo    - list of programs to run with sudo
+    #                 plain   - list of programs to run as the login user
+    #                 default - "sudo" or "plain" for programs in neither list
+    #
+    ##############################################################################################
+    def __init__(self, sudo=None, plain=None, default="sudo"):
+        """__init__(sudo, plain, default):
+              This is the initialization constructor:
+                 sudo    - list of programs to run with sudo
+                 plain   - list of programs to run as the login user
+                 default - "sudo" or "plain" for programs in neither list
+              """
+
+        self.sudo    = list(self.SUDO if sudo is None else sudo)
+        self.plain   = list(self.PLAIN if plain is None else plain)
+        self.default = default
+        self.cache   = {}
+        self.lock    = threading.Lock()
+
+        self.sudo_match  = self.compile(self.sudo)
+        self.plain_match = self.compile(self.plain)
+
+    ##############################################################################################
+    #
+    # METHOD: compile(programs)
+    #
+    # DESCRIPTION: Returns a regular expression which matches a command starting with one of programs
+    #              (optionally after "(", "{", VAR=value assignments or a path), or None for an empty list
+    #
+    ##############################################################################################
+    def compile(self, programs):
+        """compile(programs):
+              Returns a regular expression which matches a command starting with one of programs
+              (optionally after "(", "{", VAR=value assignments or a path), or None for an empty list
+              """
+
+        if len(programs) == 0:
+            return None
+        names = "|".join(re.escape(program) for program in sorted(programs, key=len, reverse=True))
+        return re.compile(r'^\s*(?:[({]\s*)*(?:[A-Za-z_]\w*=\S*\s+)*(?:\S*/)?(?:' + names + r')(?=$|[\s;|&)<>])')
+
+    ##############################################################################################
+    #
+    # METHOD: needs_sudo(cmd)
+    #
+    # DESCRIPTION: Returns 1 if cmd should be run with sudo, 0 otherwise
+    #
+    ##############################################################################################
+    def needs_sudo(self, cmd):
+        """needs_sudo(cmd):
+              Returns 1 if cmd should be run with sudo, 0 otherwise
+              """
+
+        if re.match(r'\s*sudo\s', cmd):
+            return 0
+        if self.sudo_match is not None and self.sudo_match.match(cmd):
+            return 1
+        if self.plain_match is not None and self.plain_match.match(cmd):
+            return 0
+        return 1 if self.default == "sudo" else 0
+
+    ##############################################################################################
+    #
+    # METHOD: wrap(cmd)
+    #
+    # DESCRIPTION: Returns cmd as it should be run by a non-root user, prefixed with sudo or not
+    #
+    ##############################################################################################
+    def wrap(self, cmd):
+        """wrap(cmd):
+              Returns cmd as it should be run by a non-root user, prefixed with sudo or not
+              """
+
+        wrapped = self.cache.get(cmd)
+        if wrapped is None:
+            wrapped = cmd
+            if self.needs_sudo(cmd):
+                # a subshell or group is shell syntax, not a program sudo can run
+                wrapped = "sudo sh -c " + shlex.quote(cmd) if re.match(r'\s*[({]', cmd) else "sudo " + cmd
+            with self.lock:
+                if len(self.cache) >= self.CACHE_SIZE:
+                    self.cache.clear()
+                self.cache[cmd] = wrapped
+        return wrapped
+
+    ##############################################################################################
+    #
+    # METHOD: from_xml(element)
+    #
+    # DESCRIPTION: Build a policy from a <sudo_policy> element. Missing lists keep the defaults.
+    #
+    ##############################################################################################
+    @classmethod
+    def from_xml(cls, element):
+        """from_xml(element):
+              Build a policy from a <sudo_policy> element. Missing lists keep the defaults.
+              """
+
+        sudo = element.findtext("sudo")
+        plain = element.findtext("plain")
+        default = element.findtext("default", "sudo").strip()
+        if default not in ["sudo", "plain"]:
+            sys.exit("\nERROR: sudo_policy default must be sudo or plain, not " + default + "\n")
+        return cls(None if sudo is None else sudo.split(), None if plain is None else plain.split(), default)
+
+
+# The policy of each host {ip : sudo_policy}, hosts without one use default_sudo_policy
+sudo_policies = {}
+default_sudo_policy = sudo_policy()
+
+##############################################################################################
+#
+# METHOD: get_sudo_policy(ip)
+#
+# DESCRIPTION: Returns the sudo_policy for the host ip
+#
+##############################################################################################
+def get_sudo_policy(ip):
+    """get_sudo_policy(ip):
+          Returns the sudo_policy for the host ip
+          """
+
+    return sudo_policies.get(ip, default_sudo_policy)
+
+##############################################################################################
+#
+# METHOD: set_sudo_policy(policy, ip)
+#
+# DESCRIPTION: Use policy for the host ip, or for every host without its own policy if ip is None
+#
+##############################################################################################
+def set_sudo_policy(policy, ip=None):
+    """set_sudo_policy(policy, ip):
+          Use policy for the host ip, or for every host without its own policy if ip is None
+          """
+
+    global default_sudo_policy
+
+    if ip is None:
+        default_sudo_policy = policy
+    else:
+        sudo_policies[ip] = policy
+
+##############################################################################################
+#
+# METHOD: load_sudo_policies(testbed)
+#
+# DESCRIPTION: Pick up the <sudo_policy> elements of a test_bed xml element, the one directly under
+#              the test_bed is the default and the one inside a host element applies to its <ip>
+#
+##############################################################################################
+def load_sudo_policies(testbed):
+    """load_sudo_policies(testbed):
+          Pick up the <sudo_policy> elements of a test_bed xml element, the one directly under
+          the test_bed is the default and the one inside a host element applies to its <ip>
+          """
+
+    if testbed is None:
+        return
+
+    element = testbed.find("sudo_policy")
+    if element is not None:
+        set_sudo_policy(sudo_policy.from_xml(element))
+
+    for host in testbed:
+        element = host.find("sudo_policy")
+        ip = host.findtext("ip")
+        if element is not None and ip is not None:
+            set_sudo_policy(sudo_policy.from_xml(element), ip.strip())
@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+
+#
+# Copyright 2016, Dan Malone, All Rights Reserved
+#
+from util.globals import *
+
+import sys
+
+###################################################################################################
+#
+# MODULE (Class): sweep_plan
+#
+# DESCRIPTION   : This class plans a sweep over a grid of netem profiles (delay x loss x jitter x
+#                 bandwidth x ...). The points are generated one at a time (a sweep of thousands of points
+#                 is never built as a list) in an order which keeps the reconfiguration between points
+#                 cheap:
+#
+#                    - the fields are nested by cost, the ones which restart the client ("client.<parm>",
+#                      see test_client.update_config()) outermost, then the ones which need a clear_netem(),
+#                      then bandwidth (htb class change), then the netem qdisc fields
+#                    - the nesting is walked as a snake (every other pass of an inner field runs backwards),
+#                      so consecutive points differ in exactly one field: one restart, one clear or one tc
+#                      change, never a change of everything
+#
+#                 steps() tells the sweep loop what each point needs (restart / clear / tc changes) and
+#                 estimate() the total time of the sweep before it is run.
+#
+# Usage:
+#
+# plan = sweep_plan({'delay' : [20, 100, 300], 'loss' : [0, 0.5, 2], 'jitter' : [0], 'bandwidth' : [2000, 20000]},
+#                   fixed={'COUNT' : 1}, point_time=60)
+# plan.estimate()                                     logs and returns the estimate
+# for profile, actions in plan.steps():
+#     if actions['restart']:
+#         test_client.update_config(profile)
+#         test_client.restart()
+#     if actions['clear']:
+#         netem_server.clear_netem()
+#     netem_server.set(profile)                        only changes what differs from the last point
+#
+##################################################################################################
+class sweep_plan:
+    """Plans the order of a sweep over a grid of netem profiles"""
+
+    # Estimated seconds of each kind of reconfiguration between points
+    RESTART_TIME = 15.0
+    CLEAR_TIME   = 1.0
+    TC_TIME      = 0.2
+
+    # The netem fields which are set with an htb class change, the others change the netem qdisc
+    CLASS_FIELDS = ['bandwidth']
+
+    ##############################################################################################
+    #
+    # METHOD: __init__(grid, fixed, clear_fields, point_time)
+    #
+    # DESCRIPTION: This is the initialization constructor:
+    #                 grid         - {field : [values]}, the sweep is every combination of the values
+    #                 fixed        - {field : value} added to every point (like COUNT)
+    #                 clear_fields - fields which need a clear_netem() when they change
+    #                 point_time   - estimated seconds the test of one point takes
+    #
+    ##############################################################################################
+    def __init__(self, grid, fixed=None, clear_fields=None, point_time=0):
+        """__init__(grid, fixed, clear_fields, point_time):
+              This is the initialization constructor:
+                 grid         - {field : [values]}, the sweep is every combination of the values
+                 fixed        - {field : value} added to every point (like COUNT)
+                 clear_fields - fields which need a clear_netem() when they change
+                 point_time   - estimated seconds the test of one point takes
+                 """
+
+        self.grid         = {field : list(values) for field, values in grid.items()}
+        self.fixed        = dict(fixed or {})
+        self.clear_fields = list(clear_fields or [])
+        self.point_time   = point_time
+
+        for field, values in self.grid.items():
+            if len(values) == 0:
+                msg = "\nERROR: " + self.__class__.__name__ + "() no values to sweep for " + field + "\n"
+                log(msg)
+                sys.exit(msg)
+
+        # Outermost field first, by cost (grid order is kept among fields of the same cost)
+        self.fields = sorted(self.grid, key=lambda field: -self.cost_class(field))
+
+    def __len__(self):
+        size = 1
+        for values in self.grid.values():
+            size *= len(values)
+        return size
+
+    ##############################################################################################
+    #
+    # METHOD: cost_class(field)
+    #
+    # DESCRIPTION: How expensive a change of field is: 3 client restart, 2 clear_netem(), 1 htb class
+    #              change, 0 netem qdisc change
+    #
+    ##############################################################################################
+    def cost_class(self, field):
+        """cost_class(field):
+              How expensive a change of field is: 3 client restart, 2 clear_netem(), 1 htb class
+              change, 0 netem qdisc change
+              """
+
+        if field.startswith("client."):
+            return 3
+        if field in self.clear_fields:
+            return 2
+        if field in self.CLASS_FIELDS:
+            return 1
+        return 0
+
+    ##############################################################################################
+    #
+    # METHOD: points()
+    #
+    # DESCRIPTION: Generator of the profile dictionaries of the sweep in snake order. Each is named
+    #              after its grid values (like "delay_100_loss_0.5_jitter_0_bandwidth_2000").
+    #
+    ##############################################################################################
+    def points(self):
+        """points():
+              Generator of the profile dictionaries of the sweep in snake order. Each is named
+              after its grid values (like "delay_100_loss_0.5_jitter_0_bandwidth_2000").
+              """
+
+        sizes = [len(self.grid[field]) for field in self.fields]
+        strides = []
+        stride = 1
+        for size in reversed(sizes):
+            strides.insert(0, stride)
+            stride *= size
+
+        for index in range(len(self)):
+            profile = dict(self.fixed)
+            for field, size, stride in zip(self.fields, sizes, strides):
+                digit = (index // stride) % size
+                # runs backwards on every other pass of the field outside it
+                if (index // (stride * size)) % 2:
+                    digit = size - 1 - digit
+                profile[field] = self.grid[field][digit]
+            profile['name'] = "_".join(field + "_" + str(profile[field]) for field in self.grid)
+            yield profile
+
+    ##############################################################################################
+    #
+    # METHOD: steps()
+    #
+    # DESCRIPTION: Generator of (profile, actions) for the points of the sweep in order. actions says what
+    #              moving from the previous point takes {'restart' : 0/1, 'clear' : 0/1, 'tc' : <number of
+    #              tc changes>, 'changed' : [fields]}, the first point needs everything.
+    #
+    ##############################################################################################
+    def steps(self):
+        """steps():
+              Generator of (profile, actions) for the points of the sweep in order. actions says what
+              moving from the previous point takes {'restart' : 0/1, 'clear' : 0/1, 'tc' : <number of
+              tc changes>, 'changed' : [fields]}, the first point needs everything.
+              """
+
+        previous = None
+        for profile in self.points():
+            if previous is None:
+                changed = list(self.fields)
+            else:
+                changed = [field for field in self.fields if profile[field] != previous[field]]
+            costs = [self.cost_class(field) for field in changed]
+
+            # a clear (or the first point) builds the whole tree again: class and qdisc
+            clear = 1 if previous is None or 2 in costs else 0
+            tc = 2 if clear else (1 if 1 in costs else 0) + (1 if 0 in costs else 0)
+            yield profile, {'restart' : 1 if 3 in costs else 0, 'clear' : clear, 'tc' : tc, 'changed' : changed}
+            previous = profile
+
+    ##############################################################################################
+    #
+    # METHOD: estimate(report)
+    #
+    # DESCRIPTION: Walk the plan and estimate the time the sweep will take. Returns {'points', 'restarts',
+    #              'clears', 'tc', 'setup_time', 'test_time', 'total_time'} (seconds) and logs it if report
+    #              is 1.
+    #
+    ##############################################################################################
+    def estimate(self, report=1):
+        """estimate(report):
+              Walk the plan and estimate the time the sweep will take. Returns {'points', 'restarts',
+              'clears', 'tc', 'setup_time', 'test_time', 'total_time'} (seconds) and logs it if report
+              is 1.
+              """
+
+        points = restarts = clears = tc = 0
+        for profile, actions in self.steps():
+            points += 1
+            restarts += actions['restart']
+            clears += actions['clear']
+            tc += actions['tc']
+
+        setup_time = restarts * self.RESTART_TIME + clears * self.CLEAR_TIME + tc * self.TC_TIME
+        test_time = points * self.point_time
+        estimate = {'points' : points, 'restarts' : restarts, 'clears' : clears, 'tc' : tc,
+                    'setup_time' : setup_time, 'test_time' : test_time, 'total_time' : setup_time + test_time}
+
+        if report:
+            total = int(estimate['total_time'])
+            log("Sweep of " + str(points) + " points over " + ", ".join(self.fields) + ": " + str(restarts) +
+                " client restarts, " + str(clears) + " netem clears, " + str(tc) + " tc changes, estimated " +
+                "%d:%02d:%02d" % (total // 3600, total // 60 % 60, total % 60) + " (setup %.0fs)" % setup_time)
+        return estimate
@@ -3,7 +3,7 @@
 #
 # Copyright 2016, Dan Malone, All Rights Reserved
 #
-import util.utilities
+from util import utilities
 from util.globals import *
 
 import re
@@ -14,6 +14,11 @@ import atexit
 import inspect
 from time import sleep, strftime, gmtime
 import threading
+import queue
+import concurrent.futures
+import json
+from .loadgen import loadgen_command
+from .series import time_series
 
 ###################################################################################################
 #
@@ -68,6 +73,10 @@ import threading
 # transfer.clear_stats()
 #    Clears the recorded stats for all transfers
 #
+# transfer.export_series(path)
+#    With SAMPLE_INTERVAL set, writes the bytes received samples of every transfer as "<time> <value>" files
+#    (throughput over the transfer) for gnuplot.generic_tplot()
+#
 ##################################################################################################
 class transfer:
     """This class manages file transfers started on the Test Client"""
@@ -91,8 +100,13 @@ class transfer:
         self.testbed = self.test_client.testbed
         self.content_server = self.testbed.find(".//content_server[@id='"  + str(1) + "']/ip").text
 
-        # Keep track of the active transfer threads
+        # Keep track of the active transfer threads, and how many of them (of every start()) are still running
         self.threads = []
+        self.running = 0
+        self.lock = threading.Lock()
+
+        # The stats records and ends of the threads of the last start() in the order they happen (see as_completed())
+        self.completed = queue.Queue()
 
         # Keep track of the transfer statistics in a list of dictionaries.  Each dictionary contains info about the transfer such as THROUGHPUT
         self.stats = []
@@ -108,6 +122,39 @@ class transfer:
     ##################################################################################################
     def start(self, options={}):
 
+        options, self.transfer_filenames = self.prepare(options)
+
+        # Start transfer
+        self.threads = []
+        self.completed = queue.Queue()
+
+        # Create a thread to start the transfer(s)
+        if options['ENGINE'] == "loadgen":
+            thread = loadgenThread(self, self.test_client, self.transfer_filenames, options, 0)
+        elif options['ENGINE'] == "curl":
+            thread = transferThread(self, self.test_client, self.transfer_filenames, options, 0)
+        else:
+            msg = "\nERROR: " + self.__class__.__name__ + "() unknown transfer ENGINE " + str(options['ENGINE']) + "\n"
+            log(msg)
+            sys.exit(msg)
+        thread.daemon = True
+        with self.lock:
+            self.running += 1
+        thread.start()
+        self.threads.append(thread)
+
+        return self.threads
+
+    ###################################################################################################
+    #
+    # METHOD: transfer.prepare(options={})
+    #
+    # DESCRIPTION: Returns the options with the defaults filled in and the list of urls to transfer
+    #              (FILE with the content server prepended)
+    #
+    ##################################################################################################
+    def prepare(self, options={}):
+
         ############################
         # Set default options
         ############################
@@ -126,10 +173,20 @@ class transfer:
 
         defaults['OUTFILE']  = "";   # Name of output file.  If "", output file will be given a name containing the transfer session id
 
+        defaults['ENGINE']  = "curl";   # curl    : Run curl on the test client for every transfer
+                                        # loadgen : Run one resident load generator on the test client (control/loadgen.py)
+                                        #           which keeps CONNECTIONS transfers going at the same time and reports
+                                        #           every request as it completes (file bodies are not kept)
+
+        defaults['CONNECTIONS'] = 1;    # loadgen: number of concurrent connections, each transfers every FILE COUNT times
+
+        defaults['SAMPLE_INTERVAL'] = float(getOpt('TRANSFER_SAMPLE_INTERVAL'));   # curl: seconds between samples of the bytes received while
+                                                                                   # each transfer runs (the .series of its stats record), 0 for none
+
         options = utilities.set_dictionary_defaults(defaults, options)
 
         # Prepend the content server if there is not already a content server on it
-        self.transfer_filenames = []
+        filenames = []
 
         if isinstance(options['FILE'], str):
             # If they only have one file as a string, we need to turn it into a list of 1 file
@@ -143,18 +200,39 @@ class transfer:
                 # as the files reside locally for uploads.
                 if 'UPLOAD' not in options:
                     file = self.content_server + "/" + file
-            self.transfer_filenames.append(file)
+            filenames.append(file)
 
-        # Start transfer
-        self.threads = []
+        return options, filenames
 
-        # Create a thread to start the transfer(s)
-        thread = transferThread(self, self.dpr_client, self.transfer_filenames, options, 0)
-        thread.daemon = True
-        thread.start()
-        self.threads.append(thread)
+    ##############################################################################
+    # transfer.add_stats(stats, completed)
+    # Record the stats of a finished transfer, called by the transfer threads.
+    # completed is the queue of the start() the thread belongs to
+    ##############################################################################
+    def add_stats(self, stats, completed):
+        self.stats.append(stats)
+        completed.put(stats)
 
-        return self.threads
+    ##############################################################################
+    # transfer.execute(thread)
+    # Run the transfer(s) of a thread object in the calling thread instead of its
+    # own (used by the pool workers of transfer_scheduler)
+    ##############################################################################
+    def execute(self, thread):
+        with self.lock:
+            self.running += 1
+        thread.run()
+
+    ##############################################################################
+    # transfer.thread_done(thread)
+    # Called by a transfer thread when it ends
+    ##############################################################################
+    def thread_done(self, thread):
+        with self.lock:
+            self.running -= 1
+        thread.done.set()
+        # wakes up as_completed() (after the thread's last stats)
+        thread.completed.put(thread)
 
     ##############################################################################
     # transfer.stop()
@@ -167,42 +245,60 @@ class transfer:
             except:
                 continue
 
+            # the load generator is stopped directly (it is not a curl)
+            if isinstance(thread, loadgenThread):
+                thread.end()
+
         if kill:
             # Kill all the curl's on the client system
             # TODO: We should only kill the specific curl for each thread.  To do this, Tte thread needs to record the PID when it starts the curl
-            output = self.dpr_client.shell.run('sudo pkill curl', 1, 1)
+            output = self.test_client.shell.run('sudo pkill curl', 1, 1)
 
 
     ##############################################################################
     # transfer.wait()
-    # Waits for all transfers to end
+    # Waits for all transfers to end, returns as soon as the last one does.
+    # Returns the number of transfers still running (0 unless the limit ran out)
     # 02/06/15 - DRM: Added an option to provide a limiter to the wait. I found
     #                 with the multi-client tests I would sometimes get wedged
     #                 waiting for the transfer thread to complete and never return.
     ##############################################################################
     def wait(self, limit=0):
+        deadline = time.time() + limit if limit else None
         for thread in self.threads:
-            # see if we are limiting
-            if limit:
-                # loop only until the thread clears or limit goes to 0
-                while thread.transfer_running == 1 and limit:
-                    sleep(1)
-                    limit -= 1
-            else:
-                # loop until thread clears
-                while thread.transfer_running == 1:
-                    sleep(1)
+            if deadline is None:
+                thread.done.wait()
+            elif not thread.done.wait(max(deadline - time.time(), 0)):
+                break
+        return self.check()
 
     ##############################################################################
     # transfer.check()
     # Check to see how many transfers are running
     ##############################################################################
     def check(self):
-        runners = 0
-        for thread in self.threads:
-            if thread.transfer_running == 1:
-                runners += 1
-        return runners
+        return self.running
+
+    ##############################################################################
+    # transfer.as_completed(limit=0)
+    # Iterate over the stats records of the transfers of the last start() as each
+    # transfer ends (every curl run or load generator request), until all of its
+    # threads are done or limit seconds (0 for no limit) have passed
+    ##############################################################################
+    def as_completed(self, limit=0):
+        deadline = time.time() + limit if limit else None
+        completed = self.completed
+        threads = list(self.threads)
+        while 1:
+            if completed.empty() and all(thread.done.is_set() for thread in threads):
+                return
+            try:
+                item = completed.get(timeout=None if deadline is None else max(deadline - time.time(), 0))
+            except queue.Empty:
+                log("Transfers still running after " + str(limit) + "s")
+                return
+            if isinstance(item, dict):
+                yield item
 
     ##############################################################################
     # transfer.clear_stats()
@@ -211,6 +307,14 @@ class transfer:
     def clear_stats(self):
         self.stats = []
 
+    ##############################################################################
+    # transfer.export_series(path, rate=1)
+    # Write the bytes received samples of the transfers (SAMPLE_INTERVAL) as
+    # "<time> <value>" files for generic_tplot(), see export_series()
+    ##############################################################################
+    def export_series(self, path, rate=1):
+        return export_series(self.stats, path, rate)
+
     ##############################################################################
     # transfer.get_stats()
     # Returns the list of stats records.  Each record is a dictionary containing stats for the transfer
@@ -226,6 +330,255 @@ class transfer:
         return self.stats
 
 
+###################################################################################################
+#
+# MODULE (Class): transfer_scheduler
+#
+# DESCRIPTION: This class runs a plan of many single transfers (curl) concurrently on a bounded pool of
+#              workers, spread over one or more test clients, with every stats record going to one shared
+#              list. Plan options (on top of the transfer.start() options like FILE and PROXY):
+#
+#                 TOTAL        - number of transfers (each gets every FILE once)
+#                 CONCURRENCY  - most transfers in flight at once (size of the worker pool)
+#                 DISTRIBUTION - list of weights of the clients ([3, 1] gives the first client 3 of every
+#                                4 transfers), default equal
+#                 RAMP         - transfers started per second while ramping up, 0 to start as fast as the
+#                                pool allows
+#
+# Usage:
+#
+# scheduler = transfer.transfer_scheduler([client1, client2])
+# scheduler.start({'FILE' : "files/test5M", 'PROXY' : "DIRECT", 'TOTAL' : 200, 'CONCURRENCY' : 20, 'RAMP' : 10})
+# for stats in scheduler.as_completed():      (or scheduler.wait())
+#     ...
+# summary = scheduler.summary()                {'transfers', 'errors', 'bytes', 'elapsed', 'throughput', 'clients'}
+#
+##################################################################################################
+class transfer_scheduler:
+    """Runs many transfers concurrently on a bounded pool of workers"""
+
+    ##############################################################################################
+    #
+    # METHOD: __init__(test_clients)
+    #
+    # DESCRIPTION: This is the initialization constructor:
+    #                 test_clients - list of the test_client objects to run the transfers on
+    #
+    ##############################################################################################
+    def __init__(self, test_clients):
+        """__init__(test_clients)
+             This is the initialization constructor:
+                test_clients - list of the test_client objects to run the transfers on
+                """
+
+        # One transfer per client, all of them recording into the same stats list and queue
+        self.transfers = [transfer(test_client) for test_client in test_clients]
+        self.stats = []
+        self.completed = queue.Queue()
+        for xfer in self.transfers:
+            xfer.stats = self.stats
+            xfer.completed = self.completed
+
+        self.threads = []
+        self.lock = threading.Lock()
+        self.stopping = 0
+        self.finished = threading.Event()
+        self.finished.set()
+        self.started = 0
+        self.ended = 0
+
+    ###################################################################################################
+    #
+    # METHOD: start(options={})
+    #
+    # DESCRIPTION: Start running the plan in the background (see the class description for the options)
+    #
+    ##################################################################################################
+    def start(self, options={}):
+        """start(options)
+             Start running the plan in the background (see the class description for the options)
+             """
+
+        plan = dict(options)
+        total = int(plan.pop('TOTAL', 1))
+        concurrency = max(int(plan.pop('CONCURRENCY', 1)), 1)
+        weights = plan.pop('DISTRIBUTION', None) or [1] * len(self.transfers)
+        ramp = float(plan.pop('RAMP', 0))
+
+        if len(weights) != len(self.transfers) or sum(weights) <= 0:
+            msg = "\nERROR: " + self.__class__.__name__ + "() DISTRIBUTION needs a weight for each of the " + str(len(self.transfers)) + " clients\n"
+            log(msg)
+            sys.exit(msg)
+
+        # every transfer is a single pass of curl over FILE
+        plan.update({'COUNT' : 1, 'CONTINUOUS' : 0, 'ENGINE' : "curl"})
+        prepared = [xfer.prepare(dict(plan)) for xfer in self.transfers]
+
+        self.stats[:] = []
+        self.threads = []
+        self.completed = queue.Queue()
+        for xfer in self.transfers:
+            xfer.completed = self.completed
+        self.stopping = 0
+        self.finished.clear()
+        self.started = time.time()
+        self.ended = 0
+
+        log("Transfer plan: " + str(total) + " transfers, " + str(concurrency) + " at once over " +
+            str(len(self.transfers)) + " clients " + str(weights) + (", ramp " + str(ramp) + "/s" if ramp else ""))
+
+        dispatcher = threading.Thread(target=self.dispatch, args=(total, concurrency, weights, ramp, prepared, self.completed))
+        dispatcher.daemon = True
+        dispatcher.start()
+
+    ##############################################################################################
+    #
+    # METHOD: assign(total, weights)
+    #
+    # DESCRIPTION: Generator of the client index of each of total transfers, interleaved so each client
+    #              gets its share of weights all through the plan (not all of its transfers in a row)
+    #
+    ##############################################################################################
+    def assign(self, total, weights):
+        """assign(total, weights):
+              Generator of the client index of each of total transfers, interleaved so each client
+              gets its share of weights all through the plan (not all of its transfers in a row)
+              """
+
+        share = float(sum(weights))
+        assigned = [0] * len(weights)
+        for idx in range(total):
+            client = max(range(len(weights)), key=lambda c: weights[c] * (idx + 1) / share - assigned[c])
+            assigned[client] += 1
+            yield client
+
+    ##############################################################################################
+    #
+    # METHOD: dispatch(total, concurrency, weights, ramp, prepared, completed)
+    #
+    # DESCRIPTION: Hand the transfers to the worker pool, no faster than the ramp, and mark the plan
+    #              finished (on its completed queue) once the pool is done
+    #
+    ##############################################################################################
+    def dispatch(self, total, concurrency, weights, ramp, prepared, completed):
+        """dispatch(total, concurrency, weights, ramp, prepared, completed):
+              Hand the transfers to the worker pool, no faster than the ramp, and mark the plan
+              finished (on its completed queue) once the pool is done
+              """
+
+        slots = threading.BoundedSemaphore(concurrency)
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        try:
+            for idx, client in enumerate(self.assign(total, weights)):
+                if ramp:
+                    left = self.started + idx / ramp - time.time()
+                    if left > 0:
+                        sleep(left)
+
+                # hold the transfer back until a worker is free so stop() leaves nothing queued
+                slots.acquire()
+                if self.stopping:
+                    slots.release()
+                    break
+
+                xfer = self.transfers[client]
+                options, filenames = prepared[client]
+                thread = transferThread(xfer, xfer.test_client, filenames, dict(options), idx)
+                with self.lock:
+                    self.threads.append(thread)
+                future = pool.submit(xfer.execute, thread)
+                future.add_done_callback(lambda future: slots.release())
+        finally:
+            pool.shutdown(wait=True)
+            self.ended = time.time()
+            self.finished.set()
+            completed.put(None)
+
+    ##############################################################################
+    # transfer_scheduler.stop()
+    # Start no more transfers and stop the ones running
+    ##############################################################################
+    def stop(self, kill=1):
+        self.stopping = 1
+        with self.lock:
+            threads = list(self.threads)
+        for thread in threads:
+            thread.stop_transfer = 1
+        if kill:
+            for xfer in self.transfers:
+                xfer.test_client.shell.run('sudo pkill curl', 1, 1)
+
+    ##############################################################################
+    # transfer_scheduler.wait(limit=0)
+    # Wait for the plan to finish (at most limit seconds if not 0). Returns 1 if
+    # it did
+    ##############################################################################
+    def wait(self, limit=0):
+        return 1 if self.finished.wait(limit if limit else None) else 0
+
+    ##############################################################################
+    # transfer_scheduler.check()
+    # Number of transfers running right now
+    ##############################################################################
+    def check(self):
+        return sum(xfer.check() for xfer in self.transfers)
+
+    ##############################################################################
+    # transfer_scheduler.as_completed(limit=0)
+    # Iterate over the stats records of the last start() as each transfer ends,
+    # until the plan is finished or limit seconds (0 for no limit) have passed
+    ##############################################################################
+    def as_completed(self, limit=0):
+        deadline = time.time() + limit if limit else None
+        completed = self.completed
+        while 1:
+            if completed.empty() and self.finished.is_set():
+                return
+            try:
+                item = completed.get(timeout=None if deadline is None else max(deadline - time.time(), 0))
+            except queue.Empty:
+                log("Transfer plan still running after " + str(limit) + "s")
+                return
+            if isinstance(item, dict):
+                yield item
+
+    ##############################################################################
+    # transfer_scheduler.get_stats(errassert=1)
+    # Returns the shared list of stats records (see transfer.get_stats())
+    ##############################################################################
+    def get_stats(self, errassert=1):
+        return self.transfers[0].get_stats(errassert) if len(self.transfers) else []
+
+    ##############################################################################
+    # transfer_scheduler.export_series(path, rate=1)
+    # Write the bytes received samples of the transfers (see export_series())
+    ##############################################################################
+    def export_series(self, path, rate=1):
+        return export_series(self.stats, path, rate)
+
+    ##############################################################################
+    # transfer_scheduler.summary()
+    # Log and return the totals of the plan so far: {'transfers', 'errors',
+    # 'bytes', 'elapsed', 'throughput' (bytes/s over the whole plan), 'clients'
+    # (transfers per client)}
+    ##############################################################################
+    def summary(self):
+        stats = list(self.stats)
+        elapsed = (self.ended or time.time()) - self.started if self.started else 0.0
+        total_bytes = sum(stat.get('size_download', 0) + stat.get('size_upload', 0) for stat in stats)
+        clients = [0] * len(self.transfers)
+        with self.lock:
+            for thread in self.threads:
+                clients[self.transfers.index(thread.transfer_parent)] += 1
+
+        summary = {'transfers' : len(stats), 'errors' : sum(1 for stat in stats if stat.get('error')),
+                   'bytes' : total_bytes, 'elapsed' : elapsed,
+                   'throughput' : total_bytes / elapsed if elapsed > 0 else 0.0, 'clients' : clients}
+        log("Transfer plan: " + str(summary['transfers']) + " transfers (" + str(summary['errors']) + " errors) " +
+            str(total_bytes) + " bytes in %.1fs, %.0f bytes/s, per client %s" % (elapsed, summary['throughput'], clients))
+        return summary
+
+
 ###################################################################################################
 # class transferThread
 #
@@ -235,17 +588,17 @@ class transfer:
 class transferThread(threading.Thread):
 
     ############################################################################
-    # constructor(dpr_client, options, session)
-    #     dpr_client  is the dpr_client object.  Required even if this is a TCP transfer.  It represent the system that curl will be run on
+    # constructor(transfer_parent, test_client, transfer_filenames, options, transfer_id)
+    #     test_client is the test_client object.  Required even if this is a TCP transfer.  It represent the system that curl will be run on
     #     file        file (including prepended content server) to retrieve
     #     options     is the dictionary of options.  All defaults are assumed to be set
     #     transfer_id is a number corresponding to the transfer (for simultaneous transfers)
     ############################################################################
 
-    def __init__(self, transfer_parent, dpr_client, transfer_filenames, options, transfer_id):
+    def __init__(self, transfer_parent, test_client, transfer_filenames, options, transfer_id):
         super(transferThread, self).__init__()
         self.transfer_parent = transfer_parent
-        self.dpr_client = dpr_client
+        self.test_client = test_client
         self.transfer_filenames = transfer_filenames
         self.options = options
         self.transfer_id = transfer_id
@@ -253,16 +606,25 @@ class transferThread(threading.Thread):
         self.stop_transfer = 0
         self.transfer_running = 1
         self.thread_name = utilities.snip(str(self), "(", ",")
+        self.completed = transfer_parent.completed
+        self.done = threading.Event()
         try:
             self.count = options['COUNT']
         except:
             self.count = 1
 
     def wait(self):
-        while self.transfer_running == 1:
-            sleep(1)
+        self.done.wait()
 
     def run(self):
+        try:
+            self.transfer()
+        finally:
+            # Indicate we are no longer running
+            self.transfer_running = 0
+            self.transfer_parent.thread_done(self)
+
+    def transfer(self):
 
         # Indicate that we have a transfer thread running
         self.transfer_running = 1
@@ -277,7 +639,8 @@ class transferThread(threading.Thread):
             if 'PAGELOAD' in self.options:
                 cmd = "cd /home/qfreleng/testmget; export http_proxy=127.0.0.1:10080; mget -r -p -nc -H --max-redirect 1 --num-threads " +str(self.options['PAGELOAD'])+ " --level 1 "
             else:
-                cmd = "curl"
+                # -s drops the progress meter, -S still reports errors, -w prints the metrics of each transfer
+                cmd = "curl -s -S -w '" + CURL_WRITE_OUT + "'"
 
         # Check if they want HTTP 1.0
         if 'http' in self.options and self.options['http'] == '1.0':
@@ -307,20 +670,20 @@ class transferThread(threading.Thread):
                     if not self.options['PROXY'] == "HTTP_PROXY":
                         # going direct
                         if 'UPLOAD' in self.options:
-                            cmd += cmd + " -F 'uploaded=@" +str(file)+ "; filename=" +os.path.split(file)[1] + ".CONT." + str(self.dpr_client.proxyPort) + "." +self.thread_name+ "." +str(i)+".tmp' -H \"Expect:\" http://" +self.options['CSERVER']+ "/cgi-bin/upload.php"
+                            cmd += cmd + " -F 'uploaded=@" +str(file)+ "; filename=" +os.path.split(file)[1] + ".CONT." + str(self.test_client.proxyPort) + "." +self.thread_name+ "." +str(i)+".tmp' -H \"Expect:\" http://" +self.options['CSERVER']+ "/cgi-bin/upload.php"
                             log("UPLOAD")
                         else:
-                            outfile = dnldpath + os.path.split(file)[1] + ".CONT." + str(self.dpr_client.proxyPort) + "." + self.thread_name + "." + str(i) + ".tmp"
+                            outfile = dnldpath + os.path.split(file)[1] + ".CONT." + str(self.test_client.proxyPort) + "." + self.thread_name + "." + str(i) + ".tmp"
                     else:
                         # DRM http proxy
                         if 'UPLOAD' in self.options:
-                            cmd += cmd + " -F 'uploaded=@" +str(file)+ "; filename=" +os.path.split(file)[1] + ".CONT." + str(self.dpr_client.currentClientConfig['nonDprProxyPort']) + "." +self.thread_name+ "." +str(i)+".tmp' -H \"Expect:\" http://" +self.options['CSERVER']+ "/cgi-bin/upload.php"
+                            cmd += cmd + " -F 'uploaded=@" +str(file)+ "; filename=" +os.path.split(file)[1] + ".CONT." + str(self.test_client.currentClientConfig['nonDprProxyPort']) + "." +self.thread_name+ "." +str(i)+".tmp' -H \"Expect:\" http://" +self.options['CSERVER']+ "/cgi-bin/upload.php"
                         else:
-                            outfile = dnldpath + os.path.split(file)[1] + "." + str(self.dpr_client.proxyPort) + "." + str(i) + ".tmp"
+                            outfile = dnldpath + os.path.split(file)[1] + "." + str(self.test_client.proxyPort) + "." + str(i) + ".tmp"
                 else:
                     if 'UPLOAD' in self.options:
                         # add in the upload xfer directives and temp file name.. index needs to be i-1
-                        cmd += cmd + " -F 'uploaded=@" +str(file)+ "; filename=" +os.path.split(file)[1] + "." + str(self.dpr_client.proxyPort) + "." +self.thread_name+ "." +str(i)+".tmp' -H \"Expect:\" http://" +self.options['CSERVER']+ "/cgi-bin/upload.php"
+                        cmd += cmd + " -F 'uploaded=@" +str(file)+ "; filename=" +os.path.split(file)[1] + "." + str(self.test_client.proxyPort) + "." +self.thread_name+ "." +str(i)+".tmp' -H \"Expect:\" http://" +self.options['CSERVER']+ "/cgi-bin/upload.php"
                     else:
                         outfile = dnldpath + os.path.split(file)[1] + "." + self.thread_name + "." + str(i) + ".tmp"
                         log("UPLOAD")
@@ -338,6 +701,10 @@ class transferThread(threading.Thread):
 
         log("CURL CMD : " + cmd)
 
+        # Sample the size of the output files while curl runs (uploads and page loads have none)
+        sampled = self.options.get('SAMPLE_INTERVAL', 0) > 0 and 'UPLOAD' not in self.options and 'PAGELOAD' not in self.options
+        run_cmd = sampled_command(cmd, outfiles, self.options['SAMPLE_INTERVAL']) if sampled else cmd
+
         # NOTE_TO_SELF - Change to .launch and check for completion while looking if the user called stop thread
         while not self.stop_transfer:
 
@@ -345,123 +712,43 @@ class transferThread(threading.Thread):
             if getOpt('VERBOSE_TRANSFER'):
                 log('DEBUG', "Transfer " + self.thread_name + ":" + str(self.transfer_id) + " started via: " + cmd)
 
-            output = self.test_client.shell.run(cmd, 1, 1, 1, 0)
+            output = self.test_client.shell.run(run_cmd, 1, 1, 1, 0)
 
             if getOpt('VERBOSE_TRANSFER'):
                 log('DEBUG', "Transfer" + self.thread_name + ":" + str(self.transfer_id) + " ended \nLOCAL FILE: " + str(outfiles) + "\nCURL OUTPUT:\n" + output)
 
+            series = []
+            if sampled:
+                series, output = parse_samples(output, len(outfiles))
+
             # Parse the output for errors
             errmsg = utilities.snip(output, "curl: ")
 
-            # Get each stat line
-            lines = output.split("\r")
-
-            # Get the values from the last line of output (this will have the best average, but the intermediate ones are available
-            values = lines[-1].split()
-            stats = {}
-            stats["time_finished"] = strftime("%m/%d/%y %H:%M:%S", gmtime())
-
-            if errmsg:
-                stats["error"] = self.__class__.__name__ + "() " + errmsg + "\n"
-                self.stop_transfer = 1
-            else:
-                try:
-                    stats["total_%"]       = values[0]
-                    stats["total_bytes"]   = values[1]
-                    stats["rcvd_%"]        = values[2]
-                    stats["rcvd_bytes"]    = values[3]
-                    stats["xfer_%"]        = values[4]
-                    stats["xfer_bytes"]    = values[5]
-                    stats["avg_dload"]     = values[6]
-                    stats["avg_uload"]     = values[7]
-                    stats["time_total"]    = values[8]
-                    stats["time_spent"]    = values[9]
-                    stats["time_left"]     = values[10]
-                    stats["current_speed"] = values[11]
-                except:
-                    if output.strip() != "":
-                        errmsg = "Transfer encountered abnormal output: " + str(output)
-                        if "ssh_exchange_identification" in output:
-                            errmsg = errmsg + "\nConsider modifying /etc/ssh/ssd_config on the client machine:  MaxStartups 30     (remove the :10:20)"
-                        log(errmsg)
-                        stats["error"] = self.__class__.__name__ + "() " + errmsg + "\n"
-                        self.stop_transfer = 1
-
-                else:
-            
-                    if not 'UPLOAD' in self.options:
-                        # Process curl download stats. The throughput numbers like avg_dload are like 12K. 
-                        # Make them graphable like 12300
-                        stats["down_throughput"] = 0
-                        if stats["avg_dload"] != "":
-                            for unit in ['k', 'M', 'G', 'none']:
-                                if unit in stats["avg_dload"]:
-                                    break
-                                if unit == 'none':
-                                    stats["avg_dload"] = stats["avg_dload"] + "B"
-                                    unit = "B"
-
-                                avg_dload = utilities.snip(stats["avg_dload"], 0, unit)
-
-                                # There appears to be a bug in Python where sometimes a string like "13.8" 
-                                # when passed to float has unseen garbage.  Maybe it's a fault of utilities.snip
-                                # Anyway, reassigning the variable seems to clean up the garbage
-                                if avg_dload == "":
-                                    avg_dload = 0
-                                x = avg_dload
-
-                                # 02/06/15 - DRM: well the above does not always work. Multi-client
-                                # force kill causes garbage to be collected as avg_dload and the float
-                                # aborts on string data this will overide the Python val error
-                                try:
-                                    y = float(x)
-                                except ValueError:
-                                    y = float(0)
-                                    if getOpt('VERBOSE_TRANSFER'):
-                                        log("FLOAT ERROR: converting: " +x+ " to float")
-
-                                multiplier = {"B":1, "k":1024, "M":1024*1024, "G":1024*1024*1024}
-                                y = multiplier[unit] * y
-                                down_throughput = float(int(y))
-                                stats["down_throughput"] = str(down_throughput)
-
-                    else:
-                        # Process curl upload stats. The throughput numbers like avg_dload are like 12K. 
-                        # Make them graphable like 12300
-                        stats["up_throughput"] = 0
-                        if stats["avg_uload"] != "":
-                            for unit in ['k', 'M', 'G', 'none']:
-                                if unit in stats["avg_uload"]:
-                                    break
-                                if unit == 'none':
-                                    stats["avg_uload"] = stats["avg_uload"] + "B"
-                                    unit = "B"
-
-                                avg_uload = utilities.snip(stats["avg_uload"], 0, unit)
-
-                                # There appears to be a bug in Python where sometimes a string like "13.8" 
-                                # when passed to float has unseen garbage.  Maybe it's a fault of utilities.snip
-                                # Anyway, reassigning the variable seems to clean up the garbage
-                                x = avg_uload
-
-                                # 02/06/15 - DRM: well the above does not always work. Multi-client
-                                # force kill causes garbage to be collected as avg_dload and the float
-                                # aborts on string data this will overide the Python val error
-                                try:
-                                    y = float(x)
-                                except ValueError:
-                                    y = float(0)
-                                    if getOpt('VERBOSE_TRANSFER'):
-                                        log("FLOAT ERROR: converting: " +x+ " to float")
-
-                                multiplier = {"B":1, "k":1024, "M":1024*1024, "G":1024*1024*1024}
-                                y = multiplier[unit] * y
-                                up_throughput = float(int(y))
-                                stats["up_throughput"] = str(up_throughput)
+            # curl reports every transfer of the command as one line of --write-out metrics
+            records = parse_write_out(output)
+            if len(records) == 0:
+                records = [transfer_stats.from_values({})]
+                if not errmsg and 'PAGELOAD' not in self.options and output.strip() != "":
+                    errmsg = "Transfer encountered abnormal output: " + str(output)
+                    if "ssh_exchange_identification" in output:
+                        errmsg = errmsg + "\nConsider modifying /etc/ssh/ssd_config on the client machine:  MaxStartups 30     (remove the :10:20)"
+                    log(errmsg)
+
+            for stats, samples in zip(records, series):
+                stats.series = samples
+
+            for stats in records:
+                stats["time_finished"] = strftime("%m/%d/%y %H:%M:%S", gmtime())
+                if not errmsg and stats.get("http_code", 0) >= 400:
+                    errmsg = "HTTP " + str(stats["http_code"]) + " for " + stats["url_effective"]
+                if errmsg:
+                    stats["error"] = self.__class__.__name__ + "() " + errmsg + "\n"
+                    self.stop_transfer = 1
 
             # Append the stats dictionary onto the parents lists of transfer statistics
             #print("              IN THREAD APPENDING STATS: " + str(stats))
-            self.transfer_parent.stats.append(stats)
+            for stats in records:
+                self.transfer_parent.add_stats(stats, self.completed)
 
             # Quit if we got a curl error
             if not errmsg == "" and not self.stop_transfer:
@@ -485,5 +772,334 @@ class transferThread(threading.Thread):
             if 'DELAY_XFER_RESTART' in self.options:
                 time.sleep(self.options['DELAY_XFER_RESTART'])
 
-        # Indicate we are no longer running
-        self.transfer_running = 0
+
+###################################################################################################
+# class loadgenThread
+#
+# This object is a thread for doing the transfers with the resident load generator (ENGINE=loadgen). It is
+# intended to only be invoked by transfer.start(). One program is launched on the test client for all of
+# the transfers, it keeps CONNECTIONS connections going and reports each request as one json line which is
+# turned into a transfer_stats record and appended to the parent's stats as soon as it arrives.
+###################################################################################################
+
+class loadgenThread(threading.Thread):
+
+    ############################################################################
+    # constructor(transfer_parent, test_client, transfer_filenames, options, transfer_id)
+    #     test_client is the test_client object the load generator is run on
+    #     transfer_filenames are the urls (including prepended content server) to retrieve
+    #     options     is the dictionary of options.  All defaults are assumed to be set
+    #     transfer_id is a number corresponding to the transfer (for simultaneous transfers)
+    ############################################################################
+
+    def __init__(self, transfer_parent, test_client, transfer_filenames, options, transfer_id):
+        super(loadgenThread, self).__init__()
+        self.transfer_parent = transfer_parent
+        self.test_client = test_client
+        self.transfer_filenames = transfer_filenames
+        self.options = options
+        self.transfer_id = transfer_id
+        self.stream = None
+        self.stop_transfer = 0
+        self.transfer_running = 1
+        self.lock = threading.Lock()
+        self.completed = transfer_parent.completed
+        self.done = threading.Event()
+
+    ############################################################################
+    # plan()
+    #     The plan handed to the load generator (see control/loadgen.py)
+    ############################################################################
+    def plan(self):
+        proxy = ""
+        if self.options['PROXY'] == 'HTTP_PROXY':
+            proxy = "127.0.0.1:" + str(self.test_client.currentClientConfig['nonDprProxyPort'])
+        elif self.options['PROXY'] != 'DIRECT':
+            proxy = "127.0.0.1:" + str(self.test_client.proxyPort)
+
+        # The load generator speaks http, and https only when it connects to the server itself
+        for url in self.transfer_filenames:
+            scheme = url.split("://", 1)[0].lower() if "://" in url else "http"
+            if scheme not in ["http", "https"] or (scheme == "https" and proxy):
+                msg = "\nERROR: " + self.__class__.__name__ + "() the loadgen ENGINE cannot fetch " + url + \
+                      (" through a proxy (use PROXY DIRECT or ENGINE curl)" if scheme == "https" else " (http and https urls only)") + "\n"
+                log(msg)
+                sys.exit(msg)
+
+        return {'urls' : self.transfer_filenames, 'connections' : int(self.options['CONNECTIONS']),
+                'count' : max(int(self.options['COUNT']), 1), 'continuous' : 1 if self.options['CONTINUOUS'] else 0,
+                'proxy' : proxy, 'http' : "1.0" if self.options.get('http') == '1.0' else "1.1",
+                'timeout' : self.options.get('TIMEOUT', 30)}
+
+    def wait(self):
+        self.done.wait()
+
+    def run(self):
+        try:
+            self.generate()
+        finally:
+            self.transfer_running = 0
+            self.transfer_parent.thread_done(self)
+
+    def generate(self):
+        plan = self.plan()
+        log("LOADGEN : " + str(plan['connections']) + " connections to " + ", ".join(plan['urls']) + (" via " + plan['proxy'] if plan['proxy'] else ""))
+
+        with self.lock:
+            if not self.stop_transfer:
+                self.stream = self.test_client.shell.launch(loadgen_command(plan))
+        if self.stream is None:
+            return
+
+        for line in self.stream.stdout:
+            line = line.decode('utf-8', 'replace').strip()
+            try:
+                record = json.loads(line)
+            except ValueError:
+                if line:
+                    log("LOADGEN : " + line)
+                continue
+
+            total = record['total']
+            stats = transfer_stats.from_values({'http_code' : record['code'], 'num_connects' : record['new'],
+                                                'size_download' : record['bytes'],
+                                                'speed_download' : record['bytes'] / total if total > 0 else 0.0,
+                                                'time_connect' : record['connect'], 'time_starttransfer' : record['ttfb'],
+                                                'time_total' : total, 'url_effective' : record['url']})
+            stats["connection"] = record['w']
+            stats["time_finished"] = strftime("%m/%d/%y %H:%M:%S", gmtime())
+            error = record['error'] or ("HTTP " + str(record['code']) if record['code'] >= 400 else "")
+            if error:
+                stats["error"] = self.__class__.__name__ + "() " + error + " for " + record['url'] + "\n"
+            self.transfer_parent.add_stats(stats, self.completed)
+
+        # The load generator finished (or was stopped by end())
+        self.stream.wait()
+        with self.lock:
+            stream, self.stream = self.stream, None
+        self.test_client.shell.release(stream)
+
+    ############################################################################
+    # end()
+    #     Stop the load generator and wait for its last results (requests in
+    #     flight are reported as stopped)
+    ############################################################################
+    def end(self):
+        with self.lock:
+            self.stop_transfer = 1
+            stream = self.stream
+        if stream is not None:
+            self.test_client.shell.end_groups([stream], 2)
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+
+###################################################################################################
+#
+# MODULE (Class): transfer_stats
+#
+# DESCRIPTION   : The stats record of one curl transfer, built from the metrics curl prints with
+#                 --write-out (CURL_WRITE_OUT) instead of scraping its progress meter. It is a dictionary
+#                 (like the records get_stats() always returned) with typed values:
+#
+#                    http_code, num_connects, num_redirects            int
+#                    size_download, size_upload                        int, bytes
+#                    speed_download, speed_upload                      float, bytes per second
+#                    time_namelookup, time_connect, time_appconnect,   float, seconds from the start of the
+#                    time_pretransfer, time_starttransfer, time_total  transfer (curl's timeline)
+#                    url_effective                                     str
+#
+#                 and the derived values:
+#
+#                    down_throughput / up_throughput   float, speed_download / speed_upload
+#                    dns_time                          float, time_namelookup
+#                    connect_time                      float, tcp connect (time_connect - time_namelookup)
+#                    tls_time                          float, tls handshake (0 without tls)
+#                    ttfb                              float, time to the first byte (time_starttransfer)
+#
+##################################################################################################
+class transfer_stats(dict):
+    """The stats record of one curl transfer"""
+
+    # The --write-out variables and their types, url_effective last as it is the rest of the line
+    FIELDS = [('http_code', int), ('num_connects', int), ('num_redirects', int),
+              ('size_download', int), ('size_upload', int), ('speed_download', float), ('speed_upload', float),
+              ('time_namelookup', float), ('time_connect', float), ('time_appconnect', float),
+              ('time_pretransfer', float), ('time_starttransfer', float), ('time_total', float),
+              ('url_effective', str)]
+
+    # Marks the metrics line in the output
+    MARK = "@@PATI_CURL"
+
+    ##############################################################################################
+    #
+    # METHOD: from_write_out(line)
+    #
+    # DESCRIPTION: Build the record from a metrics line ("@@PATI_CURL <value> <value> ..."), None if the
+    #              line is not one
+    #
+    ##############################################################################################
+    @classmethod
+    def from_write_out(cls, line):
+        """from_write_out(line):
+              Build the record from a metrics line ("@@PATI_CURL <value> <value> ..."), None if the
+              line is not one
+              """
+
+        values = line.split(None, len(cls.FIELDS))
+        if len(values) != len(cls.FIELDS) + 1 or values[0] != cls.MARK:
+            return None
+
+        metrics = {}
+        try:
+            for (field, kind), value in zip(cls.FIELDS, values[1:]):
+                # curl may print decimals with the locale's comma
+                metrics[field] = kind(value.replace(",", ".")) if kind is float else kind(value)
+        except ValueError:
+            return None
+        return cls.from_values(metrics)
+
+    ##############################################################################################
+    #
+    # METHOD: from_values(values)
+    #
+    # DESCRIPTION: Build the record from a dictionary of FIELDS values, missing ones are 0 (or "")
+    #
+    ##############################################################################################
+    @classmethod
+    def from_values(cls, values):
+        """from_values(values):
+              Build the record from a dictionary of FIELDS values, missing ones are 0 (or "")
+              """
+
+        stats = cls()
+        for field, kind in cls.FIELDS:
+            stats[field] = kind(values.get(field, kind()))
+
+        stats['down_throughput'] = stats['speed_download']
+        stats['up_throughput']   = stats['speed_upload']
+        stats['dns_time']        = stats['time_namelookup']
+        stats['connect_time']    = max(stats['time_connect'] - stats['time_namelookup'], 0.0)
+        stats['tls_time']        = max(stats['time_appconnect'] - stats['time_connect'], 0.0) if stats['time_appconnect'] else 0.0
+        stats['ttfb']            = stats['time_starttransfer']
+        return stats
+
+
+# The curl --write-out format of the transfer_stats metrics line (curl expands the \n)
+CURL_WRITE_OUT = "\\n" + transfer_stats.MARK + " " + " ".join("%{" + field + "}" for field, kind in transfer_stats.FIELDS) + "\\n"
+
+##############################################################################################
+#
+# METHOD: parse_write_out(output)
+#
+# DESCRIPTION: Returns the list of transfer_stats of the metrics lines in the output of a curl command,
+#              one per transfer in the order curl ran them
+#
+##############################################################################################
+def parse_write_out(output):
+    """parse_write_out(output):
+          Returns the list of transfer_stats of the metrics lines in the output of a curl command,
+          one per transfer in the order curl ran them
+          """
+
+    records = []
+    for line in output.splitlines():
+        if line.startswith(transfer_stats.MARK):
+            stats = transfer_stats.from_write_out(line)
+            if stats is not None:
+                records.append(stats)
+    return records
+
+
+# Marks the bytes received samples in the output of a sampled curl command
+SAMPLE_MARK = "@@PATI_BYTES"
+
+##############################################################################################
+#
+# METHOD: sampled_command(cmd, outfiles, interval)
+#
+# DESCRIPTION: Returns cmd (a curl writing outfiles) wrapped so a loop prints a time stamp and the size
+#              of every outfile each interval seconds while it runs, and once more when it ends. cmd runs
+#              in a subshell (an exit in it cannot leave the sampler running) and the exit status is its own.
+#
+##############################################################################################
+def sampled_command(cmd, outfiles, interval):
+    """sampled_command(cmd, outfiles, interval):
+          Returns cmd (a curl writing outfiles) wrapped so a loop prints a time stamp and the size
+          of every outfile each interval seconds while it runs, and once more when it ends. cmd runs
+          in a subshell (an exit in it cannot leave the sampler running) and the exit status is its own.
+          """
+
+    files = " ".join(shlex.quote(outfile) for outfile in outfiles)
+    sample = "echo \"" + SAMPLE_MARK + " $(date +%s.%N)\" $(for f in " + files + "; do stat -c %s \"$f\" 2>/dev/null || echo 0; done)"
+    return ("rm -f " + files + "; ( while :; do " + sample + "; sleep " + str(interval) + "; done ) & s=$!; " +
+            "( " + cmd + " ); rc=$?; kill $s; wait $s 2>/dev/null; " + sample + "; exit $rc")
+
+##############################################################################################
+#
+# METHOD: parse_samples(output, count)
+#
+# DESCRIPTION: Split the output of a sampled_command() of count outfiles. Returns (series, output): a
+#              time_series of 'bytes' per outfile, from the last sample before its transfer began to the
+#              first one with all of it, and the output without the sample lines.
+#
+##############################################################################################
+def parse_samples(output, count):
+    """parse_samples(output, count):
+          Split the output of a sampled_command() of count outfiles. Returns (series, output): a
+          time_series of 'bytes' per outfile, from the last sample before its transfer began to the
+          first one with all of it, and the output without the sample lines.
+          """
+
+    samples = []
+    lines = []
+    for line in output.splitlines(True):
+        if not line.startswith(SAMPLE_MARK):
+            lines.append(line)
+            continue
+        values = line.split()
+        try:
+            samples.append((float(values[1]), [float(value) for value in values[2:2 + count]]))
+        except (IndexError, ValueError):
+            continue
+
+    series = []
+    for idx in range(count):
+        sizes = [sizes[idx] if idx < len(sizes) else 0.0 for stamp, sizes in samples]
+        started = next((pos for pos, size in enumerate(sizes) if size > 0), len(sizes))
+        ended = sizes.index(sizes[-1]) if sizes and sizes[-1] > 0 else len(sizes) - 1
+        samples_of = time_series(['bytes'])
+        for (stamp, unused), size in list(zip(samples, sizes))[max(started - 1, 0):ended + 1]:
+            samples_of.append(stamp, {'bytes' : size})
+        series.append(samples_of)
+    return series, "".join(lines)
+
+##############################################################################################
+#
+# METHOD: export_series(records, path, rate)
+#
+# DESCRIPTION: Write the bytes received samples of the stats records that have them as "<time> <value>"
+#              files named transfer_<index>_throughput.txt (bytes per second, rate=1) or
+#              transfer_<index>_bytes.txt (rate=0) in the directory path (which must end with "/",
+#              generic_tplot() prepends it to the names). index is the one of the record. Returns the
+#              file names.
+#
+##############################################################################################
+def export_series(records, path, rate=1):
+    """export_series(records, path, rate):
+          Write the bytes received samples of the stats records that have them as "<time> <value>"
+          files named transfer_<index>_throughput.txt (bytes per second, rate=1) or
+          transfer_<index>_bytes.txt (rate=0) in the directory path (which must end with "/",
+          generic_tplot() prepends it to the names). index is the one of the record. Returns the
+          file names.
+          """
+
+    names = []
+    for index, stats in enumerate(records):
+        series = getattr(stats, 'series', None)
+        if series is None:
+            continue
+        name = "transfer_" + str(index) + ("_throughput.txt" if rate else "_bytes.txt")
+        series.export(path + name, 'bytes', rate)
+        names.append(name)
+    return names
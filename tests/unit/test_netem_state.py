@@ -0,0 +1,55 @@
+#!/usr/local/bin/python3.5
+
+#
+# Copyright 2016, Dan Malone, All Rights Reserved.
+#
+from control.netem_state import parse_class_show, tc_class
+
+#########################################################################################
+# netem state parsing
+#
+# Checks parse_class_show() against the output of a real tc (iproute2 6.1, which prints
+# text for "tc -j -s class show") for the htb class netem.set() builds.
+#
+###########################################################################################
+
+# tc -s class show dev va (iproute2-6.1.0)
+CLASS_SHOW = """class htb 10:1 root leaf 11: prio 0 rate 2Mbit ceil 2500Kbit burst 1600b cburst 1600b
+ Sent 726 bytes 9 pkt (dropped 0, overlimits 0 requeues 0)
+ backlog 0b 0p requeues 0
+ lended: 9 borrowed: 0 giants: 0
+ tokens: 94375 ctokens: 75500
+
+"""
+
+def test_class_show():
+    """The htb class of the text output of tc class show has its rates and statistics"""
+
+    entries = parse_class_show(CLASS_SHOW)
+    assert len(entries) == 1
+
+    htb = tc_class(entries[0], "va")
+    assert htb.kind == "htb"
+    assert htb.handle == "10:1"
+    assert htb.parent == "root"
+    assert htb.leaf == "11:"
+    assert htb.rate_kbit == 2000.0
+    assert htb.ceil_kbit == 2500.0
+    assert htb.bytes == 726
+    assert htb.packets == 9
+    assert htb.drops == 0
+
+def test_class_show_units():
+    """Nested classes, -iec rates and backlog sizes"""
+
+    output = ("class htb 1:10 parent 1:1 prio 0 rate 1Gibit ceil 950bit burst 1600b cburst 1600b\n"
+              " Sent 5 bytes 1 pkt (dropped 2, overlimits 3 requeues 4)\n"
+              " backlog 1.5Kb 3p requeues 0\n")
+
+    htb = tc_class(parse_class_show(output)[0], "eth1")
+    assert htb.parent == "1:1"
+    assert htb.rate_kbit == 1024.0 ** 3 / 1000
+    assert htb.ceil_kbit == 0.95
+    assert htb.drops == 2
+    assert htb.backlog == 1536
+    assert htb.qlen == 3
@@ -0,0 +1,70 @@
+#!/usr/local/bin/python3.5
+
+#
+# Copyright 2016, Dan Malone, All Rights Reserved.
+#
+from control.sudo import sudo_policy
+
+#########################################################################################
+# sudo policy
+#
+# Checks which commands a non-root user runs with sudo under the default policy and a
+# custom one. The old substring checks took "lsb_release" for "ls" and "ifconfig" for
+# "if", the policy matches whole program names.
+#
+###########################################################################################
+
+# (command, wrapped by the default policy)
+DEFAULT_CASES = [
+    ("tc qdisc show dev eth1",            "sudo tc qdisc show dev eth1"),
+    ("tcpdump -i any -w a.pcap",          "sudo tcpdump -i any -w a.pcap"),
+    ("/usr/sbin/tc qdisc",                "sudo /usr/sbin/tc qdisc"),
+    ("LC_ALL=C tc -s qdisc",              "sudo LC_ALL=C tc -s qdisc"),
+    ("pkill -TERM -P 20",                 "sudo pkill -TERM -P 20"),
+    ("ls -l /tmp",                        "ls -l /tmp"),
+    ("lsb_release -a",                    "sudo lsb_release -a"),
+    ("if [ -f x ]; then tc qdisc; fi",    "if [ -f x ]; then tc qdisc; fi"),
+    ("ifconfig eth1",                     "sudo ifconfig eth1"),
+    ("cd /tmp; tc qdisc",                 "cd /tmp; tc qdisc"),
+    ("curl -s http://10.0.0.1/f",         "curl -s http://10.0.0.1/f"),
+    ("curlx",                             "sudo curlx"),
+    ("ip link show",                      "sudo ip link show"),
+    ("ipcalc 10.0.0.0/8",                 "sudo ipcalc 10.0.0.0/8"),
+    ("sudo tc qdisc",                     "sudo tc qdisc"),
+    ("(tc qdisc)",                        "sudo sh -c '(tc qdisc)'"),
+    ("{ tc qdisc; tc class; }",           "sudo sh -c '{ tc qdisc; tc class; }'"),
+    ("(cd /tmp; ls)",                     "(cd /tmp; ls)"),
+    ("echo 'a b' > x",                    "echo 'a b' > x"),
+]
+
+# (command, wrapped by a policy with only tc as sudo, ls as plain and plain as the default)
+CUSTOM_CASES = [
+    ("tc qdisc",                          "sudo tc qdisc"),
+    ("tcpdump -i any",                    "tcpdump -i any"),
+    ("ls",                                "ls"),
+    ("grep x y",                          "grep x y"),
+    ("(tc qdisc)",                        "sudo sh -c '(tc qdisc)'"),
+]
+
+def test_default_policy():
+    """The default policy wraps by whole program name"""
+
+    policy = sudo_policy()
+    for cmd, wrapped in DEFAULT_CASES:
+        assert policy.wrap(cmd) == wrapped, cmd
+        # the cached answer is the same
+        assert policy.wrap(cmd) == wrapped, cmd
+
+def test_custom_policy():
+    """A policy's own lists and default replace the built in ones"""
+
+    policy = sudo_policy(sudo=['tc'], plain=['ls'], default="plain")
+    for cmd, wrapped in CUSTOM_CASES:
+        assert policy.wrap(cmd) == wrapped, cmd
+
+def test_needs_sudo():
+    """needs_sudo() is the decision wrap() applies"""
+
+    policy = sudo_policy()
+    for cmd, wrapped in DEFAULT_CASES:
+        assert policy.needs_sudo(cmd) == (1 if wrapped != cmd else 0), cmd
@@ -0,0 +1,62 @@
+#!/usr/local/bin/python3.5
+
+#
+# Copyright 2016, Dan Malone, All Rights Reserved.
+#
+from control.sweep import sweep_plan
+
+#########################################################################################
+# sweep planning
+#
+# Checks the order sweep_plan walks a 3x3x2 grid in (nested by cost, snake order) and the
+# restart / clear / tc counts estimate() is built from.
+#
+###########################################################################################
+
+GRID = {'delay' : [20, 100, 300], 'loss' : [0, 0.5, 2], 'client.cc' : ['cubic', 'bbr']}
+
+def plan():
+    return sweep_plan(GRID, fixed={'COUNT' : 1}, clear_fields=['loss'], point_time=60)
+
+def test_cost_nesting():
+    """Client restarts outermost, then clears, then tc changes"""
+
+    sweep = plan()
+    assert sweep.fields == ['client.cc', 'loss', 'delay']
+    assert sweep_plan({'delay' : [1], 'bandwidth' : [1]}).fields == ['bandwidth', 'delay']
+
+def test_snake_order():
+    """Every combination once, neighbouring points differ in exactly one field"""
+
+    points = list(plan().points())
+    assert len(points) == len(plan()) == 18
+    assert len(set(tuple(point[field] for field in GRID) for point in points)) == 18
+
+    for previous, point in zip(points, points[1:]):
+        assert len([field for field in GRID if point[field] != previous[field]]) == 1
+
+    # the outermost field changes once, in the middle
+    assert [point['client.cc'] for point in points] == ['cubic'] * 9 + ['bbr'] * 9
+    assert points[0]['name'] == "delay_20_loss_0_client.cc_cubic"
+    assert all(point['COUNT'] == 1 for point in points)
+
+def test_steps():
+    """What each step needs, the first one needs everything"""
+
+    steps = list(plan().steps())
+    assert steps[0][1] == {'restart' : 1, 'clear' : 1, 'tc' : 2, 'changed' : ['client.cc', 'loss', 'delay']}
+    assert steps[1][1] == {'restart' : 0, 'clear' : 0, 'tc' : 1, 'changed' : ['delay']}
+    assert steps[3][1] == {'restart' : 0, 'clear' : 1, 'tc' : 2, 'changed' : ['loss']}
+    assert steps[9][1] == {'restart' : 1, 'clear' : 0, 'tc' : 0, 'changed' : ['client.cc']}
+
+def test_estimate():
+    """The counts and times of the estimate"""
+
+    estimate = plan().estimate(report=0)
+    assert estimate['points'] == 18
+    assert estimate['restarts'] == 2
+    assert estimate['clears'] == 5
+    assert estimate['tc'] == 22
+    assert estimate['setup_time'] == 2 * sweep_plan.RESTART_TIME + 5 * sweep_plan.CLEAR_TIME + 22 * sweep_plan.TC_TIME
+    assert estimate['test_time'] == 18 * 60
+    assert estimate['total_time'] == estimate['setup_time'] + estimate['test_time']
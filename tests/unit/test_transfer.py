@@ -0,0 +1,161 @@
+#!/usr/local/bin/python3.5
+
+#
+# Copyright 2016, Dan Malone, All Rights Reserved.
+#
+from control.transfer import transfer_stats, transferThread, parse_write_out, sampled_command, parse_samples
+
+import queue
+import subprocess
+
+#########################################################################################
+# curl transfer records
+#
+# Checks the transfer_stats records built from the curl --write-out metrics line
+# (CURL_WRITE_OUT) and what a transfer thread makes of curl output without one.
+#
+###########################################################################################
+
+# http_code num_connects num_redirects size_download size_upload speed_download speed_upload
+# time_namelookup time_connect time_appconnect time_pretransfer time_starttransfer time_total url_effective
+METRICS = "@@PATI_CURL 200 1 0 1048576 0 2097152.000 0.000 0.001 0.011 0.000 0.012 0.050 0.500 http://10.77.2.2/files/test1M"
+
+def test_write_out():
+    """A metrics line gives typed values and the derived ones"""
+
+    stats = transfer_stats.from_write_out(METRICS)
+    assert stats['http_code'] == 200
+    assert stats['num_connects'] == 1
+    assert stats['size_download'] == 1048576
+    assert stats['speed_download'] == 2097152.0
+    assert stats['time_total'] == 0.5
+    assert stats['url_effective'] == "http://10.77.2.2/files/test1M"
+    assert stats['down_throughput'] == 2097152.0
+    assert stats['dns_time'] == 0.001
+    assert abs(stats['connect_time'] - 0.010) < 1e-9
+    assert stats['tls_time'] == 0.0
+    assert stats['ttfb'] == 0.05
+
+def test_write_out_comma_decimals():
+    """Decimals printed with the locale's comma"""
+
+    stats = transfer_stats.from_write_out(METRICS.replace(".000 ", ",000 ").replace(" 0.500 ", " 0,500 "))
+    assert stats['speed_download'] == 2097152.0
+    assert stats['time_total'] == 0.5
+
+def test_write_out_url_with_spaces():
+    """The url is the rest of the line"""
+
+    stats = transfer_stats.from_write_out(METRICS + " copy 2.bin")
+    assert stats['url_effective'] == "http://10.77.2.2/files/test1M copy 2.bin"
+
+def test_write_out_malformed():
+    """Lines which are not a complete metrics line give None"""
+
+    assert transfer_stats.from_write_out("") is None
+    assert transfer_stats.from_write_out("@@PATI_CURL 200 1 0") is None
+    assert transfer_stats.from_write_out(METRICS.replace(" 200 ", " abc ")) is None
+    assert transfer_stats.from_write_out(METRICS.replace("@@PATI_CURL", "@@OTHER")) is None
+
+def test_parse_write_out():
+    """One record per metrics line in the order of the output, anything else is skipped"""
+
+    output = "curl: (18) transfer closed\n" + METRICS + "\n@@PATI_CURL garbage\n" + METRICS.replace(" 200 ", " 404 ") + "\n"
+    records = parse_write_out(output)
+    assert [stats['http_code'] for stats in records] == [200, 404]
+
+class fake_shell:
+    def __init__(self, output):
+        self.output = output
+    def run(self, cmd, *args):
+        return self.output
+
+class fake_client:
+    proxyPort = 0
+    def __init__(self, output):
+        self.shell = fake_shell(output)
+
+class fake_parent:
+    def __init__(self):
+        self.completed = queue.Queue()
+        self.stats = []
+    def add_stats(self, stats, completed):
+        self.stats.append(stats)
+    def thread_done(self, thread):
+        pass
+
+def test_abnormal_output():
+    """curl output without a metrics line is a failed transfer"""
+
+    parent = fake_parent()
+    options = {'OUTFILE' : "", 'CONTINUOUS' : 0, 'PROXY' : 'DIRECT', 'COUNT' : 1, 'SAMPLE_INTERVAL' : 0}
+    transferThread(parent, fake_client("Connection reset by peer\n"), ["10.77.2.2/files/test1M"], options, 0).run()
+
+    assert len(parent.stats) == 1
+    assert "Transfer encountered abnormal output: Connection reset by peer" in parent.stats[0]["error"]
+    assert parent.stats[0]['http_code'] == 0
+
+#########################################################################################
+# bytes received samples
+#
+# Checks the sampling wrapper of a curl command (sampled_command()) and how its output is
+# split back into one time series per outfile and the curl output (parse_samples()).
+#
+###########################################################################################
+
+def sample(t, *sizes):
+    return "@@PATI_BYTES " + str(t) + " " + " ".join(str(size) for size in sizes) + "\n"
+
+def points(series):
+    return list(zip(series.time, series.data['bytes']))
+
+def test_samples_never_grow():
+    """A file which never grows keeps only the last sample"""
+
+    series, output = parse_samples(sample(100.0, 0) + sample(100.5, 0) + sample(101.0, 0), 1)
+    assert len(series) == 1
+    assert points(series[0]) == [(101.0, 0.0)]
+    assert output == ""
+
+def test_samples_multiple_outfiles():
+    """Each outfile's series runs from the last sample before it grew to the first one at its final size"""
+
+    output = (sample(100.0, 0, 0) + sample(100.5, 10, 0) + sample(101.0, 20, 0) + sample(101.5, 20, 0) +
+              sample(102.0, 20, 5) + sample(102.5, 20, 30) + sample(103.0, 20, 30))
+    series, rest = parse_samples(output, 2)
+    assert points(series[0]) == [(100.0, 0.0), (100.5, 10.0), (101.0, 20.0)]
+    assert points(series[1]) == [(101.5, 0.0), (102.0, 5.0), (102.5, 30.0)]
+    assert rest == ""
+
+def test_samples_missing_and_bad():
+    """Missing sizes count as 0 and sample lines which do not parse are dropped"""
+
+    series, output = parse_samples(sample(100.0, 0) + "@@PATI_BYTES x\n" + sample(100.5) + sample(101.0, 7), 1)
+    assert points(series[0]) == [(100.5, 0.0), (101.0, 7.0)]
+
+def test_samples_leftover_output():
+    """The output without the sample lines still has the curl metrics and errors"""
+
+    output = (sample(100.0, 0) + METRICS[:20] + "\n" + sample(100.5, 10) + "curl: (18) transfer closed\n" + METRICS + "\n" +
+              sample(101.0, 10))
+    series, rest = parse_samples(output, 1)
+    assert rest == METRICS[:20] + "\ncurl: (18) transfer closed\n" + METRICS + "\n"
+    assert "@@PATI_BYTES" not in rest
+    records = parse_write_out(rest)
+    assert len(records) == 1 and records[0]['size_download'] == 1048576
+    assert points(series[0]) == [(100.0, 0.0), (100.5, 10.0)]
+
+def test_sampled_command(tmp_path):
+    """The wrapped command is sampled while it runs, once more at the end, and keeps its exit status"""
+
+    first, second = str(tmp_path / "a b.tmp"), str(tmp_path / "b.tmp")
+    cmd = ("printf 12345 > '" + first + "'; sleep 0.3; printf 1234567890 > '" + second + "'; sleep 0.3; " +
+           "echo '" + METRICS + "'; exit 3")
+    run = subprocess.run(["sh", "-c", sampled_command(cmd, [first, second], 0.1)], stdout=subprocess.PIPE)
+    assert run.returncode == 3
+
+    series, rest = parse_samples(run.stdout.decode('utf-8'), 2)
+    assert series[0].data['bytes'][-1] == 5.0
+    assert series[1].data['bytes'][-1] == 10.0
+    assert series[1].time[-1] > series[0].time[-1]
+    assert len(parse_write_out(rest)) == 1
@@ -73,7 +73,28 @@ GLOBALS['BRANCH']          = ""
 GLOBALS['CONFIG_BASE']     = ""
 GLOBALS['TESTBED_XML']     = "QSilver_Testbed_Config.xml"
 GLOBALS['TESTBED_ID']      = 1
+GLOBALS['TESTBED_BACKEND'] = ""  ;  # Set to netns to build the test bed on this system from network namespaces (control/nsbed.py) instead of TESTBED_XML
+GLOBALS['NSBED_PREFIX']    = "pati" ;  # Name prefix of the namespaces of the netns test bed
 GLOBALS['NETWORK']         = "DEV";  # Set AWS enviornment (DEV, STAGING, PRODUCTION)
+GLOBALS['NETEM_PROFILES']  = "../netem_scripts/netem_testcases.csv" ;  # The csv file of named netem profiles (control/profiles.py)
+GLOBALS['NETEM_STATS_INTERVAL'] = 0.5 ;  # Seconds between qdisc statistics samples taken by netem.start_stats()
+GLOBALS['NETEM_PARALLEL']  = 1   ;  # Set to 1 to switch all netem interfaces to a new profile at the same time (one tc each), 0 for one after the other
+GLOBALS['NETEM_QUEUE_MODEL'] = "bdp" ;  # Queue limit model (control/profiles.py queue_models) for dynamic netem queue sizing of profiles without a network column
+GLOBALS['TRANSFER_SAMPLE_INTERVAL'] = 0 ;  # Seconds between bytes received samples taken while each curl transfer runs (transfer SAMPLE_INTERVAL), 0 for none
+
+# ######################
+# SHELL / SSH TRANSPORT
+# ######################
+GLOBALS['SSH_MULTIPLEX']   = 1   ;  # Set to 1 to reuse one persistent ssh master connection per user@host (ControlMaster), 0 for a new ssh per command
+GLOBALS['SSH_MASTER_WAIT'] = 10  ;  # Seconds to wait for a ssh master connection to come up before falling back to plain ssh
+GLOBALS['XFER_PARALLEL']   = 4   ;  # Maximum number of file copies (scp/rsync) in flight at once for get_files()/put_files()
+GLOBALS['XFER_COMPRESS']   = 0   ;  # Set to 1 to compress file copies on the wire
+GLOBALS['STOP_GRACE']      = 2   ;  # Seconds a launched program is given to exit after a TERM before shell.stop() escalates to KILL
+GLOBALS['LAUNCH_CHECK']    = 0   ;  # Seconds shell.launch() watches a program for an early failing exit before it counts as started, 0 to only poll it
+GLOBALS['SHELL_AGENT']     = 0   ;  # Set to 1 to run remote commands through a resident python agent (control/agent.py) instead of ssh per command
+GLOBALS['AGENT_WAIT']      = 10  ;  # Seconds to wait for the resident agent to answer when it is started before falling back to ssh
+GLOBALS['SHELL_METRICS']   = 0   ;  # Set to 1 to record the timing of every shell command (control/metrics.py), dumped at the end of the run
+GLOBALS['SHELL_METRICS_FILE'] = "shell_metrics" ;  # Base name of the .json/.csv files the shell command timings are written to
 
 
 # These globals get updated as each testcase is run so tests/reports can access the test case name, description, and the file the test is contained in
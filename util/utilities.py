@@ -1,9 +1,10 @@
 #!/usr/bin/python3
 import sys
+import concurrent.futures
 
 from control import organizer
 from control.transfer import *
-from util.globals import getOpt
+from util.globals import getOpt, snip
 from control.test_server import *
 from control.test_client_linux import *
 from control.netem import *
@@ -77,11 +78,14 @@ def testinit(profiles=['']):
     if getOpt('DEBUG'):
         log("Skipping clearing of netem due to DEBUG == 1")
     else:
-        # Clear out any netem cruft on the systems in the testbed
-        test_server_object.clear_netem()
-        netem_object.clear_netem()
+        # Clear out any netem cruft on the systems in the testbed. Each system is cleared in
+        # its own thread so this takes as long as the slowest system, not the sum of all of them.
+        clearing = [test_server_object.clear_netem, netem_object.clear_netem]
         if client_name == "Linux":
-            client_object.clear_netem()
+            clearing.append(client_object.clear_netem)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(clearing)) as pool:
+            for done in [pool.submit(clear) for clear in clearing]:
+                done.result()
 
     if client_name == "Linux":
         log( "TestClient(" + client_object.data_ip + ") ==> Test Server(" + test_server_object.data_ip + ")")
@@ -351,3 +355,13 @@ def zorc_min_allowable_bw(nettype="", rtt=0):
     log("MINIMUM BANDWIDTH CALCULATED = : " +str(bw))
 
     return bw
+
+##########################################################
+# set_dictionary_defaults(defaults, options)
+#   Returns a new dictionary of the defaults with the options given
+#   replacing them (neither dictionary is changed)
+##########################################################
+def set_dictionary_defaults(defaults, options):
+    merged = dict(defaults)
+    merged.update(options)
+    return merged